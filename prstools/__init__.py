@@ -22,9 +22,12 @@ _lazy_exports = {
     
     # load_*
     "load_bed": "prstools.io",
+    "load_bgen": "prstools.io",
     "load_bimfam": "prstools.io",
     "load_example": "prstools.io",
     "load_linkagedata": "prstools.io",
+    "load_pheno": "prstools.io",
+    "load_sample_ids": "prstools.io",
     "load_prscs_ldblk": "prstools.io",
     "load_ref": "prstools.io",
     "load_regdef": "prstools.io",
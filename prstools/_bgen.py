@@ -0,0 +1,169 @@
+import os, struct, zlib, threading
+import numpy as np
+import pandas as pd
+
+# Pure numpy reader for BGEN v1.2 files (layout 2, biallelic diploid variants, zlib/zstd or no compression), giving
+# dosages of the first allele (A1) through the same read() interface as bed_reader's open_bed, so it can be used as a
+# predict() target. Format spec: https://www.well.ox.ac.uk/~gav/bgen_format/spec/v1.2.html
+
+_compressions = {0: None, 1: 'zlib', 2: 'zstd'}
+
+def _read_header(f):
+    offset, L_H, M, N = struct.unpack('<4I', f.read(16))
+    magic = f.read(4)
+    if magic not in (b'bgen', b'\x00\x00\x00\x00'): raise ValueError(f'Not a BGEN file (magic number={magic}).')
+    f.seek(4 + L_H - 4); flags, = struct.unpack('<I', f.read(4))
+    compression = flags & 3; layout = (flags >> 2) & 15; has_ids = (flags >> 31) & 1
+    if layout != 2: raise NotImplementedError(f'Only BGEN layout 2 (v1.2 & v1.3) is supported, this file has layout {layout}.')
+    if compression not in _compressions: raise ValueError(f'Unknown BGEN compression flag: {compression}')
+    ids = None
+    if has_ids:
+        f.seek(4 + L_H); L_SI, N_SI = struct.unpack('<2I', f.read(8)); buf = f.read(L_SI - 8); ids = []; pos = 0
+        for _ in range(N_SI):
+            n, = struct.unpack_from('<H', buf, pos); ids += [buf[pos+2:pos+2+n].decode()]; pos += 2+n
+    return dict(first=offset + 4, n_snp=M, n_iid=N, compression=compression, ids=ids)
+
+def _scan_variants(f, first, n_snp):
+    # One sequential pass over the variant headers, storing the identifying fields and where each genotype block is.
+    def read_str(fmt='<H'):
+        n, = struct.unpack(fmt, f.read(struct.calcsize(fmt))); return f.read(n).decode()
+    f.seek(first); cols = dict(chrom=[], snp=[], varid=[], pos=[], A1=[], A2=[], gstart=[], gsize=[])
+    for _ in range(n_snp):
+        varid = read_str(); snp = read_str(); chrom = read_str()
+        pos, K = struct.unpack('<IH', f.read(6))
+        alleles = [read_str('<I') for _ in range(K)]
+        if K != 2: raise NotImplementedError(f'Only biallelic variants are supported, {snp} has {K} alleles.')
+        C, = struct.unpack('<I', f.read(4)); gstart = f.tell()
+        for key, val in zip(cols, [chrom, snp, varid, pos, *alleles, gstart, C]): cols[key] += [val]
+        f.seek(gstart + C)
+    return cols
+
+def _unpack_bits(buf, n, bits):
+    # n little-endian unsigned integers of width bits, packed back-to-back in the bytes of buf.
+    if bits in (8, 16, 32): return np.frombuffer(buf, dtype=f'<u{bits//8}', count=n)
+    arr = np.unpackbits(np.frombuffer(buf, dtype=np.uint8, count=(n*bits + 7)//8), bitorder='little')[:n*bits]
+    return arr.reshape(n, bits).astype(np.uint64) @ (np.uint64(1) << np.arange(bits, dtype=np.uint64))
+
+def _decode_dosage(raw, n_iid, out):
+    # Layout 2 probability block -> dosage of the first allele (A1, like the counted allele of a plink bed) into out, NaN for missing.
+    N, K, pmin, pmax = struct.unpack_from('<IHBB', raw, 0)
+    assert N == n_iid and K == 2, f'Unexpected sample ({N}) or allele ({K}) count in a BGEN genotype block.'
+    if not pmin == pmax == 2: raise NotImplementedError('Only diploid samples are supported in BGEN files.')
+    ploidy = np.frombuffer(raw, dtype=np.uint8, count=N, offset=8)
+    phased, bits = raw[8+N], raw[9+N]
+    vals = _unpack_bits(memoryview(raw)[10+N:], 2*N, bits).reshape(N, 2).astype(np.float64) # unphased: P(A1A1), P(A1A2); phased: P(A1) per haplotype
+    np.add(vals[:,0], vals[:,1], out=out) if phased else np.add(2.*vals[:,0], vals[:,1], out=out)
+    out /= (2**bits - 1)
+    out[ploidy >= 128] = np.nan # bit 7 flags missingness
+    return out
+
+class BgenReader():
+    dosage = True # tells predict() to use the float (imputation) path, there are no int8 hard calls
+
+    def __init__(self, location, *, sample=None, index_fn=None, verbose=False):
+        self.location = location
+        with open(location, 'rb') as f: hdr = _read_header(f)
+        self.iid_count = hdr['n_iid']; self.sid_count = hdr['n_snp']; self.compression = _compressions[hdr['compression']]
+        self.index_fn = location + '.prstidx.npz' if index_fn is None else index_fn
+        idx_dt = self._load_index(verbose=verbose)
+        if idx_dt is None:
+            if verbose: print(f'Indexing BGEN file (one-off, stored in {self.index_fn})', end=' ', flush=True)
+            with open(location, 'rb') as f: idx_dt = _scan_variants(f, hdr['first'], hdr['n_snp'])
+            idx_dt = {key: np.array(val, dtype='int64' if key in ('pos','gstart','gsize') else str) for key, val in idx_dt.items()}
+            self._save_index(idx_dt)
+            if verbose: print('-> Done', end=' ')
+        self._gstart = idx_dt['gstart']; self._gsize = idx_dt['gsize']
+        self.bim_df = pd.DataFrame(dict(chrom=idx_dt['chrom'], snp=idx_dt['snp'], cm=0., pos=idx_dt['pos'], A1=idx_dt['A1'], A2=idx_dt['A2']))
+        self.fam_df = self._get_fam_df(hdr['ids'], sample)
+        self._fd = os.open(location, os.O_RDONLY); self._lock = threading.Lock()
+
+    def _stat(self):
+        st = os.stat(self.location); return np.array([st.st_size, st.st_mtime_ns], dtype='int64')
+
+    def _load_index(self, verbose=False):
+        # The cached index is used if the BGEN file did not change (same size & modification time).
+        if not os.path.isfile(self.index_fn): return None
+        try:
+            with np.load(self.index_fn) as npz: idx_dt = {key: npz[key] for key in npz.files}
+        except Exception: return None
+        if not (idx_dt.pop('stat') == self._stat()).all() or len(idx_dt['gstart']) != self.sid_count: return None
+        if verbose: print(f'Using BGEN index: {self.index_fn}', end=' ')
+        return idx_dt
+
+    def _save_index(self, idx_dt):
+        import prstools as prst
+        def to_file(tmp_fn):
+            with open(tmp_fn, 'wb') as f: np.savez(f, stat=self._stat(), **idx_dt)
+        try: prst.io._pd_to_atomizer(to_file=to_file, fn=self.index_fn)
+        except OSError as e: prst.warn(f'Could not store the BGEN index next to the file ({e}), it will be recomputed next time.')
+
+    def _get_fam_df(self, ids, sample):
+        # Sample ids from a .sample file (if given or present next to the BGEN file), else from the BGEN itself.
+        if sample is None and os.path.isfile(self.location[:-5] + '.sample'): sample = self.location[:-5] + '.sample'
+        if sample is not None:
+            smp_df = pd.read_csv(sample, sep=r'\s+', dtype=str).iloc[1:] # 2nd line holds the column types
+            fid, iid = smp_df.iloc[:,0].to_numpy(), smp_df.iloc[:,1].to_numpy()
+        else: fid = iid = np.array(ids if ids is not None else [f'sample_{i}' for i in range(self.iid_count)])
+        assert len(iid) == self.iid_count, f'Number of samples in the sample file ({len(iid)}) and BGEN ({self.iid_count}) differ.'
+        return pd.DataFrame(dict(fid=fid, iid=iid, father='0', mother='0', gender=0, trait=-9))
+
+    def _pread(self, n, offset):
+        if hasattr(os, 'pread'): return os.pread(self._fd, n, offset) # thread safe, no shared file position
+        with self._lock: os.lseek(self._fd, offset, os.SEEK_SET); return os.read(self._fd, n)
+
+    def _decompress(self, buf):
+        if self.compression is None: return buf
+        D, = struct.unpack_from('<I', buf, 0)
+        if self.compression == 'zlib': return zlib.decompress(buf[4:])
+        try: import zstandard
+        except ImportError: raise ImportError('This BGEN file is zstd compressed, which requires the zstandard package (pip install zstandard).')
+        return zstandard.ZstdDecompressor().decompress(buf[4:], max_output_size=D)
+
+    def read(self, index=None, dtype='float64', order='F', num_threads=None):
+        # Dosages (samples x variants) of the A1 allele, missing as NaN. index=np.s_[rows, cols] as for open_bed.
+        if np.dtype(dtype).kind != 'f': raise ValueError(f'BGEN files hold dosages, so dtype must be a float type (not {dtype}).')
+        rows, cols = (slice(None), slice(None)) if index is None else index if type(index) is tuple else (index, slice(None))
+        cols = np.arange(self.sid_count)[cols] if not isinstance(cols, (int, np.integer)) else np.array([cols])
+        X = np.empty((self.iid_count, len(cols)), dtype='float64', order='F')
+        if len(cols) > 0 and (np.diff(cols) > 0).all(): # sorted: one read for the whole span
+            lo = self._gstart[cols[0]]; buf = self._pread(int(self._gstart[cols[-1]] + self._gsize[cols[-1]] - lo), int(lo))
+            blocks = (memoryview(buf)[s - lo:s - lo + n] for s, n in zip(self._gstart[cols], self._gsize[cols]))
+        else: blocks = (self._pread(int(self._gsize[j]), int(self._gstart[j])) for j in cols)
+        for j, block in enumerate(blocks):
+            _decode_dosage(self._decompress(block), self.iid_count, X[:,j])
+        X = X[rows] if not (type(rows) is slice and rows == slice(None)) else X
+        return np.asarray(X, dtype=dtype, order=order)
+
+    def close(self):
+        if getattr(self, '_fd', None) is not None: os.close(self._fd); self._fd = None
+
+    def __enter__(self): return self
+    def __exit__(self, *args): self.close()
+    def __del__(self): self.close()
+
+def write_bgen(fn, probs, bim_df, *, ids=None, bits=8, compression=1, phased=False, missing=None):
+    # Writes a (layout 2, biallelic, diploid) BGEN file, used for testing & benchmarking. probs has shape (variants x samples x 2)
+    # and holds P(A1A1), P(A1A2) (or P(A1) per haplotype if phased). Returns the dosages as they are stored after rounding.
+    n_snp, n_iid, _ = probs.shape; maxval = 2**bits - 1
+    missing = np.zeros((n_snp, n_iid), dtype=bool) if missing is None else missing
+    def pstr(s, fmt='<H'): s = str(s).encode(); return struct.pack(fmt, len(s)) + s
+    free = b''; flags = compression | (2 << 2) | ((ids is not None) << 31)
+    header = struct.pack('<3I', 20 + len(free), n_snp, n_iid) + b'bgen' + free + struct.pack('<I', flags)
+    sids = b''.join(pstr(i) for i in ids) if ids is not None else b''
+    sids = struct.pack('<2I', 8 + len(sids), n_iid) + sids if ids is not None else b''
+    dosages = np.empty((n_iid, n_snp))
+    with open(fn, 'wb') as f:
+        f.write(struct.pack('<I', len(header) + len(sids)) + header + sids)
+        for j, row in enumerate(bim_df[['chrom','snp','pos','A1','A2']].itertuples(index=False)):
+            vals = np.rint(probs[j]*maxval).astype(np.uint64)
+            if not phased: vals[:,1] = np.minimum(vals[:,1], maxval - vals[:,0])
+            vals[missing[j]] = 0
+            dosages[:,j] = (vals[:,0] + vals[:,1] if phased else 2*vals[:,0] + vals[:,1])/maxval; dosages[missing[j],j] = np.nan
+            bitarr = ((vals.reshape(-1)[:,None] >> np.arange(bits, dtype=np.uint64)) & 1).astype(np.uint8)
+            ploidy = np.where(missing[j], 2 | 128, 2).astype(np.uint8)
+            raw = struct.pack('<IHBB', n_iid, 2, 2, 2) + ploidy.tobytes() + bytes([int(phased), bits]) + np.packbits(bitarr.reshape(-1), bitorder='little').tobytes()
+            if compression == 2: import zstandard; block = struct.pack('<I', len(raw)) + zstandard.ZstdCompressor().compress(raw)
+            else: block = struct.pack('<I', len(raw)) + zlib.compress(raw) if compression == 1 else raw
+            f.write(pstr(f'{row.chrom}:{row.pos}') + pstr(row.snp) + pstr(row.chrom) + struct.pack('<IH', row.pos, 2)
+                    + pstr(row.A1, '<I') + pstr(row.A2, '<I') + struct.pack('<I', len(block)) + block)
+    return dosages
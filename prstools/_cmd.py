@@ -430,11 +430,11 @@ if '_isdevenv_prstools' in locals() or '--dev-secret' in sys.argv:
     importlib.reload(models); importlib.reload(utils)
     try:
         from prstools.models import PRSCS2, MultiPRS
-        from prstools.utils import DownloadUtil, store_argparse_dicts, Combine, Config, Transform
+        from prstools.utils import DownloadUtil, store_argparse_dicts, Combine, Config, Transform, TargetStats, Extract
         try: from prstools.models._ext import _ext_cli_selection
         except: _ext_cli_selection = []
         extra = [getattr(models,elem) for elem in _ext_cli_selection]
-        subparserkwg_lst = [Config, DownloadUtil, Transform, Combine, PRSCS2, MultiPRS] + extra
+        subparserkwg_lst = [Config, DownloadUtil, Transform, Combine, TargetStats, Extract, PRSCS2, MultiPRS] + extra
         store_argparse_dicts(subparserkwg_lst)
         print('Saved new argparse dict. (mind: dont forget the suppress mechanism, this is something in the argparse-dict processing)') 
     except Exception as e: 
@@ -87,6 +87,10 @@ def get_subparserkwg_lst():
                                          'sep': {'args': ['--sep'], 'kwargs': {'help': 'Seperator for the inputs files, default is \\t (tab).', 'type': str, 'default': '\t'}},
                                          'n_eff_handling': {'args': ['--n_eff_handling'], 'kwargs': {'help': None, 'type': str, 'default': 'raw'}},
                                          'pyarrow': {'args': ['--pyarrow'], 'kwargs': {'help': None, 'type': bool, 'default': True}},
+                                         'cache': {'args': ['--cache'],
+                                                   'kwargs': {'help': 'Also store a columnar cache of each output (<out>.prstcache.feather) so later runs load it in a fraction of the time.',
+                                                              'type': bool,
+                                                              'default': True}},
                                          'verbose': {'args': ['--verbose'], 'kwargs': {'help': None, 'type': bool, 'default': True}}}}},
       'subtype': 'PRSTCLI'},
      {'cmdname': 'combine',
@@ -139,6 +143,51 @@ def get_subparserkwg_lst():
                                          'pyarrow': {'args': ['--pyarrow'], 'kwargs': {'help': None, 'type': bool, 'default': True}},
                                          'verbose': {'args': ['--verbose'], 'kwargs': {'help': None, 'type': bool, 'default': True}}}}},
       'subtype': 'PRSTCLI'},
+     {'cmdname': 'targetstats',
+      'clsname': 'TargetStats',
+      'description': 'Compute allele frequencies, missing rates and hard-call counts for every variant of a target plink bed file.\n'
+                     'The results are stored in a compact sidecar next to the bed (<target>.prsttargetstats.npz), which is tied to the exact\n'
+                     'bed file (size & modification time). Prediction then uses these statistics for the mean imputation of missing genotypes \n'
+                     'and for variant filtering, instead of recomputing them.\n',
+      'help': 'Compute allele frequencies, missing rates and hard-call counts for every variant of a target plink bed file.',
+      'epilog': None,
+      'display_info': False,
+      'modulename': 'prstools.utils',
+      'groups': {'general': {'grpheader': 'Options',
+                             'pkwargs': {'basics': {'args': ['-h', '--help'], 'kwargs': {'action': 'help', 'help': 'Show this help message and exit.'}},
+                                         'target': {'args': ['--target'], 'kwargs': {'help': 'The target plink bed file or its prefix.', 'type': str, 'default': 'SUPPRESS', 'required': True}},
+                                         'out': {'args': ['--out'],
+                                                 'kwargs': {'help': 'Optional: Output file for the statistics (default: next to the bed file). Predictions only pick up the default location.',
+                                                            'type': str,
+                                                            'default': 'SUPPRESS'}},
+                                         'n_jobs': {'args': ['--n_jobs'], 'kwargs': {'help': 'Number of worker processes, each computes the statistics for chunks of variants.', 'type': int, 'default': 1}},
+                                         'tsv': {'args': ['--tsv'], 'kwargs': {'help': 'Also store the statistics as a readable tab-separated file.', 'type': bool, 'default': False}},
+                                         'verbose': {'args': ['--verbose'], 'kwargs': {'help': None, 'type': bool, 'default': True}}}}},
+      'subtype': 'PRSTCLI'},
+     {'cmdname': 'extract',
+      'clsname': 'Extract',
+      'description': 'Extract the target variants that are in a variant list (e.g. a HapMap3 subset or weights) into a compact plink fileset.\n'
+                     'The variants are matched on id & alleles and copied from the target plink bed file without decoding. A manifest of the\n'
+                     'source (<out>.prstextract.json) is stored too, a warning is given when the extract is used after its source bed changed.\n'
+                     'Predictions for weights on that variant set can then use the (much smaller) extract as target instead of the full bed.\n',
+      'help': 'Extract the target variants that are in a variant list (e.g. a HapMap3 subset or weights) into a compact plink fileset.',
+      'epilog': None,
+      'display_info': False,
+      'modulename': 'prstools.utils',
+      'groups': {'general': {'grpheader': 'Options',
+                             'pkwargs': {'basics': {'args': ['-h', '--help'], 'kwargs': {'action': 'help', 'help': 'Show this help message and exit.'}},
+                                         'target': {'args': ['--target'], 'kwargs': {'help': 'The target plink bed file or its prefix.', 'type': str, 'default': 'SUPPRESS', 'required': True}},
+                                         'variants': {'args': ['--variants'],
+                                                      'kwargs': {'help': 'The variant list: a bim file, a headed file with a snp column (+ optionally A1 & A2, e.g. weights) or a file with one variant '
+                                                                         'id per line.',
+                                                                 'type': str,
+                                                                 'default': 'SUPPRESS',
+                                                                 'required': True}},
+                                         'out': {'args': ['--out'],
+                                                 'kwargs': {'help': 'Output prefix for the extracted plink fileset (.bed/.bim/.fam) and its manifest.', 'type': str, 'default': 'SUPPRESS', 'required': True}},
+                                         'rsidmode': {'args': ['--rsidmode'], 'kwargs': {'help': 'How to handle the variant ids of the target, see validate_dataframe_rsids.', 'type': str, 'default': 'auto'}},
+                                         'verbose': {'args': ['--verbose'], 'kwargs': {'help': None, 'type': bool, 'default': True}}}}},
+      'subtype': 'PRSTCLI'},
      {'cmdname': 'prscs2',
       'clsname': 'PRSCS2',
       'description': 'PRS-CS v2: A polygenic prediction method that infers posterior SNP effect sizes under continuous shrinkage (CS) priors.',
@@ -228,7 +277,37 @@ def get_subparserkwg_lst():
                                                            'type': str,
                                                            'default': 'strict'}},
                                        'missing': {'args': ['--missing'], 'kwargs': {'help': None, 'type': str, 'default': 'flex'}},
-                                       'val': {'args': ['--val'], 'kwargs': {'help': None, 'type': NoneType, 'default': None}},
+                                       'n_jobs': {'args': ['--n_jobs'],
+                                                  'kwargs': {'help': 'Number of worker processes for scoring the target, which is then tiled over (samples x variants). With 1 the scoring is done '
+                                                                     'in-process.',
+                                                             'type': int,
+                                                             'default': 1}},
+                                       'val': {'args': ['--val'],
+                                               'kwargs': {'help': "Validation phenotype for selecting the best weights. Use 'fam' for the target's fam trait column or give a pheno file (FID IID "
+                                                                  'pheno..).',
+                                                          'type': str,
+                                                          'default': 'SUPPRESS'}},
+                                       'pheno': {'args': ['--pheno'],
+                                                 'kwargs': {'help': 'Column of the --val pheno file to use (default: the first phenotype column).', 'type': str, 'default': 'SUPPRESS'}},
+                                       'metric': {'args': ['--metric'],
+                                                  'kwargs': {'help': "Selection metric, 'r2' or 'auc'. With 'auto' AUC is used for binary phenotypes and R2 otherwise.",
+                                                             'type': str,
+                                                             'default': 'auto'}},
+                                       'keep': {'args': ['--keep'],
+                                                'kwargs': {'help': 'File with the induviduals (FID IID, or only IID) of the target to score, others are not read. Order and duplicates do not '
+                                                                   'matter.',
+                                                           'type': str,
+                                                           'default': 'SUPPRESS'}},
+                                       'remove': {'args': ['--remove'],
+                                                  'kwargs': {'help': 'File with the induviduals (FID IID, or only IID) of the target to leave out of the scoring.', 'type': str, 'default': 'SUPPRESS'}},
+                                       'sparse': {'args': ['--sparse'],
+                                                  'kwargs': {'help': 'Combine the weights into a sparse matrix, so memory scales with the number of nonzero weights (e.g. for thousands of PGS Catalog scores).',
+                                                             'type': bool,
+                                                             'default': False}},
+                                       'checkpoint': {'args': ['--checkpoint'],
+                                                      'kwargs': {'help': 'Store the running scores in a checkpoint next to the output, so a crashed prediction resumes from it (requires --n_jobs 1).',
+                                                                 'type': bool,
+                                                                 'default': False}},
                                        'groupby': {'args': ['--groupby'], 'kwargs': {'help': None, 'type': str, 'default': 'SUPPRESS'}},
                                        'pbar': {'args': ['--pbar'], 'kwargs': {'help': None, 'type': bool, 'default': True}},
                                        'verbose': {'args': ['--verbose'], 'kwargs': {'help': None, 'type': bool, 'default': False}}}}},
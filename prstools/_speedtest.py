@@ -0,0 +1,239 @@
+import os, sys, time, argparse
+import numpy as np
+import pandas as pd
+import prstools as prst
+
+# Benchmarks for the prstools internals, run with e.g. "_speedtest predict --size-gb 2 --dn /tmp/speedtest".
+# Synthetic plink files are created once and reused (their name encodes the dimensions).
+
+def make_synthetic_bed(base_fn, *, n_iid, n_snp, miss_rate=0.01, seed=42, block_mb=64, verbose=True):
+    # Writes base_fn.{bed,bim,fam} with random genotypes, in blocks so multi-GB files dont need multi-GB of memory.
+    rng = np.random.default_rng(seed)
+    nbytes = (n_iid + 3)//4
+    lut = np.arange(256, dtype=np.uint8) # Maps each 2-bit missing code (01) to heterozygous (10), missings are added below.
+    for shift in range(0, 8, 2):
+        ind = ((lut >> shift) & 3) == 1
+        lut[ind] = (lut[ind] & ~np.uint8(3 << shift)) | np.uint8(2 << shift)
+    n_inblock = max(1, int(block_mb*2**20/nbytes))
+    if verbose: print(f'Writing synthetic bed ({n_iid:,} induv x {n_snp:,} snps, {n_snp*nbytes/2**30:.2f} GB) to: {base_fn}.bed', end=' ', flush=True)
+    with open(base_fn + '.bed', 'wb') as f:
+        f.write(bytes([0x6c, 0x1b, 0x01]))
+        for start in range(0, n_snp, n_inblock):
+            block = lut[rng.integers(0, 256, size=(min(n_inblock, n_snp-start), nbytes), dtype=np.uint8)]
+            if miss_rate > 0:
+                i, j = np.nonzero(rng.random(block.shape) < miss_rate*4) # a byte holds 4 induviduals
+                block[i, j] = (block[i, j] & np.uint8(0xfc)) | np.uint8(1)
+            f.write(block.tobytes())
+    bim_df = pd.DataFrame(dict(chrom=(np.arange(n_snp)*22//max(n_snp,1)) + 1, snp=[f'rs{i}' for i in range(n_snp)], cm=0,
+                               pos=np.arange(n_snp)*100 + 1, A1='A', A2='G'))
+    prst.save_bim(bim_df, fn=base_fn + '.bim', verbose=False)
+    fam_df = pd.DataFrame(dict(fid=[f'f{i}' for i in range(n_iid)], iid=[f'i{i}' for i in range(n_iid)], father=0, mother=0, gender=0, trait=-9))
+    prst.save_fam(fam_df, fn=base_fn + '.fam', verbose=False)
+    if verbose: print('-> Done')
+    return base_fn
+
+def get_synthetic_bed(dn, *, size_gb, n_iid, verbose=True):
+    n_snp = int(size_gb*2**30/((n_iid + 3)//4))
+    base_fn = os.path.join(dn, f'synth_{n_iid}x{n_snp}')
+    if not os.path.isfile(base_fn + '.bed'):
+        os.makedirs(dn, exist_ok=True)
+        make_synthetic_bed(base_fn, n_iid=n_iid, n_snp=n_snp, verbose=verbose)
+    return base_fn
+
+def get_synthetic_weights(bed, *, n_configs=1, frac=1., seed=42):
+    rng = np.random.default_rng(seed)
+    weights_df = bed.bim_df[['chrom','snp','pos','A1','A2']]
+    if frac < 1: weights_df = weights_df[rng.random(weights_df.shape[0]) < frac]
+    weights_df = weights_df.reset_index(drop=True)
+    W = rng.standard_normal((weights_df.shape[0], n_configs))*1e-3
+    if n_configs == 1: weights_df['allele_weight'] = W[:,0]; return weights_df
+    cols = pd.MultiIndex.from_tuples([(col, '') for col in weights_df.columns] + [('allele_weight', f'cfg{j}') for j in range(n_configs)])
+    weights_df = pd.concat([weights_df, pd.DataFrame(W)], axis=1); weights_df.columns = cols
+    return weights_df
+
+def dropcache(fn):
+    # Evicts the file from the OS page cache (linux), so reads come from disk again.
+    if not hasattr(os, 'posix_fadvise'): return False
+    fd = os.open(fn, os.O_RDONLY)
+    try: os.fsync(fd); os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally: os.close(fd)
+    return True
+
+def timeit(fun, *, repeats=1, prefun=None):
+    secs = []
+    for _ in range(repeats):
+        if prefun: prefun()
+        tic = time.perf_counter(); res = fun(); secs += [time.perf_counter() - tic]
+    return min(secs), res
+
+def bench_predict(base_fn, *, n_configs=1, repeats=1, cold=True, settings=None, verbose=True, **kwg):
+    from prstools.models import MultiPRS
+    bed = prst.load_bed(base_fn)
+    model = MultiPRS.from_weights(get_synthetic_weights(bed, n_configs=n_configs), pbar=False)
+    prefun = (lambda: dropcache(base_fn + '.bed')) if cold else None
+    if settings is None: settings = dict(sync=dict(prefetch=0, adaptive=False), prefetch=dict(prefetch=2, adaptive=False),
+                    prefetch_adaptive=dict(prefetch=2, adaptive=True))
+    res_lst = []; ref = None
+    for name, setkwg in settings.items():
+        secs, yhat = timeit(lambda: model.predict(bed, **setkwg, **kwg), repeats=repeats, prefun=prefun)
+        if ref is None: ref = yhat.to_numpy()
+        res_lst += [dict(setting=name, secs=secs, maxdiff=np.abs(yhat.to_numpy() - ref).max())]
+        if verbose: print(f'{name:<20} {secs:8.2f}s')
+    res_df = pd.DataFrame(res_lst)
+    res_df['speedup'] = res_df['secs'].iloc[0]/res_df['secs']
+    return res_df
+
+def bench_tiled(base_fn, *, n_configs=1, max_jobs=None, repeats=1, cold=True, verbose=True):
+    # Scaling of the tiled process-parallel scoring engine from 1 to max_jobs worker processes.
+    from prstools.models._compute import score_bed_tiled
+    bed = prst.load_bed(base_fn)
+    W = get_synthetic_weights(bed, n_configs=n_configs)['allele_weight'].to_numpy()
+    xidx = np.arange(bed.sid_count); max_jobs = os.cpu_count() if max_jobs is None else max_jobs
+    prefun = (lambda: dropcache(base_fn + '.bed')) if cold else None
+    res_lst = []
+    for n_jobs in range(1, max_jobs+1):
+        secs, _ = timeit(lambda: score_bed_tiled(bed, xidx, W, n_jobs=n_jobs), repeats=repeats, prefun=prefun)
+        res_lst += [dict(n_jobs=n_jobs, secs=secs)]
+        if verbose: print(f'n_jobs={n_jobs:<13} {secs:8.2f}s')
+    res_df = pd.DataFrame(res_lst)
+    res_df['speedup'] = res_df['secs'].iloc[0]/res_df['secs']
+    res_df['efficiency'] = res_df['speedup']/res_df['n_jobs']
+    return res_df
+
+def bench_sparse(base_fn, *, n_scores=1000, frac=0.01, repeats=1, cold=True, verbose=True, seed=42):
+    # Many mostly disjoint scores (PGS Catalog like), combined dense (fillna(0)) vs as a sparse matrix.
+    from prstools.models import MultiPRS
+    bed = prst.load_bed(base_fn); rng = np.random.default_rng(seed)
+    bim_df = bed.bim_df[['chrom','snp','cm','pos','A1','A2']]
+    weights_dt = {f'score{j}': bim_df[rng.random(bim_df.shape[0]) < frac].assign(allele_weight=lambda df: rng.standard_normal(df.shape[0])*1e-3)
+                  for j in range(n_scores)}
+    prefun = (lambda: dropcache(base_fn + '.bed')) if cold else None
+    res_lst = []
+    for sparse in [False, True]:
+        tic = time.perf_counter(); model = MultiPRS.from_dict(weights_dt, ref_df=bim_df, sparse=sparse); model.pbar = False
+        combine_secs = time.perf_counter() - tic
+        nbytes = (model.sparse_weights_.data.nbytes + model.sparse_weights_.indices.nbytes) if sparse else model.get_weights()['allele_weight'].to_numpy().nbytes
+        secs, _ = timeit(lambda: model.predict(bed), repeats=repeats, prefun=prefun)
+        res_lst += [dict(setting='sparse' if sparse else 'dense', combine_secs=combine_secs, weights_mb=nbytes/2**20, secs=secs)]
+        if verbose: print(f"{res_lst[-1]['setting']:<20} {secs:8.2f}s")
+    res_df = pd.DataFrame(res_lst)
+    res_df['speedup'] = res_df['secs'].iloc[0]/res_df['secs']
+    return res_df
+
+def bench_prsio(dn, *, n_iid=50_000, n_scores=200, repeats=1, verbose=True, seed=42):
+    # Size, write and read times of the prediction output formats of save_prs(), for a random (samples x scores) prediction.
+    rng = np.random.default_rng(seed); os.makedirs(dn, exist_ok=True)
+    index = pd.MultiIndex.from_arrays([[f'f{i}' for i in range(n_iid)], [f'i{i}' for i in range(n_iid)]], names=['fid','iid'])
+    yhat = pd.DataFrame(rng.standard_normal((n_iid, n_scores)), index=index, columns=[f'score{j}' for j in range(n_scores)])
+    res_lst = []
+    for ext in ['tsv','parquet','feather','npy','h5']:
+        fn = os.path.join(dn, f'prsio_{n_iid}x{n_scores}.{ext}')
+        write_secs, _ = timeit(lambda: prst.io.save_prs(yhat, fn=fn), repeats=repeats)
+        read_secs, df = timeit(lambda: prst.io.load_prs(fn), repeats=repeats)
+        col_secs, _ = timeit(lambda: prst.io.load_prs(fn, columns=['score0']), repeats=repeats)
+        assert np.allclose(df.iloc[:,2:].to_numpy(), yhat.to_numpy(), rtol=1e-14)
+        res_lst += [dict(format=ext, size_mb=os.path.getsize(fn)/2**20, write_secs=write_secs, read_secs=read_secs, read1col_secs=col_secs)]
+        if verbose: print(f'{ext:<20} {read_secs:8.2f}s')
+        os.remove(fn)
+    res_df = pd.DataFrame(res_lst)
+    res_df['read_speedup'] = res_df['read_secs'].iloc[0]/res_df['read_secs']
+    return res_df
+
+def get_synthetic_variants(n, *, seed=42, frac_flip=0.5):
+    # Bim-like variant frame (snp, A1, A2) with n unique rsids, the first half of the alleles possibly swapped.
+    rng = np.random.default_rng(seed); A = np.array(list('ACGT'))
+    a1 = rng.integers(0, 4, n); a2 = (a1 + rng.integers(1, 4, n)) % 4
+    swap = rng.random(n) < frac_flip; a1, a2 = np.where(swap, a2, a1), np.where(swap, a1, a2)
+    return pd.DataFrame(dict(snp=pd.array(np.char.add('rs', np.arange(n).astype(str)), dtype='string[pyarrow]'),
+                             A1=pd.array(A[a1], dtype='string[pyarrow]'), A2=pd.array(A[a2], dtype='string[pyarrow]')))
+
+def bench_merge(*, n_left=1_000_000, n_right=10_000_000, repeats=1, verbose=True, seed=42):
+    # merge_snps() of a (sumstat like) left frame with a large (target bim like) right frame, pd.merge vs the int64 join engine.
+    right_df = get_synthetic_variants(n_right, seed=seed)
+    left_df = get_synthetic_variants(n_right, seed=seed+1).sample(n=n_left, random_state=seed).reset_index(drop=True)
+    left_df['beta'] = 1.
+    res_lst = []
+    for engine in ['pandas','index']:
+        secs, mrg_df = timeit(lambda: prst.io.merge_snps(left_df.copy(), right_df, flipcols=[], handle_missing='filter', engine=engine), repeats=repeats)
+        res_lst += [dict(engine=engine, n_left=n_left, n_right=n_right, n_matched=mrg_df.shape[0], secs=secs)]
+        if verbose: print(f'{engine:<20} {secs:8.2f}s')
+    res_df = pd.DataFrame(res_lst)
+    res_df['speedup'] = res_df['secs'].iloc[0]/res_df['secs']
+    return res_df
+
+def get_synthetic_chain(dn, *, n_blocks=500_000, seed=42, verbose=True):
+    # A gzipped UCSC chain file with one chain per chromosome (1 in 5 onto the minus strand) of n_blocks gapped blocks in total.
+    fn = os.path.join(dn, f'synth_{n_blocks}.over.chain.gz')
+    if os.path.isfile(fn): return fn
+    import gzip
+    os.makedirs(dn, exist_ok=True); rng = np.random.default_rng(seed)
+    if verbose: print(f'Writing synthetic chain file ({n_blocks:,} blocks) to: {fn}', end=' ', flush=True)
+    with gzip.open(fn, 'wt') as f:
+        for chrom in range(1, 23):
+            size = rng.integers(100, 20_000, n_blocks//22); dt = rng.integers(0, 500, len(size)); dq = rng.integers(0, 500, len(size))
+            tlen = int(size.sum() + dt[:-1].sum()); qlen = int(size.sum() + dq[:-1].sum())
+            f.write(f'chain 1000 chr{chrom} {tlen+10} + 0 {tlen} chr{chrom} {qlen+10} {"-" if chrom%5==0 else "+"} 0 {qlen} {chrom}\n')
+            f.write('\n'.join(f'{a}\t{b}\t{c}' for a, b, c in zip(size[:-1], dt[:-1], dq[:-1])) + f'\n{size[-1]}\n\n')
+    if verbose: print('-> Done')
+    return fn
+
+def bench_liftover(dn, *, n_pos=10_000_000, n_blocks=500_000, repeats=1, verbose=True, seed=42):
+    # get_liftoverpositions() with the vectorized chain engine, the row-by-row pyliftover one is only run if installed (on a 1% subset).
+    chain_fn = get_synthetic_chain(dn, n_blocks=n_blocks, seed=seed, verbose=verbose)
+    tic = time.perf_counter(); chain_dt = prst.io.load_chain(chain_fn, cache=False); load_secs = time.perf_counter() - tic
+    if verbose: print(f'{"load_chain":<20} {load_secs:8.2f}s')
+    rng = np.random.default_rng(seed); tlen = {int(k[3:]): v['end'][-1] for k, v in chain_dt['chroms'].items()}
+    chrom = rng.integers(1, 23, n_pos); pos = (rng.random(n_pos)*np.array([0]+[tlen[c] for c in range(1, 23)])[chrom]).astype(np.int64) + 1
+    df = pd.DataFrame(dict(chrom=chrom, pos=pos))
+    res_lst = []
+    for engine, cdf in [('chain', df), ('pyliftover', df.iloc[:n_pos//100])]:
+        if engine == 'pyliftover':
+            try: import pyliftover
+            except ImportError: continue
+        secs, lft_df = timeit(lambda: prst.io.get_liftoverpositions(cdf, bldin=19, bldout=38, chain=chain_fn if engine=='pyliftover' else chain_dt, engine=engine, verbose=engine=='pyliftover'), repeats=repeats)
+        res_lst += [dict(engine=engine, n_pos=cdf.shape[0], n_mapped=int(lft_df['pos'].notna().sum()), secs=secs, pos_per_sec=cdf.shape[0]/secs)]
+        if verbose: print(f'{engine:<20} {secs:8.2f}s')
+    return pd.DataFrame(res_lst)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='_speedtest', description='Benchmarks for prstools internals (developer tool).')
+    parser.add_argument('bench', choices=['predict','algo','tiled','sparse','prsio','merge','liftover'], help='Which benchmark to run: the read-ahead pipeline (predict), the scoring kernels (algo), '
+                        'the core scaling of the tiled process-parallel scoring (tiled), dense vs sparse many-score weights (sparse), the prediction output formats (prsio) '
+                        'the merge_snps() join engines (merge) or the chain file liftover (liftover).')
+    parser.add_argument('--dn', default='./speedtest', help='Directory for the synthetic data (reused between runs).')
+    parser.add_argument('--size-gb', type=float, default=2., help='Size of the synthetic bed file in GB.')
+    parser.add_argument('--n-iid', type=int, default=50_000, help='Number of induviduals in the synthetic bed file.')
+    parser.add_argument('--n-configs', type=int, default=1, help='Number of weight columns (e.g. hyperparameter configurations).')
+    parser.add_argument('--repeats', type=int, default=1, help='Number of repeats, the fastest is reported.')
+    parser.add_argument('--max-jobs', type=int, default=None, help='Largest number of worker processes for the tiled benchmark (default: all cores).')
+    parser.add_argument('--n-scores', type=int, default=1000, help='Number of scores for the sparse (each covering --frac of the variants) and prsio benchmarks.')
+    parser.add_argument('--frac', type=float, default=0.01, help='Fraction of the variants with a weight per score (sparse benchmark).')
+    parser.add_argument('--warm', action='store_true', help='Do not evict the bed file from the page cache before each run.')
+    parser.add_argument('--n-left', type=int, default=1_000_000, help='Number of variants in the left frame (merge benchmark).')
+    parser.add_argument('--n-right', type=int, default=10_000_000, help='Number of variants in the right frame (merge benchmark).')
+    parser.add_argument('--n-pos', type=int, default=10_000_000, help='Number of positions to lift (liftover benchmark).')
+    args = parser.parse_args(argv)
+    if args.bench == 'liftover': # No bed file needed
+        res_df = bench_liftover(args.dn, n_pos=args.n_pos, repeats=args.repeats)
+        print(res_df.to_string(index=False)); return res_df
+    if args.bench == 'merge': # No bed file needed
+        res_df = bench_merge(n_left=args.n_left, n_right=args.n_right, repeats=args.repeats)
+        print(res_df.to_string(index=False)); return res_df
+    if args.bench == 'prsio': # No bed file needed
+        res_df = bench_prsio(args.dn, n_iid=args.n_iid, n_scores=args.n_scores, repeats=args.repeats)
+        print(res_df.to_string(index=False)); return res_df
+    base_fn = get_synthetic_bed(args.dn, size_gb=args.size_gb, n_iid=args.n_iid)
+    if args.bench == 'predict':
+        res_df = bench_predict(base_fn, n_configs=args.n_configs, repeats=args.repeats, cold=not args.warm)
+    elif args.bench == 'algo':
+        settings = {algo: dict(algo=algo) for algo in ['i8fast','i8sparse','lut']}
+        res_df = bench_predict(base_fn, n_configs=args.n_configs, repeats=args.repeats, cold=not args.warm, settings=settings)
+    elif args.bench == 'tiled':
+        res_df = bench_tiled(base_fn, n_configs=args.n_configs, max_jobs=args.max_jobs, repeats=args.repeats, cold=not args.warm)
+    elif args.bench == 'sparse':
+        res_df = bench_sparse(base_fn, n_scores=args.n_scores, frac=args.frac, repeats=args.repeats, cold=not args.warm)
+    print(res_df.to_string(index=False))
+    return res_df
+
+if __name__ == '__main__':
+    main()
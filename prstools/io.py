@@ -2,7 +2,7 @@ import os, re, sys, time
 import scipy as sp
 import numpy as np
 import pandas as pd
-from scipy import linalg
+from scipy import linalg, stats
 from sys import getsizeof
 import warnings, importlib, json, os, glob, copy, uuid
 from collections import OrderedDict, deque, defaultdict
@@ -207,55 +207,141 @@ def get_diagnostics(df, verbose=True, allchecks=False):
         if verbose: print('All appears to be ok with input frame.')
         return None
 
-def get_liftoverpositions(df, *, bldout, bldin=None, sort=False, inplace=False, verbose=True, snpdb_df='mini'):
-    assert verbose, 'atm can only do liftovers verbose'
+_chain_dt = dict()
+def load_chain(fn, cache=True):
+    # Parse a UCSC chain file (plain or .gz) into per source-chromosome block arrays (0-based, half-open, sorted on start).
+    # Blocks from different chains that overlap on the source side are grouped in clusters, lift_positions() resolves those on score.
+    fn = os.path.expanduser(fn); key = (fn, os.path.getsize(fn), os.path.getmtime(fn))
+    if cache and key in _chain_dt: return _chain_dt[key]
+    import gzip
+    with (gzip.open(fn, 'rt') if fn.endswith('.gz') else open(fn, 'r')) as f: lines = f.read().split('\n')
+    heads = [i for i, line in enumerate(lines) if line.startswith('chain')] + [len(lines)]
+    assert len(heads) > 1, f'No chains found in chain file {fn}'
+    qnames = {}; blocks = defaultdict(list)
+    for i, j in zip(heads[:-1], heads[1:]):
+        score, tname, tsize, tstrand, tstart, tend, qname, qsize, qstrand, qstart, qend = lines[i].split()[1:12]
+        assert tstrand == '+', 'Chain files with source strand "-" are not supported.'
+        arr = np.array(' '.join(lines[i+1:j]).split(), dtype=np.int64); size = arr[0::3]
+        tst = int(tstart) + np.r_[0, np.cumsum(size[:-1] + arr[1::3])]
+        qst = int(qstart) + np.r_[0, np.cumsum(size[:-1] + arr[2::3])]
+        qcode = qnames.setdefault(qname, len(qnames)); n = len(size)
+        blocks[tname] += [(tst, tst+size, qst, np.full(n, qcode, dtype=np.int32), np.full(n, int(qsize)),
+                           np.full(n, qstrand == '-'), np.full(n, float(score)))]
+    chrom_dt = dict()
+    for tname, lst in blocks.items():
+        start, end, qstart, qchrom, qsize, qneg, score = [np.concatenate(x) for x in zip(*lst)]
+        srt = np.argsort(start, kind='stable')
+        dt = dict(start=start[srt], end=end[srt], qstart=qstart[srt], qchrom=qchrom[srt], qsize=qsize[srt], qneg=qneg[srt], score=score[srt])
+        dt['cmax'] = np.maximum.accumulate(dt['end']) # largest end up to each block, if a position is past it no block before it can hold it
+        newclust = np.r_[True, dt['start'][1:] >= dt['cmax'][:-1]]
+        dt['clust'] = np.cumsum(newclust) - 1; dt['clstart'] = np.flatnonzero(newclust)
+        dt['clsize'] = np.diff(np.r_[dt['clstart'], len(srt)])
+        chrom_dt[tname] = dt
+    chain_dt = dict(chroms=chrom_dt, qnames=np.array(list(qnames), dtype=object), fn=fn)
+    if cache: _chain_dt[key] = chain_dt
+    return chain_dt
+
+def lift_positions(chroms, pos, *, chain_dt):
+    # Vectorized liftover of 0-based positions on UCSC style chroms (e.g. 'chr1') with np.searchsorted, per source chromosome.
+    # Returns dict with arrays: chrom (index in chain_dt['qnames'], -1 if unmapped), pos (0-based, -1 if unmapped) and neg (minus strand).
+    # Where several chains overlap the highest scoring block is used, like the first result of pyliftover's convert_coordinate().
+    pos = np.asarray(pos, dtype=np.int64); n = len(pos)
+    codes, uniq = pd.factorize(pd.Series(chroms)) # a Categorical input is fast here
+    order = np.argsort(codes, kind='stable'); bounds = np.searchsorted(codes[order], np.arange(len(uniq)+1))
+    res = dict(chrom=np.full(n, -1, dtype=np.int32), pos=np.full(n, -1, dtype=np.int64), neg=np.zeros(n, dtype=bool))
+    for c, chrom in enumerate(uniq):
+        if not chrom in chain_dt['chroms']: continue
+        dt = chain_dt['chroms'][chrom]; idx = order[bounds[c]:bounds[c+1]]; p = pos[idx]
+        i = np.searchsorted(dt['start'], p, side='right') - 1
+        ok = i >= 0; ii = np.maximum(i, 0); cl = dt['clust'][ii]; single = dt['clsize'][cl] == 1
+        blk = np.where(ok & single & (p < dt['end'][ii]), ii, -1)
+        multi = ok & ~single & (p < dt['cmax'][ii])
+        for ccl in np.unique(cl[multi]): # Overlapping chains, these are rare so a small dense comparison per cluster is fine
+            rows = np.flatnonzero(multi & (cl == ccl)); bs = dt['clstart'][ccl] + np.arange(dt['clsize'][ccl])
+            inside = (dt['start'][bs] <= p[rows, None]) & (p[rows, None] < dt['end'][bs])
+            best = np.argmax(np.where(inside, dt['score'][bs], -np.inf), axis=1); found = inside.any(axis=1)
+            blk[rows[found]] = bs[best[found]]
+        hit = blk >= 0; idx = idx[hit]; b = blk[hit]
+        newpos = dt['qstart'][b] + (p[hit] - dt['start'][b]); neg = dt['qneg'][b]
+        res['pos'][idx] = np.where(neg, dt['qsize'][b] - 1 - newpos, newpos)
+        res['chrom'][idx] = dt['qchrom'][b]; res['neg'][idx] = neg
+    return res
+
+def _get_liftchroms(chroms):
+    # UCSC chrom names (e.g. 'chrX') to prstools chrom numbers, others (e.g. 'chr6_apd_hap1') become NA.
+    cmap = get_chrom_map()
+    cmap.update({'M':'26'})
+    chroms = pd.Series(chroms, dtype=object).str.replace("chr","").replace(cmap)
+    valid = set(cmap.values()) | set( map(str, range(1,23)))
+    chroms[~chroms.isin(valid)] = pd.NA
+    return pd.array(chroms, dtype='Int64')
+
+def get_liftoverpositions(df, *, bldout, bldin=None, sort=False, inplace=False, verbose=True, snpdb_df='mini', chain=None, engine='auto'):
+    # chain can be a chain file path or load_chain() output, if None hg{bldin}ToHg{bldout}.over.chain.gz is looked for in prstdatadir.
+    # engine='chain' lifts vectorized with lift_positions(), 'pyliftover' does it row-by-row with pyliftover (the reference).
     assert not inplace, 'cannot do inplace mod for this yet'
+    assert engine in ('auto','chain','pyliftover'), f'engine must be auto, chain or pyliftover, now: {engine}'
     if bldin is None:
         #assert snpdb_df is not None, 'need to implement get_snpdb funct.'
         if verbose: print('Input build not given so will detect it here.')
         bldin = get_build(df, snpdb_df=snpdb_df, verbose=verbose)
     ## https://genome.ucsc.edu/FAQ/FAQreleases.html#snpConversion UCSC says liftover should not be used for what everybody is using it for.
-    from pyliftover import LiftOver
     msg = 'Requiring chrom and pos columns to do position mapping from one genome build to another'
     assert all(col in df.columns for col in ['chrom','pos']), msg
-    data_dn = '/PHShome/mw1140/tge/data' # Not used ... :
-    fn = os.path.join(data_dn,f"/liftover/hg{int(bldin)}ToHg{int(bldout)}.over.chain.gz") # lo = LiftOver(fn)
+    if chain is None and engine != 'pyliftover':
+        fn = f"hg{int(bldin)}ToHg{int(bldout)}.over.chain.gz"
+        prstdatadir = prst.utils.load_config().get('prstdatadir', None)
+        if prstdatadir and os.path.isfile(os.path.join(prstdatadir, fn)): chain = os.path.join(prstdatadir, fn)
+        assert engine == 'auto' or chain is not None, f'engine=chain requires a chain file, none given and {fn} not found in prstdatadir.'
+    if engine == 'auto': engine = 'pyliftover' if chain is None else 'chain'
 
     ## The liftover:
     if bldin == bldout:
         print('Input build same as requested output build so no liftover needed. Returning same input.')
         return df
-    print('Doing liftover prep.. ', end='', flush=True)
-    df = df.copy(); lst = []; nancnt = 0
-    input_strings = (f'hg{bldin}', f'hg{bldout}')
-    lo = LiftOver(*input_strings) # IT seems this work all on its own
     cmapo = {v:k for k,v in prst.io.get_chrom_map().items() if k != 'MT'}
     cmapo.update({'26':'M'})
-    chroms = df['chrom'].astype(str).replace(cmapo)
-    poss = df['pos']-1
-    print('Casting to list to iterate over', flush=True)
-    liftlst = list(zip(chroms, poss))
-    lifted = [lo.convert_coordinate(f'chr'+c, p) for c, p in prst.utils.get_pbar(liftlst, colour='blue')]
-
-    ## Processing
-    print('Done lifting, now postprocessing results')
-    for i, lift in prst.utils.get_pbar(list(enumerate(lifted)), colour='yellow'):
-        if not lift is None:
-            try: res = lift[0]
-            except: res = (None,None,None,None); nancnt+=1
-        else: res = (None,None,None,None); nancnt+=1
-        lst += [res]
-    new_df = pd.DataFrame(lst, columns=['newchrom','newpos','strand','something']); df
+    if engine == 'chain':
+        if verbose: print('Doing liftover with chain file.. ', end='', flush=True)
+        chain_dt = load_chain(chain) if type(chain) is str else chain
+        codes, uniq = pd.factorize(df['chrom']) # string ops only on the unique chroms, for speed
+        chroms = pd.Categorical.from_codes(codes, categories=['chr'+c for c in pd.Series(uniq).astype(str).replace(cmapo)])
+        poss = pd.to_numeric(df['pos'], errors='coerce').astype('Int64') - 1
+        lifted = lift_positions(chroms, poss.fillna(-1).to_numpy(dtype=np.int64), chain_dt=chain_dt)
+        ind = lifted['chrom'] >= 0; nancnt = int((~ind).sum())
+        newpos = pd.array(np.where(ind, lifted['pos'], 0), dtype='Int64'); newpos[~ind] = pd.NA
+        strand = pd.Categorical.from_codes(np.where(ind, lifted['neg'].astype(np.int8), -1), categories=['+','-'])
+        newchrom = _get_liftchroms(np.r_[chain_dt['qnames'], [None]]).take(lifted['chrom']) # -1 -> the None at the end
+        new_df = pd.DataFrame(dict(newchrom=newchrom, newpos=newpos, strand=strand))
+        if verbose: print('-> Done')
+    else:
+        assert verbose, 'atm can only do pyliftover liftovers verbose'
+        from pyliftover import LiftOver
+        print('Doing liftover prep.. ', end='', flush=True)
+        lst = []; nancnt = 0
+        input_strings = (f'hg{bldin}', f'hg{bldout}')
+        lo = LiftOver(*input_strings) if chain is None else LiftOver(chain) # IT seems this work all on its own
+        chroms = df['chrom'].astype(str).replace(cmapo)
+        poss = df['pos']-1
+        print('Casting to list to iterate over', flush=True)
+        liftlst = list(zip(chroms, poss))
+        lifted = [lo.convert_coordinate(f'chr'+c, p) for c, p in prst.utils.get_pbar(liftlst, colour='blue')]
+
+        ## Processing
+        print('Done lifting, now postprocessing results')
+        for i, lift in prst.utils.get_pbar(list(enumerate(lifted)), colour='yellow'):
+            if not lift is None:
+                try: res = lift[0]
+                except: res = (None,None,None,None); nancnt+=1
+            else: res = (None,None,None,None); nancnt+=1
+            lst += [res]
+        new_df = pd.DataFrame(lst, columns=['newchrom','newpos','strand','something'])
+        new_df['newchrom'] = _get_liftchroms(new_df['newchrom'])
+    df = df.copy()
     df['oldpos'] = df['pos']; df['oldchrom'] = df['chrom']
     if 'strand' in df.columns: df['oldstrand'] = df['strand']
     df['pos'] = new_df['newpos'].astype('Int64').values +1 ### PLUS 1 !!!!!
     df['chrom'] = new_df['newchrom'].values
-    cmap = get_chrom_map()
-    cmap.update({'M':'26'})
-    df['chrom'] = df['chrom'].str.replace("chr","").replace(cmap)
-    valid = set(cmap.values()) | set( map(str, range(1,23)))
-    df.loc[~df['chrom'].isin(valid), 'chrom'] = pd.NA
-    df['chrom'] = df['chrom'].astype('Int64')
     df['strand'] = new_df['strand'].values
     perc = (nancnt/df.shape[0])*100
     if nancnt != 0 :
@@ -274,25 +360,124 @@ def get_snpdb(snpdb_df='mini', cache_vars=('mini',)):
     else: snpdb_df=load_snpdb(snpdb_df)
     return snpdb_df
 
-def get_build(df, *, snpdb_df='mini', nsmp = 10_000, avail_builds = [19,38], seed=42*42, verbose=True, on_fail='error'):
+def _hash_int64(x):
+    # splitmix64 finalizer, vectorized: well mixed uint64 hashes of integers.
+    z = np.asarray(x, dtype=np.int64).view(np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+def make_build_sketch(snpdb_df, *, max_size=2**16, avail_builds=[19,38]):
+    # Per build the sorted hashes of the snpdb cpnum positions with a hash below 2**(64-shift), so (about) a 2**-shift sample that the
+    # same positions of any sumstat hash into as well. shift is chosen for at most ~max_size positions per build.
+    # snpdb_df can also be a snpdb index (load_snpdb_index), then its sorted position keys are used.
+    if isinstance(snpdb_df, str): snpdb_df = load_snpdb(snpdb_df)
+    isindex = isinstance(snpdb_df, dict)
+    builds = [bld for bld in avail_builds if (f'cp{bld}' in snpdb_df if isindex else f'chrom{bld}' in snpdb_df.columns)]
+    n = snpdb_df['meta']['n'] if isindex else snpdb_df.shape[0]
+    shift = int(max(0, np.ceil(np.log2(max(n, 1)/max_size))))
+    sketch_dt = dict(shift=np.array(shift), builds=np.array(builds))
+    for bld in builds:
+        if isindex: cp = np.asarray(snpdb_df[f'cp{bld}']); cp = cp[np.r_[True, cp[1:] != cp[:-1]]] # Already sorted
+        else: cp = (snpdb_df[f'pos{bld}'] + snpdb_df[f'chrom{bld}']*int(1e10)).astype('Int64').dropna().unique().to_numpy(dtype=np.int64)
+        h = _hash_int64(cp); sketch_dt[f'hash{bld}'] = np.sort(h[h >> np.uint64(64 - shift) == 0] if shift else h)
+    return sketch_dt
+
+def _get_build_sketch_fn(name): return os.path.join(os.path.dirname(prst.__file__), 'data', 'defs', 'buildsketch', f'snpdb_{name}.buildsketch.npz')
+
+def get_build_sketch(snpdb_df='mini', verbose=False):
+    # The build sketch (make_build_sketch) for a snpdb: shipped in data/defs/buildsketch, else stored next to the snpdb (made once).
+    if isinstance(snpdb_df, pd.DataFrame): return make_build_sketch(snpdb_df)
+    if snpdb_df in ('mini','full') and os.path.isfile(_get_build_sketch_fn(snpdb_df)): return dict(np.load(_get_build_sketch_fn(snpdb_df)))
+    src_fn = _get_snpdb_fn(snpdb_df); fn = src_fn + '.buildsketch.npz'; key = _get_snpdb_fingerprint(src_fn)
+    if os.path.isfile(fn):
+        with np.load(fn) as npz:
+            if str(npz['key']) == key: return {k: npz[k] for k in npz.files if k != 'key'}
+    if verbose: print('Making build detection sketch', end=' ', flush=True)
+    index_dt = load_snpdb_index(src_fn, build=False)
+    sketch_dt = make_build_sketch(src_fn if index_dt is None else index_dt)
+    try: _save_build_sketch_npz(sketch_dt, fn, key=key)
+    except OSError as e: prst.warn(f'Could not store the build sketch ({e}), it will be made again next time.')
+    if verbose: print('-> Done', end=' ')
+    return sketch_dt
+
+def _save_build_sketch_npz(sketch_dt, fn, key=None):
+    def to_file(tmp_fn):
+        with open(tmp_fn, 'wb') as f: np.savez(f, **(dict(key=np.array(key)) if key is not None else {}), **sketch_dt)
+    _pd_to_atomizer(to_file=to_file, fn=fn)
+
+def save_build_sketch(snpdb_df='full', fn=None, verbose=True):
+    # The build step for the sketches shipped in data/defs/buildsketch (used by get_build_sketch for 'mini' & 'full', without a key since
+    # they go with the released snpdbs). They are not in git, run this for both before packaging a release, with the prstdatadir set:
+    #   python -c "import prstools as prst; prst.io.save_build_sketch('mini'); prst.io.save_build_sketch('full')"   (done in release.sh)
+    # Without the shipped file the sketch is made once on first use & stored next to the snpdb, so build detection works either way.
+    if fn is None:
+        assert snpdb_df in ('mini','full'), 'Only the mini & full snpdb sketches are shipped, for others give fn (or use get_build_sketch).'
+        fn = _get_build_sketch_fn(snpdb_df); os.makedirs(os.path.dirname(fn), exist_ok=True)
+    if verbose: print(f'Making build detection sketch for {snpdb_df if isinstance(snpdb_df, str) else "snpdb"}', end=' ', flush=True)
+    index_dt = load_snpdb_index(_get_snpdb_fn(snpdb_df), build=False) if isinstance(snpdb_df, str) else None
+    sketch_dt = make_build_sketch(snpdb_df if index_dt is None else index_dt)
+    _save_build_sketch_npz(sketch_dt, fn)
+    if verbose: print(f'-> Saved to {fn}')
+    return fn
+
+def get_build_sketched(df, *, sketch_dt, min_frac=0.7):
+    # Build call from the sketch: the hashed sample of the sumstat positions is looked up in each build its sketch. Returns the build, a
+    # confidence (1 - binomial p-value of the best build its matches vs the runner-up) & stats. The confidence is 0 if the best build has both
+    # frac (matched share of the sampled sumstat positions) & cover (matched share of its sketch) < min_frac, so sub- & supersets of the snpdb pass.
+    cp = np.asarray(df['pos'], dtype=np.float64) + np.asarray(df['chrom'], dtype=np.float64)*1e10 # exact in float64 (<2**53)
+    h = _hash_int64(cp[~np.isnan(cp)].astype(np.int64)); shift = int(sketch_dt['shift'])
+    h = np.unique(h[h >> np.uint64(64 - shift) == 0] if shift else h) # Only the sampled ones are deduplicated
+    stats_dt = {}
+    for bld in sketch_dt['builds']:
+        sk = sketch_dt[f'hash{bld}']; pos = np.minimum(np.searchsorted(sk, h), max(len(sk) - 1, 0))
+        mcnt = int((sk[pos] == h).sum()) if len(sk) else 0
+        stats_dt[int(bld)] = dict(mcnt=mcnt, cover=mcnt/max(len(sk), 1), frac=mcnt/max(len(h), 1))
+    ranked = sorted(stats_dt, key=lambda bld: -stats_dt[bld]['mcnt'])
+    m1 = stats_dt[ranked[0]]['mcnt']; m2 = stats_dt[ranked[1]]['mcnt'] if len(ranked) > 1 else 0
+    conf = 1. - stats.binom.sf(m1 - 1, m1 + m2, 0.5) if m1 > 0 else 0.
+    if max(stats_dt[ranked[0]]['frac'], stats_dt[ranked[0]]['cover']) < min_frac: conf = 0.
+    return ranked[0], conf, dict(n_sampled=len(h), **{f'hg{bld}': item for bld, item in stats_dt.items()})
+
+def get_build(df, *, snpdb_df='mini', nsmp = 10_000, avail_builds = [19,38], seed=42*42, verbose=True, on_fail='error', method='auto', min_conf=0.999, return_conf=False):
+    # method='auto' first tries the precomputed per-build position sketches (get_build_sketched), only if that call has a confidence
+    # below min_conf it falls back to the sampled snpdb lookup (method='sample'). With return_conf (build, confidence) is returned.
     assert snpdb_df is not None, 'No snps database present for build detection! (snpdb_df argument inside of python)'
     msg = 'Columns chrom & pos have to be present for genome build detection (and also for adding rsids)'
     assert all(col in df.columns for col in ['chrom','pos']), msg
+    assert method in ('auto','sketch','sample'), f'method={method} not recognized, options are auto, sketch & sample.'
+    nosketch = type(snpdb_df) is str and snpdb_df in ('full','mini') and not prst.utils.load_config().get('prstdatadir', None) \
+        and not os.path.isfile(_get_build_sketch_fn(snpdb_df)) # Then the prstdatadir error below is given
+    if method != 'sample' and not nosketch:
+        sketch_dt = get_build_sketch(snpdb_df, verbose=verbose)
+        bld, conf, sstats_dt = get_build_sketched(df, sketch_dt=sketch_dt)
+        if verbose: print('Build sketch: ' + ', '.join(f"{b} {item['frac']*100:5.2f}% matched ({item['cover']*100:5.2f}% of sketch)" for b, item in sstats_dt.items() if b != 'n_sampled') + 
+                          f" ({sstats_dt['n_sampled']:,} sampled variants), confidence={conf:.4f}")
+        if conf >= min_conf or method == 'sketch':
+            if conf < min_conf: 
+                msg = f'Build Detection Failed: the sketch based build call has a low confidence ({conf:.4f}<{min_conf}).'
+                if on_fail == 'error': raise Exception(msg)
+                elif on_fail == 'warn': warnings.warn(msg); bld = None
+                else: raise ValueError(f'Option on_fail = {on_fail} not recognized')
+            if verbose and bld: print(f'Detected build is hg{bld}!')
+            return (bld, conf) if return_conf else bld
+        if verbose: print('Build sketch is not conclusive, falling back to the snpdb lookup.')
     if type(snpdb_df) is str:
         if snpdb_df in ('full','mini'):
             msg = 'Trying to infer genome build, but prstdatadir is not set, which is required for this functionality. '
             msg += 'Please run "prst config" to set it.'; prstcfg = prst.utils.load_config()
             if not prstcfg.get('prstdatadir', None): raise RuntimeError(msg)
-        snpdb_df = get_snpdb(snpdb_df); 
+        index_dt = load_snpdb_index(snpdb_df, build='auto', verbose=verbose) # Only the sampled rows are read
+        snpdb_df = get_snpdb(snpdb_df) if index_dt is None else index_dt
     pin=df.shape[0]; assert pin>5, 'input snp file too small! less than 5 rows!'
-    dbcnt = snpdb_df.shape[0]
+    dbcnt = snpdb_df.shape[0] if isinstance(snpdb_df, pd.DataFrame) else snpdb_df['meta']['n']
     dbfrac = nsmp/dbcnt
 
     # Sub-sample database to make things faster
     np.random.seed(seed)
-    if dbfrac < 0.1: idx=np.unique(np.random.randint(0,snpdb_df.shape[0],nsmp)); nsmp=len(idx)
-    else: idx = np.sort(np.random.permutation(np.arange(0,snpdb_df.shape[0]))[:nsmp])
-    dbsmp_df = snpdb_df.iloc[idx]
+    if dbfrac < 0.1: idx=np.unique(np.random.randint(0,dbcnt,nsmp)); nsmp=len(idx)
+    else: idx = np.sort(np.random.permutation(np.arange(0,dbcnt))[:nsmp])
+    dbsmp_df = snpdb_df.iloc[idx] if isinstance(snpdb_df, pd.DataFrame) else take_snpdb_index(snpdb_df, idx)
     uchroms = df['chrom'].unique();
     if len(uchroms) < 20:
         msg=('It seems you are inputing fewer then 20 unique chromosomes into genome build detection. '
@@ -331,36 +516,71 @@ def get_build(df, *, snpdb_df='mini', nsmp = 10_000, avail_builds = [19,38], see
         else: raise ValueError(f'Option on_fail = {on_fail} not recognized')
         maxbld = None
     if verbose and maxbld: print(f'Detected build is hg{maxbld}!')
-    return maxbld
+    return (maxbld, None) if return_conf else maxbld
 
-def get_rsids(df, *, snpdb_df='full', bld='detect', verbose=True, inplace=False, bldsnpdb_df='mini'):
+def get_rsids(df, *, snpdb_df='full', bld='detect', verbose=True, inplace=False, bldsnpdb_df='mini', use_index='auto'):
+    # With a snpdb name/path the memory mapped snpdb index is used for the lookups (see load_snpdb_index), if use_index allows it.
     assert snpdb_df is not None, 'No snps database present! (snpdb_df argument inside of python)'
     if verbose: print('Retrieving rsids for input based on genomic position..')
-    if type(snpdb_df) is str: snpdb_df = get_snpdb(snpdb_df);
+    index_dt = load_snpdb_index(snpdb_df, build=use_index, verbose=verbose) if type(snpdb_df) is str and use_index else None
+    if type(snpdb_df) is str and index_dt is None: snpdb_df = get_snpdb(snpdb_df);
     if bld == 'detect':
         bld=get_build(df, verbose=verbose, snpdb_df=bldsnpdb_df)
     else: 
         if verbose: print(f'Build is set to be hg{bld}')
-    if verbose: print('Merging.. ',end='')
     a = df.rename(columns=dict(snp='oldsnp', aranndomxtest='randotest'))
+    get_cpnum(a)
+    if index_dt is not None:
+        if verbose: print('Looking up in snpdb index.. ',end='')
+        qidx, rows = lookup_snpdb_index(index_dt, a['cpnum'], bld)
+        columns = [col for col in index_dt['meta']['columns'] if not col in (f'chrom{bld}', f'pos{bld}')]
+        mrg = pd.concat([a.iloc[qidx].reset_index(drop=True), take_snpdb_index(index_dt, rows, columns=columns)], axis=1)
+        mcnt = (~mrg['snp'].isna()).sum()
+        if verbose: print(f'-> Added rsids to the input ({mcnt:,} rsids covering {(mcnt/mrg.shape[0])*100:.2f}% of total input rows)')
+        return mrg
+    if verbose: print('Merging.. ',end='')
     b = snpdb_df.rename(columns={f'chrom{bld}': 'chrom', f'pos{bld}':'pos'})
-    get_cpnum(a); get_cpnum(b)
+    get_cpnum(b)
     mrg = pd.merge(a, b.drop(['chrom','pos'], axis=1), on='cpnum', how='left', suffixes=('','_right')) # double as fast as the next example line:
     #mrg = pd.merge(df.rename(columns=dict(snp='oldsnp', whoooeg=345)),smp_df.rename(columns={f'chrom{bld}': 'chrom', f'pos{bld}':'pos'}), on=['chrom','pos'], how=how)
     mcnt = (~mrg['snp'].isna()).sum()
     if verbose: print(f'-> Added rsids to the input ({mcnt:,} rsids covering {(mcnt/mrg.shape[0])*100:.2f}% of total input rows)')
     return mrg
 
+_snv_codes = dict(A=0, C=1, G=2, T=3) # 3-code is the strand complement. Case sensitive, as alleles always were compared.
+_complements = dict(A='T', C='G', G='C', T='A')
+
+def get_allele_codes(alleles):
+    # int64 allele codes: 0-3 for A/C/G/T (so 3-code is the complementary base), a 31 bit hash (>=4) for other alleles (e.g. indels), -1 if missing.
+    # Only the distinct alleles are looked at, so this is cheap also for tens of millions of rows.
+    codes, uniq = pd.factorize(pd.Series(alleles) if not isinstance(alleles, (pd.Series, pd.Index)) else alleles)
+    uniq = np.asarray(uniq, dtype=object)
+    ucodes = np.array([_snv_codes.get(a, -1) for a in uniq], dtype=np.int64)
+    other = ucodes < 0
+    if other.any(): ucodes[other] = 4 + (pd.util.hash_array(uniq[other].astype(str)) % np.uint64(2**31 - 4)).astype(np.int64)
+    return np.where(codes < 0, -1, ucodes[np.maximum(codes, 0)]) if len(ucodes) else np.full(len(codes), -1, dtype=np.int64)
+
+def get_allele_match(a1, a2, b1, b2, strand=False):
+    # Boolean arrays for same alleles (ind_match) & swapped alleles (ind_flip) of a1/a2 vs b1/b2. The alleles are compared exactly, as
+    # strings (through one joint factorization), with strand=True also on the complementary strand (A/C/G/T). Missing alleles match nothing.
+    lst = [elem.reset_index(drop=True) if isinstance(elem, pd.Series) else pd.Series(np.asarray(elem, dtype=object)) for elem in [a1, a2, b1, b2]]
+    codes, uniq = pd.factorize(pd.concat(lst, ignore_index=True))
+    a1, a2, b1, b2 = np.split(codes, np.cumsum([len(elem) for elem in lst])[:-1])
+    ok = (a1 >= 0) & (a2 >= 0)
+    ind_match = ok & (a1 == b1) & (a2 == b2); ind_flip = ok & (a1 == b2) & (a2 == b1)
+    if strand: # The code of the complementary base (-2 if none, the last entry is for missing)
+        idx_dt = {allele: i for i, allele in enumerate(uniq)}
+        comp = np.array([idx_dt.get(_complements.get(allele), -2) for allele in uniq] + [-2], dtype=np.int64)
+        ind_match |= ok & (a1 == comp[b1]) & (a2 == comp[b2]); ind_flip |= ok & (a1 == comp[b2]) & (a2 == comp[b1])
+    return ind_match, ind_flip
+
 def get_AX(df, opt=1, redo=False):
+    # AX: the unordered allele pair as one int64 code (the same for swapped A1/A2), -1 if an allele is missing.
     df = validate_dataframe_index(df)
     assert all(A in df.columns for A in ['A1','A2']), 'A1 and/or A2 columns are missing, these are required here.'
-    if 'AX' in df and not redo: return df # Dont redo AX if alredy done
-    vara = (df['A1'] + '_') + df['A2'] # 35%
-    varb = (df['A2'] + '_') + df['A1'] # 35%
-    ind = df['A1'] <= df['A2']
-    df['AX'] = varb
-    df.loc[ind,'AX'] = vara[ind].values #(takes 25%)
-    #df['AX'][ind] = vara #(takes 18%, but give annoying warnings
+    if 'AX' in df and not redo and pd.api.types.is_integer_dtype(df['AX']): return df # Dont redo AX if alredy done (an old string AX is redone)
+    c1 = get_allele_codes(df['A1']); c2 = get_allele_codes(df['A2'])
+    df['AX'] = np.where((c1 < 0) | (c2 < 0), -1, (np.minimum(c1, c2) << 31) | np.maximum(c1, c2))
     return df
 
 def get_chrom_and_pos(df, bld=19, snpdb_df='full', redo=False):
@@ -387,7 +607,9 @@ def get_chromposAX(df, inplace=True, redo=False):
     if 'chromposAX' in df and not redo: return df
     get_AX(df)
     get_chrompos(df)
-    df['chromposAX']=df['chrompos']+'_'+df['AX']
+    vara = (df['A1'] + '_') + df['A2']; varb = (df['A2'] + '_') + df['A1'] # The alphabetically ordered allele pair, e.g. 1_12345_A_G
+    ind = np.asarray((df['A1'] <= df['A2']).fillna(False), dtype=bool)
+    df['chromposAX']=df['chrompos']+'_'+varb.where(~ind, vara)
     return df
 
 def get_cpnum(df, inplace=True):
@@ -400,6 +622,32 @@ def get_rsnum(df, inplace=True):
     df.loc[ind,'rsnum'] = df.loc[ind,'snp'].str[2:].astype('Int64')
     return df
 
+def get_intervalidx(chrom, pos, *, ichrom, start, stop, overlap='last'):
+    # For each chrom & pos the (positional) index of the interval [start, stop) on ichrom holding it, -1 if none (i.e. a gap).
+    # Per chrom intervals are cut into elementary segments between all start & stop boundaries and positions found with np.searchsorted.
+    # If intervals overlap the last one (in input order) wins with overlap='last', as get_regid() always did, or the first with overlap='first'.
+    assert overlap in ('last','first'), f'overlap must be last or first, now: {overlap}'
+    chrom = pd.Series(chrom).reset_index(drop=True); ichrom = pd.Series(ichrom).reset_index(drop=True)
+    if not pd.api.types.is_numeric_dtype(chrom): ichrom = ichrom.astype(str) # e.g. '1' in chrom should match 1 in ichrom
+    pos = pd.to_numeric(pd.Series(pos), errors='coerce').to_numpy(dtype=float, na_value=np.nan) # NA -> nan, ends up past the last boundary
+    start = np.asarray(start, dtype=float); stop = np.asarray(stop, dtype=float)
+    codes, uniq = pd.factorize(pd.concat([chrom, ichrom], ignore_index=True))
+    codes, icodes = codes[:len(chrom)], codes[len(chrom):]
+    order = np.argsort(codes, kind='stable'); bounds = np.searchsorted(codes[order], np.arange(len(uniq)+1))
+    res = np.full(len(chrom), -1, dtype=np.int64)
+    for c in np.unique(icodes[icodes >= 0]):
+        iidx = np.flatnonzero((icodes == c) & (stop > start)); idx = order[bounds[c]:bounds[c+1]] # empty (or inverted) intervals hold nothing
+        if len(idx) == 0 or len(iidx) == 0: continue
+        bnds = np.unique(np.r_[start[iidx], stop[iidx]]); owner = np.full(len(bnds), -1, dtype=np.int64) # last one is past all intervals
+        lo = np.searchsorted(bnds, start[iidx]); hi = np.searchsorted(bnds, stop[iidx])
+        srt = np.argsort(start[iidx], kind='stable')
+        if (start[iidx][srt][1:] >= stop[iidx][srt][:-1]).all(): owner[lo[hi > lo]] = iidx[hi > lo] # No overlaps: one segment per interval
+        else: # Overlaps: paint the segments interval by interval, so the one painted last wins
+            for k in (range(len(iidx)) if overlap == 'last' else range(len(iidx))[::-1]): owner[lo[k]:hi[k]] = iidx[k]
+        seg = np.searchsorted(bnds, pos[idx], side='right') - 1
+        res[idx] = np.where(seg >= 0, owner[np.maximum(seg, 0)], -1)
+    return res
+
 def get_regid(prst_df, regdef=None, fixchromends=True):
     prst_df = validate_dataframe_index(prst_df)
     if regdef is None: regdef_df = load_regdef()
@@ -408,18 +656,14 @@ def get_regid(prst_df, regdef=None, fixchromends=True):
     else: raise TypeError(f'type={type(regdef)} not recognized. Type needs to be string or dataframe.')
     prst_df = validate_dataframe_index(prst_df)
     # regdef_df = validate_regdef_df(regdef_df)
-    # Loop through chromosomes
-    for chrom, cur_df in prst_df.groupby('chrom'):
-        cdef_df = regdef_df[regdef_df.chrom.astype(type(chrom))==chrom].copy()
-        if cdef_df.empty: continue # Jump to next if it is empty
-        # Iterate over regions and assign regid
-        if fixchromends: ## since regdef is asserted to be sorted the following is ok
-            cdef_df.loc[cdef_df.index[0], 'start'] = 0 #=ok, see 1 line above
-            cdef_df.loc[cdef_df.index[-1], 'stop'] = 1e12
-        for _, row in cdef_df.iterrows():
-            mask = (cur_df['pos'] >= row['start']) & (cur_df['pos'] < row['stop'])
-            idx = mask.index[mask].to_numpy()
-            prst_df.loc[idx, 'regid'] = int(row['regid'])
+    start = regdef_df['start'].to_numpy(dtype=float); stop = regdef_df['stop'].to_numpy(dtype=float)
+    if fixchromends: ## since regdef is asserted to be sorted the first and last region of each chrom are at the ends
+        start[~regdef_df['chrom'].duplicated(keep='first').to_numpy()] = 0
+        stop[~regdef_df['chrom'].duplicated(keep='last').to_numpy()] = 1e12
+    idx = get_intervalidx(prst_df['chrom'], prst_df['pos'], ichrom=regdef_df['chrom'], start=start, stop=stop)
+    regids = regdef_df['regid']
+    regids = regids.to_numpy(dtype=float) if pd.api.types.is_numeric_dtype(regids) else regids.to_numpy(dtype=object)
+    prst_df['regid'] = np.where(idx >= 0, regids[idx], np.nan)
     indnans = prst_df['regid'].isna(); nansum = indnans.sum()
     if nansum > 0: 
         perc = (nansum/len(indnans))*100
@@ -590,15 +834,21 @@ def get_chrom_map(flow='in', version='onlyonenow'):
 def merge_snps(df0, df1, *, flipcols, afcols=[], how='left', on=['snp','AX'], reset_index=True, extradropdupcols=False, dropalldupcols=False,
                dropduprightcols=['chrom','snp','cm','pos','A1','A2','maf_ref','std_ref','af_A1_ref','AX'], warndupcol=True, removedups=True,
                seperate=False, handle_missing=False, allow_right_filter=True,
-               req_all_right=None # or all entries in the right dataframe being matchable to left 
-              ):
+               req_all_right=None, # or all entries in the right dataframe being matchable to left 
+               engine='pandas' # 'pandas' uses pd.merge (the reference), 'index' joins on exact int64 variant codes (join_snps), 'auto' the index
+              ):                   # engine where it gives the same frame (single level columns, removedups, AX in on) and pd.merge otherwise
     ## Checks & Validation:
     if req_all_right is None: # (e.g in the case of allele_weight 's which cannot just be dropped')
         req_all_right = True if 'allele_weight' in ([*df0.columns] + [*df1.columns]) else False
     if extradropdupcols: dropduprightcols = list(set(dropduprightcols + extradropdupcols))
 
+    assert engine in ('auto','index','pandas'), f'engine={engine} not recognized, options are auto, index & pandas.'
+    indexable = df0.columns.nlevels == 1 and df1.columns.nlevels == 1 and removedups and 'AX' in on and not 'cpnum' in on # With AX in on duplicated
+    if engine == 'index': assert indexable, 'engine=index needs single level columns, removedups=True, AX in on and no cpnum.' # right variants align alike, the first stays
+    use_index = engine != 'pandas' and indexable
+
     ## THE SPOT WHERE I SHOULD TRY AGGRESSIVE FILTERING OF RIGHT FOR MERGE SPEEDUPS
-    if allow_right_filter:
+    if allow_right_filter and not use_index: # The index engine only looks up the left variants anyway
         if df0.shape[0] < df1.shape[0]*0.5 and req_all_right is False and 'snp' in on:
             #empirical relatation, if right is more than 2times as large, slicing makes sense:
             ind = df1['snp'].isin(df0['snp']); df1 = df1[ind].reset_index(drop=True)
@@ -609,7 +859,7 @@ def merge_snps(df0, df1, *, flipcols, afcols=[], how='left', on=['snp','AX'], re
 
     if 'AX' in on:
         if not 'AX' in df0.columns: df0 = get_AX(df0)
-        if not 'AX' in df1.columns: df1 = get_AX(df1)
+        if not 'AX' in df1.columns and not use_index: df1 = get_AX(df1) # Not needed in the output, the index engine hashes it directly
     suffixes = ('','_right')
     if type(on) is str: on = [on]
     assert type(on) is list
@@ -629,9 +879,17 @@ def merge_snps(df0, df1, *, flipcols, afcols=[], how='left', on=['snp','AX'], re
         ' can be used to handle this differently. One should not see this message inside of the prstools cli, if you do contact dev.')
 
     ## Merging:
-    df0, df1 = prst.io.validate_dataframes_premerge(df0.copy(),df1.copy())
-    with warnings.catch_warnings(record=True): # Suppress annyoing warnings for multiindex case.
-        mrg_df = pd.merge(df0, df1, on=on, how=how, suffixes=suffixes)
+    n_rdups = 0
+    if use_index: # Same frame as pd.merge, apart from the extra rows for duplicated right variants (counted)
+        join_dt = join_snps(df0, df1, on=on)
+        n_rdups = int((join_dt['n_right'] - 1).sum())
+        right_df = df1.drop(columns=on, errors='ignore').rename(columns=lambda col: col + suffixes[1] if col in df0.columns else col)
+        ridx = np.full(df0.shape[0], -1, dtype=np.int64); ridx[join_dt['lidx']] = join_dt['ridx']
+        mrg_df = pd.concat([df0.reset_index(drop=True), right_df.reindex(ridx).reset_index(drop=True)], axis=1) # -1: NaN rows as in pd.merge
+    else:
+        df0, df1 = prst.io.validate_dataframes_premerge(df0.copy(),df1.copy())
+        with warnings.catch_warnings(record=True): # Suppress annyoing warnings for multiindex case.
+            mrg_df = pd.merge(df0, df1, on=on, how=how, suffixes=suffixes)
     indnans = mrg_df['A1_right'].isna()
     n_missing_right = indnans.sum()
     if not handle_missing: assert n_missing_right == 0, ('Not all variants can be matched.'+handlenotclimsg)
@@ -649,6 +907,7 @@ def merge_snps(df0, df1, *, flipcols, afcols=[], how='left', on=['snp','AX'], re
         if cnts[0] != df1.shape[0]: issues=True
         if issues:
             # Create sets of key tuples from df1 and from the merged df.
+            if 'AX' in on and not 'AX' in df1.columns: df1 = get_AX(df1)
             df1_keys = set(df1[on].itertuples(index=False, name=None))
             merged_keys = set(mrg_df[on].dropna().itertuples(index=False, name=None))
             missing_keys = list(df1_keys - merged_keys)
@@ -658,23 +917,22 @@ def merge_snps(df0, df1, *, flipcols, afcols=[], how='left', on=['snp','AX'], re
                 '(typically not a good thing to do) set req_all_right=False ' if req_all_right else ''
                 raise ValueError(f"Not all SNPs from df1 were matched. Missing keys (n={n_miss}): {missing_keys[:5]}.. ")
 
-    #ind_match = (mrg_df['A1'] == mrg_df['A1_right']).fillna(True) & (mrg_df['A2'] == mrg_df['A2_right']).fillna(True)
-    #ind_flip  = (mrg_df['A1'] == mrg_df['A2_right']).fillna(True) & (mrg_df['A2'] == mrg_df['A1_right']).fillna(True)
-    ind_match = (mrg_df['A1'] == mrg_df['A1_right']) & (mrg_df['A2'] == mrg_df['A2_right'])
-    ind_flip  = (mrg_df['A1'] == mrg_df['A2_right']) & (mrg_df['A2'] == mrg_df['A1_right'])
-    ind_wrong = ~ind_match & ~ind_flip
+    # Allele alignment (exact allele comparison), rows without a right variant (handle_missing='keep') get a NaN rflip
+    indright = ~np.asarray(mrg_df['A1_right'].isna(), dtype=bool)
+    ind_match, ind_flip = get_allele_match(*(mrg_df[col] for col in ['A1','A2','A1_right','A2_right']))
+    ind_wrong = ~ind_match & ~ind_flip & indright
     if ind_wrong.sum() != 0:
         cnt = ind_wrong.sum()
         msg = (f'Probable tri-allelic snps detected (n={cnt}) and handled appropriately.')
         if handle_missing=='filter': 
             warnings.warn(msg)
             mrg_df = mrg_df[~ind_wrong]
-            ind_match=ind_match[~ind_wrong]; ind_flip=ind_flip[~ind_wrong]
+            ind_match=ind_match[~ind_wrong]; ind_flip=ind_flip[~ind_wrong]; indright=indright[~ind_wrong]
         else: raise Exception('with handle_mssing=filter, this can be fixed.' + handlenotclimsg)
 
     ## Flipping:
     cast='float64' #cast='int64[pyarrow]' # used to be int(), but now better a type with nans like float 
-    mrg_df['rflip'] = -1*ind_flip.astype(cast) + 1*ind_match.astype(cast)
+    mrg_df['rflip'] = np.where(indright, 1*ind_match.astype(cast) - 1*ind_flip.astype(cast), np.nan)
     indfunny = mrg_df['rflip'] == 0 #).sum() ==0, 'regerergre'
     assert indfunny.sum() == 0, 'snp alignment issue, that should not happen, please contact dev if it does.'
     #mrg_df.loc[mrg_df['rflip'] == 0, 'rflip'] = 15
@@ -705,12 +963,12 @@ def merge_snps(df0, df1, *, flipcols, afcols=[], how='left', on=['snp','AX'], re
         warnings.warn(f'Columns present in right/2nd input that are also present in the first.'
                       f'\nThe duplicate columns are: {duplicate_columns}, (remove the {suffixes[1]} suffix)')
 
-    if mrg_df.shape[0] != mrg_df[on[0]].nunique():
+    if mrg_df.shape[0] != mrg_df[on[0]].nunique() or n_rdups:
         onhack = mrg_df[on].columns # ohh pandas sometimes, you remind of actual pandas...
         new_df = mrg_df.drop_duplicates(subset=onhack, keep='first')
         #ip.embed()
-        if new_df.shape[0] < mrg_df.shape[0]:
-            n_dups = mrg_df.shape[0] - new_df.shape[0]
+        if new_df.shape[0] < mrg_df.shape[0] or n_rdups:
+            n_dups = mrg_df.shape[0] - new_df.shape[0] + n_rdups
             inject = ' but not removed '
             if removedups: mrg_df = new_df; inject=' and removed '
             warnings.warn(f'Duplicates detected{inject}in sumstat n_dups={n_dups}.')
@@ -719,6 +977,107 @@ def merge_snps(df0, df1, *, flipcols, afcols=[], how='left', on=['snp','AX'], re
     if seperate: raise NotImplementedError()
     else: return mrg_df
 
+def _get_AX_codes(df):
+    if 'AX' in df.columns and pd.api.types.is_integer_dtype(df['AX']): return np.asarray(df['AX'], dtype=np.int64)
+    return get_AX(pd.DataFrame(dict(A1=np.asarray(df['A1']), A2=np.asarray(df['A2']))))['AX'].to_numpy()
+
+def get_varhash(df, on=['snp','AX']):
+    # int64 hash per variant of the merge key columns (by default snp id & unordered allele pair, as in merge_snps()).
+    key_dt = {col: np.asarray(df[col]) for col in on if col != 'AX'} # arrays, so this also works for multiindex columns
+    if 'AX' in on: key_dt['AX'] = _get_AX_codes(df)
+    return pd.util.hash_pandas_object(pd.DataFrame(key_dt), index=False).to_numpy().view(np.int64)
+
+def _get_codes(left, right):
+    # Codes for left values (factorized) & right values in those (len(uniq) when absent, these cannot match anyway). NaN gets its own code, as in pd.merge().
+    codes0, uniq = pd.factorize(left, use_na_sentinel=False)
+    try: # A hash table of the (typically smaller) left side only, probed with arrow
+        import pyarrow as pa, pyarrow.compute as pc
+        rarr = pa.array(right, from_pandas=True); value_set = pa.array(uniq, from_pandas=True).cast(rarr.type)
+        codes1 = pc.index_in(rarr, value_set=value_set, skip_nulls=False).fill_null(len(uniq)).to_numpy(zero_copy_only=False)
+    except Exception:
+        codes1 = pd.Index(uniq).get_indexer(right); codes1[codes1 < 0] = len(uniq)
+    return codes0.astype(np.int64), codes1.astype(np.int64), len(uniq) + 1
+
+def get_varcodes(df0, df1, *, on=['snp','AX']):
+    # Exact int64 variant keys for two frames, equal where their on columns are ('AX': the allele pair code of get_AX) & not present in df0 otherwise.
+    # Column codes are packed mixed-radix, and refactorized in the rare case that would overflow int64.
+    keys0 = np.zeros(df0.shape[0], dtype=np.int64); keys1 = np.zeros(df1.shape[0], dtype=np.int64); radix = 1
+    for col in on:
+        if col == 'AX': codes0, codes1, k = _get_codes(_get_AX_codes(df0), _get_AX_codes(df1))
+        else: codes0, codes1, k = _get_codes(df0[col], df1[col])
+        if radix*k >= 2**62:
+            codes, uniq = pd.factorize(np.r_[keys0, keys1]); radix = len(uniq)
+            keys0 = codes[:len(keys0)].astype(np.int64); keys1 = codes[len(keys0):].astype(np.int64)
+        keys0 = keys0*k + codes0; keys1 = keys1*k + codes1; radix = radix*k
+    return keys0, keys1
+
+def join_snps(df0, df1, *, on=['snp','AX']):
+    # Integer join engine: the left rows (lidx) that have a variant in df1 with the first matching right row (ridx), the number of right rows
+    # with that variant (n_right) & rflip (+1 same A1, -1 swapped alleles). Keys are exact int64 codes (get_varcodes) matched by np.searchsorted.
+    k0, k1 = get_varcodes(df0, df1, on=on)
+    order = np.argsort(k1, kind='stable'); skey = k1[order]
+    first = np.flatnonzero(np.r_[True, skey[1:] != skey[:-1]]) if len(skey) else np.zeros(0, dtype=np.int64)
+    n_right = np.diff(np.r_[first, len(skey)]); ukey = skey[first]
+    pos = np.minimum(np.searchsorted(ukey, k0), max(len(ukey) - 1, 0))
+    lidx = np.flatnonzero(ukey[pos] == k0) if len(ukey) else np.zeros(0, dtype=np.int64); pos = pos[lidx]
+    ridx = order[first[pos]]
+    ind_match, ind_flip = get_allele_match(*(df[col].iloc[idx] for df, idx in [(df0, lidx), (df1, ridx)] for col in ['A1','A2']))
+    return dict(lidx=lidx, ridx=ridx, n_right=n_right[pos], rflip=(ind_match.astype(np.int8) - ind_flip))
+
+def make_hash_index(hashes):
+    # Sorted hashes & their original positions, first occurence is kept for duplicates. Lookups are then O(log n) each.
+    order = np.argsort(hashes, kind='stable'); shash = hashes[order]
+    first = np.r_[True, shash[1:] != shash[:-1]]
+    dtype = np.int32 if len(hashes) < 2**31 else np.int64
+    return dict(hash=shash[first], idx=order[first].astype(dtype))
+
+def lookup_hash_index(index_dt, hashes):
+    # Positions for the given hashes in the indexed frame, -1 where absent.
+    if len(index_dt['hash']) == 0: return np.full(len(hashes), -1, dtype=np.int64)
+    pos = np.minimum(np.searchsorted(index_dt['hash'], hashes), len(index_dt['hash']) - 1)
+    return np.where(index_dt['hash'][pos] == hashes, index_dt['idx'][pos], -1).astype(np.int64)
+
+def _get_varindex_key(bed, rsidmode):
+    location = str(bed.location); lst = [location, location[:-4] + '.bim']
+    stats = [f'{os.stat(fn).st_size}_{os.stat(fn).st_mtime_ns}' for fn in lst if os.path.isfile(fn)]
+    return f"{'_'.join(stats)}_{bed.sid_count}_{rsidmode}_ax3" # ax3: integer AX codes (get_AX), case sensitive
+
+def load_varindex(bed, *, rsidmode='auto', fn=None, save=False, min_save=100_000, verbose=False):
+    # Hashed index of the target variants (snp id & unordered alleles), built from the rsid-validated bim. A stored index
+    # (<target>.prstvaridx.npz, 12 bytes/variant) is used if present and the target is unchanged, otherwise it is rebuilt.
+    # Storing is opt-in: save=True, or save='auto' for targets with min_save or more variants. Write failures only warn.
+    location = str(bed.location)
+    fn = (location[:-4] if location.endswith('.bed') else location) + '.prstvaridx.npz' if fn is None else fn
+    key = _get_varindex_key(bed, rsidmode)
+    if os.path.isfile(fn):
+        with np.load(fn) as npz:
+            if str(npz['key']) == key: 
+                if verbose: print(f'Using target variant index: {fn}', end=' ')
+                return dict(hash=npz['hash'], idx=npz['idx'])
+    if verbose: print(f'Building target variant index', end=' ', flush=True)
+    bim_df = validate_dataframe_rsids(bed.bim_df[['snp','A1','A2']].copy(), rsidmode=rsidmode)
+    index_dt = make_hash_index(get_varhash(bim_df))
+    if save is True or (save == 'auto' and bed.sid_count >= min_save):
+        def to_file(tmp_fn):
+            with open(tmp_fn, 'wb') as f: np.savez(f, key=np.array(key), **index_dt)
+        try: _pd_to_atomizer(to_file=to_file, fn=fn)
+        except OSError as e: prst.warn(f'Could not store the target variant index ({e}), it will be rebuilt next time.')
+    if verbose: print('-> Done', end=' ')
+    return index_dt
+
+def match_snps_index(df, bed, index_dt, on=['snp','AX']):
+    # The rows of df present in the target (bed with bim_df, or a variant frame) with their xidx & rflip (+1 same A1, -1 swapped alleles), 
+    # like merge_snps(df, bim_df, handle_missing='filter') but with lookups in the hashed index (of get_varhash(.., on=on)) instead of a full merge.
+    bim_df = bed if isinstance(bed, pd.DataFrame) else bed.bim_df
+    xidx = lookup_hash_index(index_dt, get_varhash(df, on=on))
+    df = df[xidx >= 0].copy(); xidx = xidx[xidx >= 0]
+    bA1 = bim_df['A1'].to_numpy()[xidx]; bA2 = bim_df['A2'].to_numpy()[xidx]
+    A1 = df['A1'].to_numpy(); A2 = df['A2'].to_numpy()
+    ind_match = (A1 == bA1) & (A2 == bA2); ind_flip = (A1 == bA2) & (A2 == bA1)
+    ok = ind_match | ind_flip # Also guards against the (extremely unlikely) 64 bit hash collisions
+    df = df[ok]; df['xidx'] = xidx[ok]; df['rflip'] = np.where(ind_match, 1., -1.)[ok]
+    return df
+
 def check_alignment_snps(*args, dropsnps=False, on=['snp','A1','A2']):
     assert len(args) >= 2, 'At least 2 arguments need for this function'
     for col in on:
@@ -835,9 +1194,10 @@ def check_reqcols_sst(orisst_df, *, reqcols, colmap=None,
         cprint_input_df(sst_df)
         raise Exception(f'Columns {dupcols} are duplicates, which makes it unclear which of these columns to select. Please remove these columns.')
 
-def compute_beta_mrg(df, *, calc_beta_mrg=True, n_eff_handling='topmedian', copy=True, ispretest=False, slicenaninfs=True, verbose=False, cli=False):
+def compute_beta_mrg(df, *, calc_beta_mrg=True, n_eff_handling='topmedian', copy=True, ispretest=False, slicenaninfs=True, verbose=False, cli=False, full=None):
     # --- df is the sst_df # if this function is slower than loading, then there is something fishy with the compute of the system; 
     # loading should be 60% and this processing 30% time of compute.
+    # full: whole-sumstat columns (see _get_full_colstats) if df holds only a part of the sumstat, for the topmedian n_eff & std_y.
     if copy: df = df.copy(); 
     if calc_beta_mrg:
         cols = df.columns
@@ -848,8 +1208,9 @@ def compute_beta_mrg(df, *, calc_beta_mrg=True, n_eff_handling='topmedian', copy
         testcols = [elem for elem in ['se_beta','beta','n_eff','pval'] if elem in cols]
         if 'n_eff' in df: # <-- n_eff handling
             if n_eff_handling == 'topmedian':
-                k=int(len(df['n_eff']) * 0.02); k=max(k,1) # if df is very short k can be 0 and that will work properly (e.g. 9 snps)
-                n_eff = np.median(np.partition(df['n_eff'], -k)[-k:]); n_eff_msg=n_eff
+                n_effs = df['n_eff'] if full is None or full['n_eff'] is None else full['n_eff']
+                k=int(len(n_effs) * 0.02); k=max(k,1) # if df is very short k can be 0 and that will work properly (e.g. 9 snps)
+                n_eff = np.median(np.partition(n_effs, -k)[-k:]); n_eff_msg=n_eff
             elif n_eff_handling == 'raw':
                 n_eff = df['n_eff']; n_eff_msg = np.median(n_eff)
             else: raise ValueError(f'Option not recog: {n_eff_handling}. Options are "topmedian" and "raw"')
@@ -859,7 +1220,11 @@ def compute_beta_mrg(df, *, calc_beta_mrg=True, n_eff_handling='topmedian', copy
             #pre_std_sst = 1. / np.sqrt((n_eff+1) * df['se_beta']**2); k=int(len(pre_std_sst) * 0.025) #old
             #df.loc[:,'beta_mrg'] = df.beta/np.sqrt((n_eff+1)*df.se_beta**2) # old
             df.loc[:,'beta_mrg'] = df.beta*pre_std_sst # There is a funny order here 4 speed
-            std_y = np.sqrt(0.5)/np.median(np.partition(pre_std_sst, -k)[-k:])
+            if full is not None and full['se_beta'] is not None: # The normalization over the whole sumstat
+                valid = ~full['nan']; n_full = full['n_eff'][valid] if n_eff_handling == 'raw' and full['n_eff'] is not None else np.median(n_eff)
+                pre_std_full = 1. / (np.sqrt(n_full+1) * full['se_beta'][valid]); k=int(len(pre_std_full) * 0.02); k=max(k,1)
+            else: pre_std_full = pre_std_sst
+            std_y = np.sqrt(0.5)/np.median(np.partition(pre_std_full, -k)[-k:])
             df['std_sst'] = std_y * pre_std_sst
             df.std_y = std_y # Saving it here incase its needed later on at some point.
             msg = f'Computed beta marginal (=X\'y/n) from sumstat using beta and its standard error and sample size (n_eff={int(n_eff_msg)}).'; 
@@ -882,6 +1247,27 @@ def compute_beta_mrg(df, *, calc_beta_mrg=True, n_eff_handling='topmedian', copy
         if slicenaninfs: df=naninfslicer_funct(df, cols=['beta_mrg'], inf=True, verbose=verbose, ispretest=ispretest)
     return df
 
+def compute_prs_metrics(yhat, pheno, *, binary='auto', min_n=10):
+    # Scores all columns of yhat (one per weight config) against pheno in one go; r2 = squared pearson r,
+    # and for binary (2-valued) phenotypes also the AUC via the Mann-Whitney rank statistic.
+    assert type(yhat) is pd.DataFrame, f'Input \'yhat\' is required to be pd.DataFrame. It is currently: {type(yhat)}'
+    y = pd.Series(pheno).reindex(yhat.index).to_numpy(dtype='float64')
+    ind = ~np.isnan(y); S = yhat.to_numpy(dtype='float64')[ind]; y = y[ind]; n = len(y)
+    if n < min_n: raise ValueError(f'Only {n} individuals with non-missing phenotype overlap with the prediction, need at least {min_n}.')
+    uniq = np.unique(y)
+    if binary == 'auto': binary = len(uniq) == 2
+    Sc = S - S.mean(axis=0); yc = y - y.mean()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        r = (Sc.T@yc)/(np.sqrt((Sc**2).sum(axis=0))*np.sqrt((yc**2).sum()))
+    metrics_df = pd.DataFrame(dict(n=n, r=r, r2=r**2), index=yhat.columns)
+    if binary:
+        assert len(uniq) == 2, f'Binary phenotype should have 2 unique values, found {len(uniq)}.'
+        case = (y == uniq[1]); n1 = case.sum(); n0 = n - n1
+        ranks = stats.rankdata(S, axis=0) # ties get average ranks
+        metrics_df['n_case'] = n1
+        metrics_df['auc'] = (ranks[case].sum(axis=0) - n1*(n1+1)/2.)/(n1*n0)
+    return metrics_df
+
 def _pd_read_csv(*args, max_arrow_tries=2, arrow_sleep=0.5, **kwg):
     try:
         for i in range(max_arrow_tries):
@@ -947,20 +1333,228 @@ def _validate_kwg_load_fun(fn, *, load_fun, ukwg_lst=None, **kwg): ## keep close
     warnings.warn(msg)
     raise ori_err
                                                     # Mind for addrids (this should not set with --addrids in code)
+def _get_file_fingerprint(fn, n_bytes=2**20):
+    # Hash of the size, modification time and first & last n_bytes of a file, to key caches without reading all of it.
+    import hashlib
+    st = os.stat(fn); sha = hashlib.sha1(f'{st.st_size}_{st.st_mtime_ns}'.encode())
+    with open(fn, 'rb') as f:
+        sha.update(f.read(n_bytes))
+        if st.st_size > n_bytes: f.seek(max(st.st_size - n_bytes, n_bytes)); sha.update(f.read())
+    return sha.hexdigest()
+
+def _get_sst_cache_fn(sst_fn): return sst_fn + '.prstcache.feather'
+
+_cache_format = 2 # Bump when the columns or encodings of the cache tables change (e.g. the AX codes)
+
+def _read_cache_table(fn, key='prst_cache'):
+    # Memory mapped (uncompressed feather) cache table & its metadata, or (None, {}) if it is absent, unreadable or written by
+    # another prstools version or cache format (then it is a cache miss and is made again).
+    import pyarrow.feather as pf
+    if not os.path.isfile(fn): return None, {}
+    try: table = pf.read_table(fn, memory_map=True)
+    except Exception: return None, {}
+    meta = json.loads((table.schema.metadata or {}).get(key.encode(), b'{}'))
+    if meta.get('version') != prst.__version__ or meta.get('format') != _cache_format: return None, {}
+    return table, meta
+
+def _cache_table_to_df(table, meta):
+    # Columns are wrapped without copies, only the dictionary encoded (allele) columns are decoded.
+    import pyarrow as pa
+    cols = {}
+    for col, arrow in meta['arrow'].items():
+        arr = table.column(col)
+        if pa.types.is_dictionary(arr.type): arr = arr.cast(arr.type.value_type)
+        cols[col] = arr.to_pandas(types_mapper=pd.ArrowDtype if arrow else None)
+        dtype = meta.get('dtypes', {}).get(col) # e.g. Int64 (with NA) comes back as float64
+        if not arrow and dtype and str(cols[col].dtype) != dtype: cols[col] = cols[col].astype(dtype)
+    return pd.DataFrame(cols)
+
+def _write_cache_table(df, fn, meta, key='prst_cache', dictcols=('A1','A2')):
+    import pyarrow as pa, pyarrow.feather as pf
+    meta = dict(meta, arrow={col: isinstance(dtype, pd.ArrowDtype) for col, dtype in df.dtypes.items()},
+                dtypes={col: str(dtype) for col, dtype in df.dtypes.items()}, version=prst.__version__, format=_cache_format)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    for col in dictcols: # Alleles: few distinct strings
+        if col in table.column_names: table = table.set_column(table.column_names.index(col), col, table.column(col).dictionary_encode())
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), key.encode(): json.dumps(meta).encode()})
+    _pd_to_atomizer(to_file=lambda tmp_fn: pf.write_feather(table, tmp_fn, compression='uncompressed'), fn=fn)
+    return fn
+
+def load_sst_cache(sst_fn, args, verbose=False):
+    # The load_sst() result from the cache next to the sumstat, or None if there is none or it is for another file/arguments.
+    # The (uncompressed feather) columns are memory mapped and wrapped without copies, alleles are stored dictionary encoded.
+    fn = _get_sst_cache_fn(sst_fn)
+    table, meta = _read_cache_table(fn)
+    if table is None: return None
+    args = dict(args, n_gwas=None if meta.get('has_n_eff') else args['n_gwas']) # n_gwas is not used if there is an n_eff column
+    if meta.get('source') != _get_file_fingerprint(sst_fn) or meta.get('args') != json.loads(json.dumps(args, sort_keys=True, default=str)): return None
+    if verbose: print(f' Using cache ({fn})   -> {table.num_rows:>12,} variants sumstat loaded.')
+    sst_df = _cache_table_to_df(table, meta)
+    if 'n_total' in meta: sst_df.attrs['n_total'] = meta['n_total'] # The rows of the sumstat file
+    return sst_df
+
+def _to_arrow_dtypes(df):
+    # The frame with pyarrow backed columns, as read_csv(dtype_backend='pyarrow') gives them.
+    import pyarrow as pa
+    return pa.Table.from_pandas(df, preserve_index=False).to_pandas(types_mapper=pd.ArrowDtype)
+
+_sst_cache_keys = ['colmap','addcols','addrsids','calc_beta_mrg','n_gwas','n_eff_handling','delimiter','chrom','comment','reqcols','slicenaninfs','validate','readkwg']
+
+def get_sst_cache_args(**kwg):
+    # The load_sst() arguments a sumstat cache is keyed by, those not in kwg get the load_sst() defaults. colmap is keyed by
+    # the column renames it gives, so e.g. colmap=None and the default colmap string share a cache.
+    import inspect
+    params = inspect.signature(load_sst).parameters
+    args = {key: kwg.get(key, params[key].default) for key in _sst_cache_keys}
+    addcols = [args['addcols']] if type(args['addcols']) is str else (args['addcols'] or []) # as load_sst() prepares them
+    return dict(args, colmap=get_conv_dt(flow='in', colmap=args['colmap']), addcols=addcols, readkwg=args['readkwg'] or {})
+
+def save_sst_cache(sst_df, sst_fn, args, has_n_eff=False, n_total=None, verbose=False):
+    # Normalized columnar cache of a load_sst() result (including beta_mrg), keyed by the fingerprint of the sumstat file.
+    # n_total (the rows of the file) is kept in the meta, so a load_sst(keep_snps=..) from the cache reports the same as one from the file.
+    fn = _get_sst_cache_fn(sst_fn)
+    args = dict(args, n_gwas=None if has_n_eff else args['n_gwas'])
+    meta = dict(source=_get_file_fingerprint(sst_fn), args=json.loads(json.dumps(args, sort_keys=True, default=str)), has_n_eff=bool(has_n_eff))
+    if n_total is not None: meta['n_total'] = int(n_total)
+    try: _write_cache_table(sst_df, fn, meta)
+    except OSError as e: prst.warn(f'Could not store the sumstat cache ({e}), the sumstat will be parsed again next time.'); return None
+    if verbose: print(f'Stored sumstat cache: {fn}')
+    return fn
+
+def _get_bim_cache_fn(bim_fn): return bim_fn + '.prstcache.feather'
+
+def _get_bim_cache_key(bim_fn):
+    # Identifies the exact bim file the cache belongs to (size & modification time), the bim is not read for this.
+    st = os.stat(bim_fn); return f'{st.st_size}_{st.st_mtime_ns}'
+
+def load_bim_cache(bim_fn, args, verbose=False):
+    # The parsed bim (chrom/pos integer columns, before any chrom or snp selection) from the sidecar, or None if absent or stale.
+    fn = _get_bim_cache_fn(bim_fn)
+    table, meta = _read_cache_table(fn)
+    if table is None: return None
+    if meta.get('source') != _get_bim_cache_key(bim_fn) or meta.get('args') != json.loads(json.dumps(args, sort_keys=True, default=str)): return None
+    return _cache_table_to_df(table, meta)
+
+def save_bim_cache(bim_df, bim_fn, args, verbose=False):
+    # Binary sidecar of the parsed bim next to it, so the next load_bimfam() does not parse the text again.
+    fn = _get_bim_cache_fn(bim_fn)
+    meta = dict(source=_get_bim_cache_key(bim_fn), args=json.loads(json.dumps(args, sort_keys=True, default=str)))
+    try: _write_cache_table(bim_df, fn, meta)
+    except OSError as e: prst.warn(f'Could not store the bim cache ({e}), the bim will be parsed again next time.'); return None
+    if verbose: print(f'Stored bim cache: {fn}')
+    return fn
+
+def _get_keep_keys(keep):
+    # Reference variants to keep as {'snp': ids, 'chrompos': 'chrom:pos' strings}, from ids or a frame with snp and/or chrom & pos.
+    # A sumstat row is kept if it matches on any of the keys its columns allow (so e.g. rows with other ids but a matching position stay).
+    if isinstance(keep, pd.DataFrame):
+        keys = {}
+        if 'snp' in keep.columns: keys['snp'] = pd.unique(keep['snp'].astype(str).to_numpy())
+        if {'chrom','pos'}.issubset(keep.columns):
+            chrom = keep['chrom'].astype(str).str.replace('^chr', '', regex=True, case=False)
+            keys['chrompos'] = pd.unique((chrom + ':' + keep['pos'].astype('int64').astype(str)).to_numpy())
+        assert keys, 'The variants to keep should be given as snp ids or in a frame with a snp column or chrom and pos columns.'
+        return keys
+    if isinstance(keep, (set, frozenset)): keep = list(keep)
+    return dict(snp=pd.unique(pd.Series(keep, dtype=object).astype(str).to_numpy()))
+
+def _get_keep_usable(keys, cols):
+    # The keys a sumstat with cols is filtered on. chrom:pos is only used next to a snp column: without one the snp ids are added from the
+    # positions later on (get_rsids, with build detection), so filtering on positions that can be in another build than the reference is wrong.
+    if not 'snp' in cols: return []
+    return [key for key in keys if key == 'snp' or (key == 'chrompos' and {'chrom','pos'}.issubset(cols))]
+
+def _get_keep_mask(keys, get_col, cols, *, isin, concat):
+    # The rows to keep, OR-ed over the usable keys (None if there are none). get_col, isin(arr, key) & concat abstract over pandas and pyarrow.
+    ind = None
+    for key in _get_keep_usable(keys, cols):
+        cur = isin(get_col('snp'), key) if key == 'snp' else isin(concat(get_col('chrom'), get_col('pos')), key)
+        ind = cur if ind is None else ind | cur
+    return ind
+
+def _filter_keep(sst_df, keep):
+    # The (renamed) sumstat rows that are in keep, or None if it cannot be filtered on its columns (see _get_keep_usable).
+    keys = _get_keep_keys(keep)
+    ind = _get_keep_mask(keys, lambda col: sst_df[col].astype(str), sst_df.columns, isin=lambda ser, key: ser.isin(keys[key]),
+                         concat=lambda chrom, pos: chrom.str.replace('^chr', '', regex=True, case=False) + ':' + pos)
+    return None if ind is None else sst_df[ind.to_numpy(dtype=bool)].reset_index(drop=True)
+
+_full_cols = ['n_eff','se_beta','beta','oddsratio','pval']
+
+def _get_full_colstats(cols):
+    # Whole-sumstat statistics for compute_beta_mrg (topmedian n_eff & std_sst normalization) from float arrays of all rows, so
+    # these do not change if only a part of the variants is kept. nan: rows dropped for a NaN in one of the columns it tests.
+    testcols = [col for col in ['se_beta','beta','n_eff','pval'] if col in cols] + (['oddsratio'] if 'oddsratio' in cols and not 'beta' in cols else [])
+    nan = np.zeros(len(next(iter(cols.values()))) if cols else 0, dtype=bool)
+    for col in testcols: nan |= np.isnan(cols[col])
+    return dict(n_eff=cols.get('n_eff'), se_beta=cols.get('se_beta'), nan=nan)
+
+def _read_csv_filtered(fn, keep, *, delimiter='\t', conv_dt=None, block_size=2**24, verbose=False):
+    # Streams the file in pyarrow record batches and only keeps rows of which the snp id (or chrom:pos) is in the hashed keep set,
+    # so peak memory is bounded by the block size and the kept rows. The kept rows are parsed like a normal read (same dtypes).
+    # The columns for the whole-sumstat statistics are gathered for all rows (as floats), in df.attrs['full'] (see _get_full_colstats).
+    # Returns None if the file has no columns to match on, the number of rows read is in df.attrs['n_read'].
+    import pyarrow as pa, pyarrow.csv as pacsv, pyarrow.compute as pc
+    from io import BytesIO
+    keys = _get_keep_keys(keep)
+    names = list(pd.read_csv(fn, sep=delimiter, nrows=0).columns)
+    inv_dt = {}
+    for col in names: inv_dt.setdefault((conv_dt or {}).get(col, col), col)
+    if not _get_keep_usable(keys, inv_dt): return None
+    value_sets = {key: pa.array(values, type=pa.string()) for key, values in keys.items()}
+    na_set = pa.array(['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN', '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null'])
+    def to_float(arr): # As read_csv parses the column, unparsable values become NaN
+        arr = pc.if_else(pc.is_in(arr, value_set=na_set), pa.scalar(None, pa.string()), arr)
+        try: return pc.cast(arr, pa.float64()).to_numpy(zero_copy_only=False)
+        except pa.ArrowInvalid: return pd.to_numeric(arr.to_pandas(), errors='coerce').to_numpy(dtype=float)
+    reader = pacsv.open_csv(fn, read_options=pacsv.ReadOptions(block_size=block_size),
+                            parse_options=pacsv.ParseOptions(delimiter=delimiter),
+                            convert_options=pacsv.ConvertOptions(column_types={col: pa.string() for col in names}, strings_can_be_null=False))
+    batches = []; n_read = 0; full = {col: [] for col in _full_cols if col in inv_dt}
+    def concat(chrom, pos): return pc.binary_join_element_wise(pc.replace_substring_regex(chrom, '(?i)^chr', ''), pos, ':')
+    for batch in reader:
+        n_read += batch.num_rows
+        for col in full: full[col] += [to_float(batch.column(inv_dt[col]))]
+        ind = _get_keep_mask(keys, lambda col: batch.column(inv_dt[col]), inv_dt, isin=lambda arr, key: pc.is_in(arr, value_set=value_sets[key]), concat=concat)
+        batch = batch.filter(ind)
+        if batch.num_rows: batches += [batch]
+    buf = BytesIO(); buf.write((delimiter.join(names) + '\n').encode())
+    if batches: pacsv.write_csv(pa.Table.from_batches(batches, schema=reader.schema), buf,
+                                pacsv.WriteOptions(include_header=False, delimiter=delimiter, quoting_style='none'))
+    buf.seek(0); df = _pd_read_csv(buf, delimiter=delimiter, **get_pyarrow_prw()) if batches else pd.read_csv(buf, delimiter=delimiter)
+    df.attrs['n_read'] = n_read
+    df.attrs['full'] = _get_full_colstats({col: np.concatenate(lst) if lst else np.zeros(0) for col, lst in full.items()})
+    return df
+
 def load_sst(sst_fn, *, colmap=None, addcols=False, addrsids='auto', calc_beta_mrg=True, n_gwas=None, n_eff_handling='topmedian', delimiter=None, chrom=None, comment=None,
-             reqcols=['snp','A1','A2',('beta','oddsratio'),('pval','se_beta')], pyarrow=True, pretest=True, check=True, slicenaninfs=True, validate=True, verbose=True, 
-             nrows=None, testnrows=100, ispretest=False, cli=False, readkwg=None): # do not change pretest
+             reqcols=['snp','A1','A2',('beta','oddsratio'),('pval','se_beta')], pyarrow=True, pretest=True, check=True, slicenaninfs=True, validate=True, verbose=True,
+             nrows=None, testnrows=100, ispretest=False, cli=False, readkwg=None, cache='auto', min_cache=100_000, keep_snps=None): # do not change pretest
 
     # Hey! I take about 7 seconds on 20M snps with Pyarrow, Optimal enough for now,
     # -> get_beta_mrg takes 60% (np.sort() part takes 40% of that, speedup possible) , and read_csv takes 30% and appears effient already
+    # With cache a valid columnar cache of the result is used (see load_sst_cache), with cache='auto' one is stored for sumstats
+    # of min_cache or more variants, with cache=True always.
+    # With keep_snps (snp ids, or a frame with snp or chrom & pos columns) only those variants are read, streaming the file in batches
+    # (see _read_csv_filtered). The sample size (topmedian n_eff) and std_sst normalization are still computed over the whole sumstat.
     # Preps & Pretest:
     if not addcols: addcols=[]
     if readkwg is None: readkwg = {}
     if type(addcols) is str: addcols = [addcols]
     if delimiter == r'\s+': pyarrow=False
     if verbose: print(f'Loading sumstat file.', end='')
+    use_cache = bool(cache) and nrows is None and not ispretest and os.path.isfile(sst_fn) and get_pyarrowinstalled_bool()
+    if use_cache:
+        lcls = locals(); cache_args = get_sst_cache_args(**{key: lcls[key] for key in _sst_cache_keys})
+        sst_df = load_sst_cache(sst_fn, cache_args, verbose=verbose)
+        if sst_df is not None and keep_snps is None: sst_df.attrs.pop('n_total', None); return sst_df
+        if sst_df is not None: # The cached result was computed over the whole sumstat, so keep_snps is just a selection of it
+            n_total = sst_df.attrs.get('n_total', sst_df.shape[0]); kept_df = _filter_keep(sst_df, keep_snps)
+            sst_df = sst_df if kept_df is None else kept_df
+            assert sst_df.shape[0] > 0, f'None of the variants to keep (keep_snps) were found in the sumstat {sst_fn}.'
+            if verbose: print(f'Kept {sst_df.shape[0]:,} variants that are in the given reference.')
+            sst_df.attrs['n_total'] = n_total; return sst_df
     if pretest: # Pre-test: This can become a self call (shorter test run)
-        pretestkwg = {key: item for key,item in locals().items() if not key in ['sst_fn']}
+        pretestkwg = {key: item for key,item in locals().items() if not key in ['sst_fn','use_cache','lcls','cache_args','sst_df','keep_snps']}
         pretestkwg.update(verbose=False, ispretest=True, nrows=testnrows, pretest=False)
         ukwg = _validate_kwg_load_fun(sst_fn, load_fun=load_sst, **pretestkwg)
         if 'pyarrow' in ukwg: pyarrow=ukwg.pop('pyarrow') # <-- this could become a full load_sst() call later
@@ -974,7 +1568,9 @@ def load_sst(sst_fn, *, colmap=None, addcols=False, addrsids='auto', calc_beta_m
     kwg.update(ukwg); kwg.update(readkwg)
 
     # Loading
-    orisst_df = _pd_read_csv(sst_fn, **kwg) # 60% of time
+    streamable = keep_snps is not None and pyarrow and nrows is None and comment is None and not readkwg and kwg['delimiter'] != r'\s+'
+    orisst_df = _read_csv_filtered(sst_fn, keep_snps, delimiter=kwg['delimiter'], conv_dt=get_conv_dt(flow='in', colmap=colmap)) if streamable else None
+    if orisst_df is None: orisst_df = _pd_read_csv(sst_fn, **kwg) # 60% of time
     if verbose: print(f'   -> {orisst_df.shape[0]:>12,} variants sumstat loaded.')
 
     # Checks: This part should do all the reqcol checks...
@@ -984,6 +1580,15 @@ def load_sst(sst_fn, *, colmap=None, addcols=False, addrsids='auto', calc_beta_m
     # Translate: 
     conv_dt = get_conv_dt(flow='in', colmap=colmap, verbose=False)
     sst_df = orisst_df.rename(columns=conv_dt)
+    full = orisst_df.attrs.get('full') if keep_snps is not None else None; n_total = orisst_df.attrs.get('n_read', orisst_df.shape[0])
+    if keep_snps is not None and not 'n_read' in orisst_df.attrs: # Not streamed, filtered here
+        full = _get_full_colstats({col: pd.to_numeric(sst_df[col], errors='coerce').to_numpy(dtype=float, na_value=np.nan) for col in _full_cols if col in sst_df})
+        kept_df = _filter_keep(sst_df, keep_snps)
+        if kept_df is None: full = None; keep_snps = None # Nothing to filter on (e.g. no snp column), the whole sumstat is used as without keep_snps
+        else: sst_df = kept_df
+    if keep_snps is not None:
+        assert sst_df.shape[0] > 0, f'None of the variants to keep (keep_snps) were found in the sumstat {sst_fn}.'
+        if verbose: print(f'Kept {sst_df.shape[0]:,} variants that are in the given reference.')
 
     # Computation of beta marginal & other Post proc:
     if check and n_gwas is None:
@@ -991,13 +1596,14 @@ def load_sst(sst_fn, *, colmap=None, addcols=False, addrsids='auto', calc_beta_m
         reqcols=['n_eff'], postfix='. Please add the '+\
         'column to the sumstat or supply --n_gwas/-n (at times it can be done with '+\
         '--colmap selecting the right n_eff/N column, more above, or copy-paste into chatbot).')
+    has_n_eff = 'n_eff' in sst_df
     if calc_beta_mrg:
         if not 'n_eff' in sst_df and not n_gwas is None:
             sst_df['n_eff'] = n_gwas
         from contextlib import nullcontext
         with (warnings.catch_warnings(record=True) if ispretest else nullcontext()):
             sst_df = compute_beta_mrg(sst_df, calc_beta_mrg=calc_beta_mrg, ispretest=ispretest, # 30% of time
-                      n_eff_handling=n_eff_handling, slicenaninfs=slicenaninfs, verbose=verbose, cli=cli)
+                      n_eff_handling=n_eff_handling, slicenaninfs=slicenaninfs, verbose=verbose, cli=cli, full=full)
     
     if validate: 
         sst_df = validate_dataframe_index(sst_df, warn=False)
@@ -1014,6 +1620,9 @@ def load_sst(sst_fn, *, colmap=None, addcols=False, addrsids='auto', calc_beta_m
             ' a snp column will be added. This might take quite some time and memory.')
             if verbose: print(msg)
             sst_df = get_rsids(sst_df)
+    # The cache is stored from loads of the whole sumstat only, a keep_snps load takes its selection from it (above)
+    if use_cache and keep_snps is None and (cache is True or sst_df.shape[0] >= min_cache): save_sst_cache(sst_df, sst_fn, cache_args, has_n_eff=has_n_eff, n_total=n_total, verbose=verbose)
+    if keep_snps is not None: sst_df.attrs['n_total'] = n_total # The number of variants in the whole sumstat
 
     return sst_df
 
@@ -1188,12 +1797,19 @@ def pvalandbeta_to_betamrg(*, pvals, beta, n_gwas):
 
 def load_bimfam(base_fn, strip=True, bim=True, fam=True, chrom='*', cmap=True, delimiter='determine', fil_arr=None, end='\n', start_string='Loading bim/fam. ',
                 testnrows=20, nrows=None, pretest=True, rsidmode=False, add_xidx=False, add_AX=False, check=True, pyarrow=True, verbose=False, reset_index=True,
-                ispretest=False):
+                ispretest=False, cache='auto', min_cache=100_000):
+    # With cache the parsed bim is stored in a binary sidecar (<bim>.prstcache.feather, see load_bim_cache) that is memory mapped on
+    # the next load as long as size & mtime of the bim match, with cache='auto' this is done for bims with at least min_cache variants.
     if verbose: print(f"{start_string:<24.24}", end='', flush=True)
-    if pretest:
+    if strip and (base_fn.split('.')[-1] in ('bim','fam','bed')): base_fn = '.'.join(base_fn.split('.')[:-1]); strip = False
+    use_cache = bool(cache) and bim and nrows is None and not ispretest and pyarrow and os.path.isfile(base_fn + '.bim') and get_pyarrowinstalled_bool()
+    cache_args = dict(cmap=cmap)
+    bim_df = load_bim_cache(base_fn + '.bim', cache_args) if use_cache else None
+    from_cache = bim_df is not None
+    if pretest and not from_cache:
         delimiter='\t'; nrows=testnrows; pretest=False
         pyarrowstart=pyarrow; pyarrow=False
-        kwg = locals(); kwg.pop('pyarrowstart')
+        kwg = {key: item for key, item in locals().items() if not key in ['pyarrowstart','use_cache','cache_args','bim_df','from_cache']}
         kwg['verbose']=False; kwg['ispretest']=True
         try: load_bimfam(**kwg)
         except: 
@@ -1203,11 +1819,9 @@ def load_bimfam(base_fn, strip=True, bim=True, fam=True, chrom='*', cmap=True, d
 
     prw = get_pyarrow_prw(delimiter=delimiter, pyarrow=pyarrow)
 
-    if strip and (base_fn.split('.')[-1] in ('bim','fam','bed')): base_fn = '.'.join(base_fn.split('.')[:-1])
-
-    bim_df = pd.read_csv(base_fn + '.bim', delimiter=delimiter, header=None, nrows=nrows,
-                         names=['chrom', 'snp', 'cm', 'pos', 'A1', 'A2'], **prw) if bim else None
-    if type(bim_df) is pd.DataFrame and add_xidx: bim_df['xidx'] = bim_df.index
+    if bim and not from_cache:
+        bim_df = pd.read_csv(base_fn + '.bim', delimiter=delimiter, header=None, nrows=nrows,
+                             names=['chrom', 'snp', 'cm', 'pos', 'A1', 'A2'], **prw)
     if bim: n_snps_start=bim_df.shape[0]
 
     fam_df = pd.read_csv(base_fn + '.fam', delimiter=r'\s+', header=None,  nrows=nrows,
@@ -1218,6 +1832,8 @@ def load_bimfam(base_fn, strip=True, bim=True, fam=True, chrom='*', cmap=True, d
             cmap = get_chrom_map() if cmap is True else cmap
             bim_df["chrom"] = bim_df["chrom"].replace(cmap) # the to_numeric() step can be slow, speedup is involved.
             bim_df['chrom'] = pd.to_numeric(bim_df['chrom'], errors='coerce').astype('Int64') # rrx= bim_df['chrom'].unique() appears fast, so perhaps fix, mod cmap
+        if use_cache and not from_cache and (cache is True or n_snps_start >= min_cache): save_bim_cache(bim_df, base_fn + '.bim', cache_args)
+        if add_xidx: bim_df['xidx'] = bim_df.index
         if not chrom in ['*','all']:
             #ind = bim_df['chrom'] == bim_df['chrom'].dtype.type(chrom) # old one  
             ind = bim_df['chrom'].isin(get_chrom_lst(chrom))
@@ -1245,7 +1861,8 @@ def load_bimfam(base_fn, strip=True, bim=True, fam=True, chrom='*', cmap=True, d
             lst += [f'{fam_df.shape[0]:,} induviduals fam file loaded']
         report = ' & '.join(lst)
         if report == '': report='no bim or fam file'
-        if len(prw) > 1: report=report+' (used pyarrow)'
+        if from_cache: report=report+' (used cache)'
+        elif len(prw) > 1: report=report+' (used pyarrow)'
         print(f'-> {report}.', end=end, flush=True)
         
 
@@ -1322,7 +1939,7 @@ def load_ref(ref_fn, chrom=None, verbose=False, rename_dt=dict(maf='maf_ref',af_
         ref_df = validate_dataframe_index(ref_df, warn=False)
     return ref_df
 
-def load_snpdb(snpdb_df='mini'):
+def _get_snpdb_fn(snpdb_df='mini'):
     assert type(snpdb_df) is str, f'Input to load_snpdb must be string, it is {type(snpdb_df)}'
     prstcfg = prst.utils.load_config()
     prstdatadir = prstcfg['prstdatadir']
@@ -1332,13 +1949,103 @@ def load_snpdb(snpdb_df='mini'):
         msg = f'Trying load a snp database (version="{snpdb_df}"), but prstdatadir is not set, '
         msg += 'which is required for this functionality. Please run "prst config" to set it.'
         if not prstdatadir: raise RuntimeError(msg)
-    else: assert os.path.exists(os.path.expanduser(snpdb_df)), (f'Path {snpdb_df} must exist, or specify '
+    else: 
+        assert os.path.exists(os.path.expanduser(snpdb_df)), (f'Path {snpdb_df} must exist, or specify '
                     'snpdb=mini or full (if prst data dir is enabled) or specify dataframe type as input')
-    fn = prst.utils.validate_path(fn=fn, must_exist=True, handle_prstdatadir='only')
+        return os.path.expanduser(snpdb_df)
+    return prst.utils.validate_path(fn=fn, must_exist=True, handle_prstdatadir='only')
+
+def load_snpdb(snpdb_df='mini'):
+    fn = _get_snpdb_fn(snpdb_df)
     prw = get_pyarrow_prw()
     snpdb_df = pd.read_csv(fn, sep='\t', **prw)
     return snpdb_df
 
+def _get_snpdb_builds(columns): return [int(col[5:]) for col in columns if col.startswith('chrom') and col[5:].isdigit() and f'pos{col[5:]}' in columns]
+
+def build_snpdb_index(snpdb_df='full', dn=None, verbose=False):
+    # One-time conversion of the snp database into a directory (<snpdb>.prstidx) of memory-mappable arrays: per build the sorted cpnum
+    # keys (cp<bld>.npy) with their snpdb rows (ix<bld>.npy), the rsids as integers (rsnum.npy) & the other columns (uncompressed feather).
+    import pyarrow as pa, pyarrow.feather as pf, shutil
+    fn = _get_snpdb_fn(snpdb_df); dn = fn + '.prstidx' if dn is None else dn
+    if verbose: print(f'Building snpdb index for {fn}', end=' ', flush=True)
+    db_df = load_snpdb(fn); builds = _get_snpdb_builds(db_df.columns)
+    assert len(builds) > 0, f'No chrom<build>/pos<build> columns found in the snp database {fn}.'
+    snp = db_df['snp'].astype('string[pyarrow]')
+    isrs = snp.str.fullmatch(r'rs[0-9]{1,18}').fillna(False).to_numpy(dtype=bool)
+    arrays = dict(rsnum=np.where(isrs, pd.to_numeric(snp.str[2:].where(isrs, '0'), errors='coerce').fillna(-1).to_numpy(dtype=np.int64), -1))
+    for bld in builds:
+        cp = (db_df[f'pos{bld}'] + db_df[f'chrom{bld}']*int(1e10)).astype('Int64')
+        ok = ~cp.isna().to_numpy(dtype=bool); rows = np.flatnonzero(ok)
+        cp = cp.to_numpy(dtype=np.int64, na_value=-1)[ok]; order = np.argsort(cp, kind='stable')
+        arrays[f'cp{bld}'] = cp[order]; arrays[f'ix{bld}'] = rows[order].astype(np.int32 if len(db_df) < 2**31 else np.int64)
+    other_df = db_df.drop(columns=['snp']) if isrs.all() else db_df # The snp strings are only kept if they are not all rsids
+    meta = dict(source=_get_snpdb_fingerprint(fn), n=int(db_df.shape[0]), builds=builds, columns=list(db_df.columns), has_snp=bool(not isrs.all()), version=prst.__version__)
+    tmp_dn = os.path.join(os.path.dirname(dn) or '.', f'.{os.path.basename(dn)}.incomplete.{uuid.uuid4().hex[:16]}')
+    try:
+        os.makedirs(tmp_dn)
+        for key, arr in arrays.items(): np.save(os.path.join(tmp_dn, f'{key}.npy'), arr)
+        pf.write_feather(pa.Table.from_pandas(other_df, preserve_index=False), os.path.join(tmp_dn, 'table.feather'), compression='uncompressed')
+        with open(os.path.join(tmp_dn, 'meta.json'), 'w') as f: json.dump(meta, f)
+        if os.path.isdir(dn): shutil.rmtree(dn)
+        os.replace(tmp_dn, dn)
+    finally:
+        if os.path.isdir(tmp_dn): shutil.rmtree(tmp_dn, ignore_errors=True)
+    if verbose: print('-> Done')
+    return dn
+
+def _get_snpdb_fingerprint(fn): st = os.stat(fn); return f'{st.st_size}_{st.st_mtime_ns}'
+
+def load_snpdb_index(snpdb_df='full', dn=None, build='auto', verbose=False):
+    # The memory mapped snpdb index (see build_snpdb_index) as a dict, (re)built if absent or stale & build allows it ('auto': if the
+    # directory is writable). Returns None if there is no (valid) index. Lookups only touch the pages they need.
+    import pyarrow.feather as pf
+    fn = _get_snpdb_fn(snpdb_df); dn = fn + '.prstidx' if dn is None else dn
+    key = ('idx', dn)
+    def valid(meta): return meta.get('source') == _get_snpdb_fingerprint(fn)
+    if key in _snpdb_dt and valid(_snpdb_dt[key]['meta']): return _snpdb_dt[key]
+    meta = {}
+    if os.path.isfile(os.path.join(dn, 'meta.json')):
+        with open(os.path.join(dn, 'meta.json')) as f: meta = json.load(f)
+    if not valid(meta):
+        if build is True or (build == 'auto' and os.access(os.path.dirname(os.path.abspath(dn)), os.W_OK)):
+            try: build_snpdb_index(fn, dn=dn, verbose=verbose)
+            except OSError as e: prst.warn(f'Could not store the snpdb index ({e}), falling back to loading the full snpdb.'); return None
+            with open(os.path.join(dn, 'meta.json')) as f: meta = json.load(f)
+        else: return None
+    index_dt = dict(meta=meta, table=pf.read_table(os.path.join(dn, 'table.feather'), memory_map=True),
+                    **{key: np.load(os.path.join(dn, f'{key}.npy'), mmap_mode='r') for key in ['rsnum'] + [f'{k}{bld}' for bld in meta['builds'] for k in ['cp','ix']]})
+    _snpdb_dt[key] = index_dt
+    return index_dt
+
+def take_snpdb_index(index_dt, rows, columns=None):
+    # The snpdb rows (-1 gives a row of NaNs) as a frame with the dtypes of load_snpdb(), from the memory mapped index.
+    import pyarrow as pa, pyarrow.compute as pc
+    columns = index_dt['meta']['columns'] if columns is None else columns
+    rows = np.asarray(rows, dtype=np.int64); miss = rows < 0
+    table = index_dt['table'].take(pa.array(np.where(miss, 0, rows), mask=miss))
+    cols = {}
+    for col in columns:
+        if col == 'snp' and not index_dt['meta']['has_snp']:
+            rsnum = pa.array(np.asarray(index_dt['rsnum'])[np.where(miss, 0, rows)], mask=miss)
+            arr = pc.binary_join_element_wise('rs', pc.cast(rsnum, pa.string()), '')
+        else: arr = table.column(col)
+        cols[col] = arr.to_pandas(types_mapper=pd.ArrowDtype)
+    return pd.DataFrame(cols)
+
+def lookup_snpdb_index(index_dt, cpnum, bld):
+    # For each query cpnum all matching snpdb rows (in snpdb order): the query positions (qidx) & snpdb rows (-1 if none), like a left merge.
+    keys = index_dt[f'cp{bld}']; ix = index_dt[f'ix{bld}']
+    cpnum = np.asarray(pd.array(cpnum).astype('Int64').to_numpy(dtype=np.int64, na_value=-1))
+    order = np.argsort(cpnum, kind='stable'); lo = np.empty_like(order); hi = np.empty_like(order) # Sorted queries: 5-10x faster lookups
+    lo[order] = np.searchsorted(keys, cpnum[order], 'left'); hi[order] = np.searchsorted(keys, cpnum[order], 'right')
+    n = np.where(cpnum < 0, 0, hi - lo); nout = np.maximum(n, 1)
+    qidx = np.repeat(np.arange(len(cpnum)), nout)
+    offs = np.arange(len(qidx)) - np.repeat(np.cumsum(nout) - nout, nout)
+    pos = np.repeat(lo, nout) + offs
+    rows = np.where(np.repeat(n, nout) > 0, np.asarray(ix)[np.minimum(pos, len(ix) - 1)] if len(ix) else -1, -1)
+    return qidx, rows
+
 def load_weights(fn, ftype='auto', pyarrow=True, sep:str='\t', verbose=False):
     if pyarrow: # pyarrow mechanics
         try: import pyarrow as pyarrowpack # Prevent var overloading
@@ -1363,6 +2070,54 @@ def load_weights(fn, ftype='auto', pyarrow=True, sep:str='\t', verbose=False):
     else: df = pd.read_csv(fn, sep=sep, names=names, **header_dt, **prw)
     return df
 
+def load_pheno(fn='fam', *, fam_df=None, pheno=None, missing=(-9,), verbose=False):
+    # Returns a float phenotype series with a (fid, iid) multiindex (same as the predict() output). fn='fam' (or a .fam file)
+    # uses the 6th fam column, otherwise a plink-style pheno file (FID IID pheno1 pheno2 .., with or without header) is expected.
+    if fn == 'fam' or str(fn).endswith('.fam'):
+        if fam_df is None: _, fam_df = load_bimfam(fn, bim=False)
+        df = fam_df[['fid','iid','trait']]; pheno = 'trait' if pheno is None else pheno
+        assert pheno == 'trait', f'A fam file only holds one phenotype (\'trait\'), cannot select pheno={pheno}'
+    else:
+        with open(os.path.expanduser(fn)) as f: first = f.readline().split()
+        hashead = len(first) > 0 and first[0].lstrip('#').upper() in ('FID','IID')
+        names = None if hashead else ['fid','iid'] + [f'pheno{i}' for i in range(1, len(first)-1)]
+        df = pd.read_csv(os.path.expanduser(fn), sep=r'\s+', header=0 if hashead else None, names=names, dtype={0: str, 1: str}, na_values=['NA','na','nan'])
+        df = df.rename(columns={df.columns[0]: 'fid', df.columns[1]: 'iid'})
+        if pheno is None: pheno = df.columns[2]
+        assert pheno in df.columns, f'Phenotype column \'{pheno}\' not present in {fn}. Available: {", ".join(df.columns[2:])}'
+    ser = pd.to_numeric(df[pheno], errors='coerce').to_numpy(dtype='float64', copy=True)
+    ser[np.isin(ser, missing)] = np.nan
+    ser = pd.Series(ser, index=pd.MultiIndex.from_arrays(df[['fid','iid']].values.T, names=['fid','iid']), name=pheno)
+    assert not ser.index.duplicated().any(), f'Duplicate fid/iid pairs present in phenotype input {fn}.'
+    if verbose: print(f'Loaded phenotype \'{pheno}\' for {ser.notna().sum():,} induviduals ({ser.isna().sum():,} missing).')
+    return ser
+
+def load_sample_ids(fn):
+    # Reads a plink style --keep/--remove file: FID IID (extra columns ignored) or a single IID column, with or without header.
+    with open(os.path.expanduser(fn)) as f: first = f.readline().split()
+    hashead = len(first) > 0 and first[0].lstrip('#').upper() in ('FID','IID')
+    df = pd.read_csv(os.path.expanduser(fn), sep=r'\s+', header=None, skiprows=int(hashead), dtype=str, usecols=range(min(len(first), 2)))
+    if df.shape[1] == 1 or (hashead and first[0].lstrip('#').upper() == 'IID'): return df.iloc[:,:1].set_axis(['iid'], axis=1)
+    return df.set_axis(['fid','iid'], axis=1)
+
+def get_sample_index(fam_df, *, keep=None, remove=None, verbose=False):
+    # Resolves --keep/--remove sample files (or frames with fid/iid, or only iid columns) against fam_df once. Returns the sorted
+    # unique fam row numbers to score, or None if there is nothing to subset. Order and duplicates in the inputs do not matter.
+    if keep is None and remove is None: return None
+    def get_msk(ids):
+        ids = load_sample_ids(ids) if isinstance(ids, (str, os.PathLike)) else pd.DataFrame(ids)
+        cols = ['fid','iid'] if 'fid' in ids.columns else ['iid']
+        key = pd.MultiIndex.from_frame(ids[cols].astype(str)) if len(cols) == 2 else pd.Index(ids['iid'].astype(str))
+        ref = pd.MultiIndex.from_frame(fam_df[cols].astype(str)) if len(cols) == 2 else pd.Index(fam_df['iid'].astype(str))
+        return ref.isin(key)
+    msk = np.ones(fam_df.shape[0], dtype=bool)
+    if keep is not None: msk &= get_msk(keep)
+    if remove is not None: msk &= ~get_msk(remove)
+    iidx = np.flatnonzero(msk)
+    if len(iidx) == 0: raise Exception('No induviduals left after applying the keep/remove sample selection, check the ids.')
+    if verbose: print(f'Sample selection: scoring {len(iidx):,} out of {fam_df.shape[0]:,} induviduals.')
+    return iidx
+
 def _get_countstring(n):
     return f"{n/1e6:.2f}M" if n>=1e6 else f"{n/1e3:.1f}k" if n>=1e3 else str(n)
 
@@ -1371,6 +2126,7 @@ def load_bed(fn, make_bimfam_attrs=True, countA12correct=True, verbose=False, st
     if verbose: 
         proc_fn = f'...{fn[-17:]}' if len(fn) >= 20 else fn
         print(start_string.format_map(prst.utils.AutoDict(fn=proc_fn)), end='', flush=True) 
+    if fn.endswith('.bgen'): return load_bgen(fn, make_bimfam_attrs=make_bimfam_attrs, verbose=verbose, end=end) # Dosage target
     fn = prst.utils.validate_path(fn=fn, must_exist=False)
     iid_count=None; sid_count=None
     if make_bimfam_attrs:
@@ -1378,12 +2134,303 @@ def load_bed(fn, make_bimfam_attrs=True, countA12correct=True, verbose=False, st
         iid_count=fam_df.shape[0]; sid_count=bim_df.shape[0] 
     base_fn = '.'.join(fn.split('.')[:-1]) if (fn.split('.')[-1] in ('bim','fam','bed')) else fn
     bed = open_bed(base_fn+'.bed', iid_count=iid_count, sid_count=sid_count)
+    check_extract(base_fn) # Warns for an extract with a changed source
     if make_bimfam_attrs:
         bed.bim_df = bim_df; bed.fam_df = fam_df
     proc = _get_countstring 
     if verbose: print(f"[{proc(fam_df.shape[0])} induv x {proc(bim_df.shape[0])} snps]. ", end=end, flush=True)
     return bed
 
+def load_bgen(fn, *, sample=None, make_bimfam_attrs=True, verbose=False, start_string='Loading bgen file (@ {fn}) ', end=''):
+    # BGEN (v1.2, layout 2) dosage target, with the open_bed interface (read(), iid_count, sid_count, bim_df & fam_df).
+    # A variant offset index is made once and cached next to the file (.prstidx.npz), so later loads skip the header scan.
+    from prstools._bgen import BgenReader
+    if verbose: 
+        proc_fn = f'...{fn[-17:]}' if len(fn) >= 20 else fn
+        print(start_string.format_map(prst.utils.AutoDict(fn=proc_fn)), end='', flush=True) 
+    fn = prst.utils.validate_path(fn=fn, must_exist=False)
+    bgen = BgenReader(fn, sample=sample, verbose=verbose)
+    if make_bimfam_attrs:
+        bim_df = bgen.bim_df
+        if not pd.api.types.is_numeric_dtype(bim_df['chrom']): # same chrom handling as load_bimfam()
+            bim_df['chrom'] = pd.to_numeric(bim_df['chrom'].str.replace('^chr', '', regex=True).replace(get_chrom_map()), errors='coerce').astype('Int64')
+        bim_df['xidx'] = bim_df.index; bgen.bim_df = get_AX(bim_df)
+    if verbose: print(f"[{_get_countstring(bgen.iid_count)} induv x {_get_countstring(bgen.sid_count)} snps]. ", end=end, flush=True)
+    return bgen
+
+def read_bed_packed(bed, xidx):
+    # The raw 2-bit packed rows (variants x ceil(n_iid/4) bytes) of a snp-major plink bed, from a memory map of the file.
+    mm = getattr(bed, '_packed_mm', None)
+    if mm is None:
+        mm = np.memmap(bed.location, dtype=np.uint8, mode='r')
+        assert bytes(mm[:3]) == bytes([0x6c, 0x1b, 0x01]), f'{bed.location} is not a (snp-major) plink bed file.'
+        mm = mm[3:].reshape(bed.sid_count, (bed.iid_count + 3)//4); bed._packed_mm = mm
+    return mm[np.asarray(xidx)]
+
+def _get_interval_layers(chrom, start, end):
+    # Splits (possibly overlapping) intervals into layers, such that the intervals within a layer do not overlap. Greedy
+    # (sorted by start, each interval goes into the layer that came free first), so the number of layers is the max overlap depth.
+    import heapq
+    layer = np.zeros(len(chrom), dtype='int64'); heap = []; n_layers = 0; prev = None
+    for i in np.lexsort((start, chrom)):
+        if chrom[i] != prev: heap = [(-np.inf, k) for k in range(n_layers)]; prev = chrom[i] # all layers are free on a new chrom
+        if heap and heap[0][0] <= start[i]: _, layer[i] = heapq.heappop(heap)
+        else: layer[i] = n_layers; n_layers += 1
+        heapq.heappush(heap, (end[i], layer[i]))
+    return layer
+
+def get_variant_groups(df, groups='chrom'):
+    # Variant to group membership for the rows of df (with chrom, snp & pos), as (rows, gidx, names): row rows[i] of df is in
+    # group names[gidx[i]]. groups: a column of df (e.g. 'chrom'), an array with a group per row (nan is none), an annotation
+    # BED file (chrom start end [name], a variant is in an interval if start < pos <= end; intervals can overlap) or a tsv
+    # with snp & group columns (a variant can be in several groups).
+    if isinstance(groups, str) and groups in df.columns: groups = df[groups].to_numpy()
+    if not isinstance(groups, str): # A group per row
+        ser = pd.Series(np.asarray(groups), dtype=object); ind = ser.notna().to_numpy()
+        codes, names = pd.factorize(ser[ind], sort=True)
+        return np.flatnonzero(ind), codes, [str(name) for name in names]
+    fn = os.path.expanduser(groups)
+    if fn.endswith(('.bed','.bed.gz')): 
+        bed_df = pd.read_csv(fn, sep=r'\s+', header=None, comment='#', dtype={0: str})
+        bed_df = bed_df[~bed_df[0].isin(['track','browser'])]
+        chrom = bed_df[0].str.replace('^chr', '', regex=True).to_numpy(); start = bed_df[1].to_numpy(dtype='int64'); end = bed_df[2].to_numpy(dtype='int64')
+        name = bed_df[3].astype(str).to_numpy() if bed_df.shape[1] > 3 else np.char.add(np.char.add(chrom.astype(str), ':'), np.char.add(np.char.add(start.astype(str), '-'), end.astype(str)))
+        codes, names = pd.factorize(pd.Series(name), sort=True)
+        vchrom = df['chrom'].astype(str).str.replace('^chr', '', regex=True); vpos = df['pos'].to_numpy(dtype='int64')
+        layer = _get_interval_layers(chrom, start, end); rows = []; gidx = []
+        for k in range(layer.max()+1 if len(layer) else 0): # Within a layer the intervals do not overlap, (start, end] is [start+1, end+1)
+            sel = np.flatnonzero(layer == k)
+            idx = get_intervalidx(vchrom, vpos, ichrom=chrom[sel], start=start[sel]+1, stop=end[sel]+1)
+            ind = idx >= 0; rows += [np.flatnonzero(ind)]; gidx += [codes[sel][idx[ind]]]
+        rows = np.concatenate(rows or [np.zeros(0, dtype='int64')]); gidx = np.concatenate(gidx or [np.zeros(0, dtype='int64')])
+    else:
+        ann_df = pd.read_csv(fn, sep=r'\s+', dtype=str)
+        assert {'snp','group'} <= set(ann_df.columns), f'The annotation file {fn} needs snp & group columns (or be a BED file).'
+        codes, names = pd.factorize(ann_df['group'], sort=True)
+        ridx = pd.Index(df['snp'].astype(str)).get_indexer(ann_df['snp']); ind = ridx >= 0
+        rows = ridx[ind]; gidx = codes[ind]
+    rows, gidx = np.unique(np.stack([rows, gidx]), axis=1) # no double membership
+    return rows, gidx, [str(name) for name in names]
+
+def is_multitarget(target):
+    # A multi-file target: a list of files, a comma separated string of them or a '{chrom}' template (e.g. 'ukb_chr{chrom}').
+    return isinstance(target, (list, tuple)) or (isinstance(target, str) and ('{chrom}' in target or ',' in target))
+
+def get_target_fns(target, chroms=None):
+    # The files of a multi-file target as {chrom: fn}. A '{chrom}' template is filled in with chroms (default 1-22), the
+    # chromosomes without a file are skipped. For a list of files the chromosomes are taken from their variants.
+    def strip(fn): return fn[:-4] if fn.split('.')[-1] in ('bed','bim','fam') else fn
+    def exists(fn): return os.path.isfile(fn + '.bed') or (fn.endswith('.bgen') and os.path.isfile(fn))
+    if isinstance(target, str) and '{chrom}' in target:
+        chroms = [str(c) for c in (range(1, 23) if chroms is None else chroms)]
+        fn_dt = {c: strip(target.format(chrom=c)) for c in chroms if exists(strip(target.format(chrom=c)))}
+        if len(fn_dt) == 0: raise FileNotFoundError(f'No target files found for template {target} (chromosomes {", ".join(chroms)}).')
+        return fn_dt
+    fn_dt = {}
+    for fn in (target.split(',') if isinstance(target, str) else target):
+        fn = strip(fn)
+        if fn.endswith('.bgen'): cur = load_bed(fn).bim_df['chrom']
+        else: cur = pd.read_csv(fn + '.bim', sep=r'\s+', header=None, usecols=[0], dtype=str)[0]
+        for c in cur.astype(str).unique():
+            if c in fn_dt: raise Exception(f'Chromosome {c} is present in multiple target files ({fn_dt[c]} and {fn}), this is not allowed.')
+            fn_dt[c] = fn
+    return fn_dt
+
+def check_target_fams(fns):
+    # All files of a multi-file target need the same induviduals in the same order, since their scores are summed.
+    first = None
+    for fn in fns:
+        if fn.endswith('.bgen'): continue # Checked on the predictions (their index)
+        fam_df = load_bimfam(fn, bim=False)[1][['fid','iid']].astype(str)
+        if first is None: first = (fn, fam_df); continue
+        if not fam_df.reset_index(drop=True).equals(first[1].reset_index(drop=True)):
+            raise Exception(f'The induviduals (fid/iid) in the fam of {fn} differ from those of {first[0]} (or are in another order). '
+                            'All files of a multi-file target need the exact same induviduals in the same order.')
+
+def load_variants(fn):
+    # A variant list: a bim file or a (whitespace separated) headed file with a snp/rsid/id column and optionally A1/A2 alleles,
+    # or a plain list of variant ids without header.
+    if fn.endswith('.bim'): return load_bimfam(fn[:-4], fam=False)[0]
+    df = pd.read_csv(os.path.expanduser(fn), sep=r'\s+', dtype=str)
+    names = {'snp':'snp','rsid':'snp','id':'snp','variant_id':'snp','a1':'A1','effect_allele':'A1','a2':'A2','other_allele':'A2'}
+    cols = {col: names[col.lstrip('#').lower()] for col in df.columns if col.lstrip('#').lower() in names}
+    if not 'snp' in cols.values(): return pd.read_csv(os.path.expanduser(fn), sep=r'\s+', header=None, usecols=[0], names=['snp'], dtype=str)
+    return df.rename(columns=cols)
+
+def _get_extract_fn(base_fn): return base_fn + '.prstextract.json'
+
+def extract_bed(bed, variants_df, out, *, rsidmode='auto', block_mb=64, verbose=True):
+    # Writes the target variants that match variants_df as a compact plink fileset out.{bed,bim,fam} plus a manifest
+    # (out.prstextract.json) with the source bed its fingerprint & the variant set. Matching is done with merge_snps() on
+    # snp id & alleles (snp id only if variants_df has no alleles). The packed bed rows are copied as they are, no decoding.
+    import json
+    bim_df = validate_dataframe_rsids(bed.bim_df.copy(), rsidmode=rsidmode)
+    if {'A1','A2'} <= set(variants_df.columns):
+        cur_df = variants_df[['snp','A1','A2']].drop_duplicates()
+        cur_df = merge_snps(cur_df, bim_df, flipcols=[], req_all_right=False, handle_missing='filter', engine='auto')
+        xidx = np.unique(cur_df['xidx'].to_numpy(dtype='int64'))
+    else: xidx = np.flatnonzero(bim_df['snp'].isin(variants_df['snp']).to_numpy())
+    if len(xidx) == 0: raise Exception('None of the variants in the variant list are present in the target, nothing to extract.')
+    nbytes = (bed.iid_count + 3)//4; n_inblock = max(1, int(block_mb*2**20/nbytes))
+    if verbose: print(f'Extracting {len(xidx):,} of {bed.sid_count:,} variants ({len(xidx)*nbytes/2**20:,.1f} MB) to: {out}.bed', end=' ', flush=True)
+    def to_file(tmp_fn):
+        with open(tmp_fn, 'wb') as f:
+            f.write(bytes([0x6c, 0x1b, 0x01]))
+            for start in range(0, len(xidx), n_inblock): f.write(read_bed_packed(bed, xidx[start:start+n_inblock]).tobytes())
+    _pd_to_atomizer(to_file=to_file, fn=out + '.bed')
+    save_bim(bed.bim_df.iloc[xidx], fn=out + '.bim', verbose=False)
+    save_fam(bed.fam_df, fn=out + '.fam', verbose=False)
+    manifest = dict(source=os.path.abspath(str(bed.location)), source_key=_get_targetstats_key(bed), n_source_variants=bed.sid_count,
+                    n_variants=int(len(xidx)), n_list=int(variants_df.shape[0]), varhash=str(pd.util.hash_pandas_object(bed.bim_df.iloc[xidx][['snp','A1','A2']], index=False).sum()),
+                    created=str(pd.Timestamp.now()), version=prst.__version__)
+    def to_file(tmp_fn):
+        with open(tmp_fn, 'w') as f: json.dump(manifest, f, indent=2)
+    _pd_to_atomizer(to_file=to_file, fn=_get_extract_fn(out))
+    if verbose: print('-> Done')
+    return manifest
+
+def check_extract(base_fn):
+    # If base_fn is an extract (see extract_bed()), warn when its source bed changed after the extraction.
+    fn = _get_extract_fn(base_fn)
+    if not os.path.isfile(fn): return None
+    import json
+    with open(fn) as f: manifest = json.load(f)
+    if os.path.isfile(manifest['source']):
+        st = os.stat(manifest['source']) # size & mtime part of the key, so the (possibly huge) source bim/fam are not read
+        if f'{st.st_size}_{st.st_mtime_ns}' != '_'.join(manifest['source_key'].split('_')[:2]):
+            prst.warn(f'The source of extract {base_fn} ({manifest["source"]}) changed after the extraction. Rerun \'prst extract\' to update it.')
+    return manifest
+
+def iter_bed_chunks(bed, xidx, *, n_inchunk=1000, dtype='int8', prefetch=2, n_threads=1, adaptive=True, max_secs=2.,
+                    min_inchunk=64, max_chunk_mb=512, start=0, iidx=None):
+    # Yields (start, stop, X) in order, with X the genotypes of variants xidx[start:stop]. With prefetch>0, background reader
+    # thread(s) fill a bounded queue (at most prefetch+n_threads decoded chunks in memory) so disk/decoding overlaps with the
+    # compute done by the consumer. With adaptive=True the chunk size is tuned on the measured read throughput (variants/sec):
+    # it is doubled (or else halved) while that improves >10% and then fixed at the best size found. Chunks are capped
+    # at max_secs of read time and at max_chunk_mb, counted as float64 since that is what consumers typically materialize.
+    # Use start to skip the first variants (e.g. when resuming). With dtype='packed' X holds the raw bed bytes (variants x bytes).
+    # iidx (sorted sample rows, see get_sample_index()) restricts the reads to those samples, X then has len(iidx) rows.
+    import threading, queue
+    xidx = np.asarray(xidx); p = len(xidx)
+    assert iidx is None or dtype != 'packed', 'Sample subsetting (iidx) is not available for packed reads.'
+    rows = np.s_[:] if iidx is None else np.asarray(iidx)
+    max_inchunk = max(min_inchunk, int(max_chunk_mb*2**20/(max(bed.iid_count if iidx is None else len(rows), 1)*8)))
+    state = dict(start=int(start), n=int(min(max(n_inchunk, 1), max_inchunk)), seq=0, factor=2., best_n=None, best_rate=0.)
+    def next_range():
+        start = state['start']; stop = min(start + state['n'], p); state['start'] = stop
+        seq = state['seq']; state['seq'] += 1
+        return seq, start, stop
+    def adapt(n, secs):
+        if not adaptive or secs <= 0 or n < state['n'] or state['factor'] == 1.: return # last (short) chunk or search done
+        rate = n/secs
+        if rate > 1.1*state['best_rate']: state['best_rate'] = rate; state['best_n'] = n
+        elif state['factor'] > 1 and state['best_n'] == n//2: state['factor'] = 0.5 # growing did not help, try shrinking once
+        else: state['factor'] = 1. # no improvement anymore, settle
+        newn = state['best_n']*state['factor'] if state['factor'] != 1. else state['best_n']
+        if secs > max_secs: newn = min(newn, n*max_secs/secs)
+        state['n'] = int(min(max(newn, min_inchunk, 1), max_inchunk))
+        if state['n'] == n and state['factor'] != 1.: state['factor'] = 1. # hit a bound
+    def read(start, stop):
+        tic = time.perf_counter()
+        X = read_bed_packed(bed, xidx[start:stop]) if dtype == 'packed' else bed.read(index=np.s_[rows, xidx[start:stop]], dtype=dtype)
+        adapt(stop-start, time.perf_counter() - tic)
+        return X
+
+    if not prefetch: # Synchronous, no threads.
+        while state['start'] < p:
+            _, start, stop = next_range()
+            yield start, stop, read(start, stop)
+        return
+
+    lock = threading.Lock(); q = queue.Queue(maxsize=prefetch); stop_evt = threading.Event()
+    def put(item):
+        while not stop_evt.is_set():
+            try: q.put(item, timeout=0.1); return
+            except queue.Full: continue
+    def worker():
+        try:
+            while not stop_evt.is_set():
+                with lock:
+                    if state['start'] >= p: break
+                    seq, start, stop = next_range()
+                put((seq, start, stop, read(start, stop)))
+        except BaseException as e: put(e)
+        finally: put(None)
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(max(int(n_threads), 1))]
+    for thread in threads: thread.start()
+    pending = dict(); nxt = 0; n_done = 0
+    try:
+        while n_done < len(threads) or pending:
+            if nxt in pending: # Chunks are yielded in order, even if multiple reader threads finish out of order.
+                start, stop, X = pending.pop(nxt); nxt += 1
+                yield start, stop, X; continue
+            item = q.get()
+            if item is None: n_done += 1
+            elif isinstance(item, BaseException): raise item
+            else: pending[item[0]] = item[1:]
+    finally:
+        stop_evt.set()
+        for thread in threads: thread.join()
+
+def _targetstats_counts(location, iid_count, sid_count, start, stop):
+    # Worker for compute_targetstats(): plink code counts for variants start:stop, with its own memory map of the bed.
+    from prstools.models._compute import get_packed_counts
+    from types import SimpleNamespace
+    bed = SimpleNamespace(location=location, iid_count=iid_count, sid_count=sid_count)
+    return start, get_packed_counts(read_bed_packed(bed, np.arange(start, stop)), iid_count)
+
+def compute_targetstats(bed, *, n_inchunk=20000, n_jobs=1, verbose=False):
+    # Per-variant hard-call counts, A1 allele frequency & missing rate of every variant of a plink bed, from the packed bytes 
+    # (no decoding) in parallel chunks. Rows follow the bim (i.e. xidx).
+    from joblib import Parallel, delayed
+    if verbose: print(f'Computing target variant statistics ({bed.sid_count:,} variants, {n_jobs} workers)', end=' ', flush=True)
+    counts = np.zeros((bed.sid_count, 4), dtype=np.int64)
+    ranges = [(start, min(start+n_inchunk, bed.sid_count)) for start in range(0, bed.sid_count, n_inchunk)]
+    for start, cnts in Parallel(n_jobs=n_jobs)(delayed(_targetstats_counts)(str(bed.location), bed.iid_count, bed.sid_count, start, stop) for start, stop in ranges):
+        counts[start:start+len(cnts)] = cnts
+    if verbose: print('-> Done')
+    return _get_targetstats_df(counts, bed)
+
+def _get_targetstats_df(counts, bed):
+    stats_df = bed.bim_df[['chrom','snp','pos','A1','A2']].copy() if hasattr(bed, 'bim_df') else pd.DataFrame(index=np.arange(counts.shape[0]))
+    for j, col in enumerate(['n_homA1','n_miss','n_het','n_homA2']): stats_df[col] = counts[:,j]
+    n_obs = np.maximum(bed.iid_count - counts[:,1], 1)
+    stats_df['af_A1'] = (2*counts[:,0] + counts[:,2])/(2*n_obs)
+    stats_df['miss_rate'] = counts[:,1]/max(bed.iid_count, 1)
+    stats_df['mean'] = 2*stats_df['af_A1'] # mean A1 count of the observed genotypes, used for imputation
+    return stats_df
+
+def _get_targetstats_fn(bed):
+    location = str(bed.location)
+    return (location[:-4] if location.endswith('.bed') else location) + '.prsttargetstats.npz'
+
+def _get_targetstats_key(bed):
+    # Identifies the exact bed file the stats belong to (size & modification time, and dimensions).
+    st = os.stat(bed.location); return f'{st.st_size}_{st.st_mtime_ns}_{bed.iid_count}_{bed.sid_count}'
+
+def save_targetstats(stats_df, bed, fn=None, verbose=True):
+    # Compact sidecar (npz with the int32 code counts) next to the bed, keyed by the bed file its size/mtime.
+    fn = _get_targetstats_fn(bed) if fn is None else fn
+    counts = stats_df[['n_homA1','n_miss','n_het','n_homA2']].to_numpy(dtype=np.int32)
+    if verbose: print(f'Saving target variant statistics to: {fn}', end=' ', flush=True)
+    def to_file(tmp_fn):
+        with open(tmp_fn, 'wb') as f: np.savez_compressed(f, key=np.array(_get_targetstats_key(bed)), counts=counts)
+    try: _pd_to_atomizer(to_file=to_file, fn=fn)
+    except OSError as e: prst.warn(f'Could not store the target variant statistics ({e}).'); return None
+    if verbose: print('-> Done')
+    return fn
+
+def load_targetstats(bed, fn=None, verbose=False):
+    # Returns the stats of the sidecar, or None if there is none or if it belongs to another version of the bed file.
+    fn = _get_targetstats_fn(bed) if fn is None else fn
+    if not os.path.isfile(fn): return None
+    with np.load(fn) as npz: key = str(npz['key']); counts = npz['counts'].astype(np.int64)
+    if key != _get_targetstats_key(bed):
+        prst.warn(f'Target statistics {fn} do not match the current bed file (it changed), so they are not used. Rerun \'prst targetstats\'.')
+        return None
+    if verbose: print(f'Using target variant statistics: {fn}')
+    return _get_targetstats_df(counts, bed)
+
 def load_srd(fn, make_bimfam_attrs=True, countA12correct=True, verbose=False, start_string='Loading plink files (@ {fn}). '):
     if verbose:
         from prstools.utils import AutoDict
@@ -1504,6 +2551,22 @@ def _pd_to_atomizer(*, to_file, fn, **kwg):
             try: os.remove(tmp_fn)
             except OSError: pass
 
+def save_checkpoint(fn, *, hash, **arrays):
+    # Atomic npz write, so a crash during saving never leaves a broken checkpoint behind.
+    def to_file(tmp_fn):
+        with open(tmp_fn, 'wb') as f: np.savez(f, hash=np.array(hash), **arrays)
+    _pd_to_atomizer(to_file=to_file, fn=fn)
+
+def load_checkpoint(fn, *, hash=None, verbose=False):
+    # Returns the checkpoint contents as a dict, or None if there is no checkpoint or it was made with other inputs.
+    if not fn or not os.path.isfile(fn): return None
+    with np.load(fn) as npz: ckpt_dt = {key: npz[key] for key in npz.files}
+    if hash is not None and str(ckpt_dt['hash']) != hash:
+        prst.warn(f'Checkpoint {fn} was made with different inputs (weights/target changed), so it is ignored and the computation starts over.')
+        return None
+    if verbose: print(f'Resuming from checkpoint: {fn}')
+    return ckpt_dt
+
 def save_bim(bim_df, fn=None, ommitcm=False, verbose=True):
     assert fn is not None
     assert ommitcm is False, 'not implemented' 
@@ -1549,24 +2612,75 @@ def save_sst(sst_df, fn=None, return_sst=False, ftype='tsv', basecols=None, addi
     if verbose: print(f'-> Done')
     if return_sst: return out_df
 
-def save_prs(yhat, *, fn, ftype='prstprs.tsv', nanwarn=True, verbose=False, reset_index=True, end='\n\n'):
-    assert type(yhat) is pd.DataFrame, f'Input \'yhat\' is required to be pd.DataFrame. It is currently: {type(yhat)}'
-    if reset_index: yhat = yhat.reset_index(drop=False) # With this the FID and IID become columns
-    #yhat = yhat.rename(columns=dict(fid='FID',iid='IID')) why these names...
-    if ftype == 'prstprs.tsv':
-        sep='\t'
-        to_file = yhat.to_csv
-    else:
-        raise ValueError(f"'{ftype}' is not a valid filetype/ftype. only 'prstprs.tsv' availabe atm")
+_prs_ftypes = {'.tsv':'prstprs.tsv', '.parquet':'prstprs.parquet', '.feather':'prstprs.feather', '.npy':'prstprs.npy', '.h5':'prstprs.h5', '.hdf5':'prstprs.h5'}
 
+def save_prs(yhat, *, fn, ftype='prstprs.tsv', nanwarn=True, verbose=False, reset_index=True, block_cols=64, end='\n\n'):
+    # Stores the prediction (samples x scores) with fid & iid as the first columns. The format follows ftype, or the extension
+    # of fn if it has one of: .tsv, .parquet, .feather (arrow ipc), .npy (structured array, np.load(fn, mmap_mode='r') gives 
+    # columns without a full read) or .h5/.hdf5 (h5py: fid, iid, columns & a chunked prs matrix). The binary formats are filled
+    # from the score columns in groups of block_cols, so there is no full (text or frame) copy of hundreds of columns.
+    assert type(yhat) is pd.DataFrame, f'Input \'yhat\' is required to be pd.DataFrame. It is currently: {type(yhat)}'
+    if ftype not in _prs_ftypes.values(): raise ValueError(f"'{ftype}' is not a valid filetype/ftype. Options: {', '.join(sorted(set(_prs_ftypes.values())))}")
     fn = fn.format_map(dict(ftype=ftype)) # Maybe some AutoDict buzz here later.
-    #import uuid; tmp_fn = f"{fn}.incomplete.{uuid.uuid4().hex[:16]}"  # unique temp file name  
+    ftype = _prs_ftypes.get(os.path.splitext(fn)[1].lower(), ftype)
+    if reset_index: ids = yhat.index.to_frame(index=False).astype(str); scores = yhat
+    else: ids = yhat[['fid','iid']].astype(str); scores = yhat.drop(columns=['fid','iid'])
+    names = [str(col) for col in scores.columns]
+    def blocks():
+        for start in range(0, scores.shape[1], block_cols): yield start, scores.iloc[:, start:start+block_cols].to_numpy(dtype='float64')
+    if ftype == 'prstprs.tsv':
+        def to_file(tmp_fn): pd.concat([ids, scores.reset_index(drop=True)], axis=1).to_csv(tmp_fn, sep='\t', index=False)
+    elif ftype in ('prstprs.parquet','prstprs.feather'):
+        import pyarrow as pa
+        def to_file(tmp_fn):
+            arrays = [pa.array(ids[col].to_numpy()) for col in ids.columns]
+            for _, X in blocks(): arrays += [pa.array(np.ascontiguousarray(X[:,j])) for j in range(X.shape[1])] # zero-copy per column
+            table = pa.Table.from_arrays(arrays, names=list(ids.columns) + names)
+            if ftype == 'prstprs.parquet': import pyarrow.parquet as pq; pq.write_table(table, tmp_fn)
+            else: import pyarrow.feather as pf; pf.write_feather(table, tmp_fn)
+    elif ftype == 'prstprs.npy':
+        def to_file(tmp_fn):
+            dtype = [(col, f'U{max(ids[col].str.len().max(), 1)}') for col in ids.columns] + [(name, 'f8') for name in names]
+            with open(tmp_fn, 'wb') as f: # np.lib.format.open_memmap appends .npy to unknown extensions, so via a file object
+                np.lib.format.write_array_header_1_0(f, dict(descr=np.dtype(dtype).descr, fortran_order=False, shape=(len(ids),)))
+                offset = f.tell()
+            arr = np.memmap(tmp_fn, dtype=dtype, mode='r+', offset=offset, shape=(len(ids),))
+            for col in ids.columns: arr[col] = ids[col].to_numpy()
+            for start, X in blocks():
+                for j in range(X.shape[1]): arr[names[start+j]] = X[:,j]
+            arr.flush(); del arr
+    elif ftype == 'prstprs.h5':
+        import h5py
+        def to_file(tmp_fn):
+            with h5py.File(tmp_fn, 'w') as f:
+                for col in ids.columns: f.create_dataset(col, data=ids[col].to_numpy().astype('S'))
+                f.create_dataset('columns', data=np.array(names, dtype='S'))
+                n_rows = -(-len(ids)//max(-(-len(ids)//2**16), 1)) # <=2**16 rows per chunk, evenly split so there is no padding
+                dset = f.create_dataset('prs', shape=scores.shape, dtype='f8', chunks=(n_rows or 1, min(block_cols, scores.shape[1]) or 1))
+                for start, X in blocks(): dset[:, start:start+X.shape[1]] = X
     if verbose: print(f'Saving prediction (i.e. PRS) to: {fn}', end=' ')
-    _pd_to_atomizer(to_file=to_file, fn=fn, sep=sep, index=False)
-    #to_file(tmp_fn, sep=sep, index=False)
-    #os.replace(tmp_fn, fn) # atomically move into place
+    _pd_to_atomizer(to_file=to_file, fn=fn)
     if verbose: print(f'-> Done', end=end)
 
+def load_prs(fn, columns=None):
+    # Reads a prediction stored by save_prs() (format by extension) into a frame with fid & iid as the first columns.
+    # With columns only those scores are read (the binary formats do so without reading the others).
+    ftype = _prs_ftypes.get(os.path.splitext(fn)[1].lower(), 'prstprs.tsv')
+    if ftype == 'prstprs.tsv':
+        df = pd.read_csv(fn, sep='\t', dtype={'fid':str, 'iid':str})
+        return df if columns is None else df[['fid','iid'] + list(columns)]
+    if ftype == 'prstprs.parquet': return pd.read_parquet(fn, columns=None if columns is None else ['fid','iid'] + list(columns))
+    if ftype == 'prstprs.feather': return pd.read_feather(fn, columns=None if columns is None else ['fid','iid'] + list(columns))
+    if ftype == 'prstprs.npy':
+        arr = np.load(fn, mmap_mode='r'); columns = [name for name in arr.dtype.names[2:]] if columns is None else list(columns)
+        return pd.DataFrame({col: np.asarray(arr[col]) for col in ['fid','iid'] + columns})
+    import h5py
+    with h5py.File(fn, 'r') as f:
+        names = f['columns'][:].astype(str).tolist(); jdx = np.arange(len(names)) if columns is None else np.array([names.index(col) for col in columns])
+        df = pd.DataFrame(f['prs'][:, np.sort(jdx)] if len(jdx) else np.zeros((len(f['iid']), 0)), columns=[names[j] for j in np.sort(jdx)])
+        df.insert(0, 'iid', f['iid'][:].astype(str)); df.insert(0, 'fid', f['fid'][:].astype(str))
+    return df if columns is None else df[['fid','iid'] + list(columns)]
+
 if not '__file__' in locals():
     import sys
     if np.all([x in sys.argv[-1] for x in ('jupyter','.json')]+['ipykernel_launcher.py' in sys.argv[0]]):
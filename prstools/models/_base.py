@@ -5,7 +5,7 @@ import numpy as np
 import pandas as pd
 from scipy import linalg, stats
 import prstools as prst
-from prstools.models._compute import dpsi, gigrnd, g
+from prstools.models._compute import dpsi, gigrnd, g, score_i8sparse, score_i8fixed, ScoreAccumulator, get_score_error_bound, score_bed_tiled, score_packed_lut, _add_matmul, _scale_rows
 from prstools.utils import PRSTCLI
 try:
     from fastcore.script import call_parse, Param
@@ -44,7 +44,7 @@ class BasePred(ABC):
     _close_pbar = True
     _default_n_jobs=8
     _allow_missing=True
-    algo_pred = 'i8fast'
+    algo_pred = 'i8fast' # 'i8sparse' (see score_i8sparse) is opt-in, and used when a path requires it (n_jobs != 1, dtype='int16')
     _display_info = True
     
     def _checktype(self, obj, classname): # This methods needs some work
@@ -467,12 +467,15 @@ class BasePred(ABC):
         sst_lst += [chunk_sst_df]
         return stuff
     
-    def predict(self, bed, *, n_inchunk=1000, groupby=None, validate=True, dtype=None, algo=None, rsidmode='auto',
-                localdump=False, weight_type='allele', trait_df=None, colour='#7f00ff'): # <-- The more esotheric stuff on this line
+    def predict(self, bed, *, n_inchunk=1000, groupby=None, validate=True, dtype=None, algo=None, rsidmode='auto', prefetch=2, adaptive=True, n_jobs=1,
+                keep=None, remove=None, partial=None, loco=False, checkpoint=None, checkpoint_secs=300, varindex=True, targetstats='auto', n_jobs_files=1, min_maf=None, max_miss=None, localdump=False, weight_type='allele', trait_df=None, colour='#7f00ff'): # <-- The more esotheric stuff on this line
         
         if 'pysnptools' in str(type(bed)):
             srd = bed; del bed
             return self.srdpredict(**locals())
+        if prst.io.is_multitarget(bed): # e.g. one bed file per chromosome, see _predict_multifile()
+            kwg = {key: item for key, item in locals().items() if not key in ('self','bed')}
+            return self._predict_multifile(bed, **kwg)
         if type(bed) is str:
             if self.verbose: print('Input to predict() is a string and perhaps a filepath. Trying to load..')
             bed = prst.io.load_bed(bed,verbose=self.verbose)
@@ -483,23 +486,42 @@ class BasePred(ABC):
         if algo != 'ori': assert weight_type == 'allele'
         if trait_df is not None: assert localdump
         weights_df = self.get_weights()
-        if len(weights_df['allele_weight'].shape) == 1: n_traits = 1
+        sparse_W = getattr(self, 'sparse_weights_', None) # csr (variants x weights), see BaseMulti.from_dict(sparse=True)
+        sparse_names = getattr(self, 'sparse_names_', None)
+        if partial is not None: # Partial scores per variant group (e.g. chrom) in the same single pass, via a sparse (variants x groups) weight matrix
+            assert sparse_W is None, 'Partial scores (partial) are not available for sparse multi-weights.'
+            sparse_W, sparse_names = self._get_partial_weights(weights_df, 'chrom' if partial is True else partial)
+        if sparse_W is not None:
+            assert groupby is None and weight_type == 'allele', 'Sparse weights require groupby=None and weight_type=\'allele\'.'
+            n_traits = sparse_W.shape[1]; weights_df = weights_df.assign(widx=np.arange(weights_df.shape[0]))
+        elif len(weights_df['allele_weight'].shape) == 1: n_traits = 1
         else: n_traits = weights_df['allele_weight'].shape[1]  
         if self.verbose: print(f'Predicting {n_traits} phenotype(s) i.e. generating PRS, in chucks of {n_inchunk} snps. ', flush=True, end='')
         dtype = self.dtype_pred if dtype is None else dtype
+        if getattr(bed, 'dosage', False): # Dosage targets (e.g. bgen) have no int8 hard calls, so the float path is used
+            assert algo in (None, 'ori') and n_jobs == 1, 'Dosage targets (e.g. bgen) require algo=\'ori\' and n_jobs=1.'
+            algo = 'ori'
+        if algo is None and (n_jobs != 1 or str(dtype) == 'int16'): algo = 'i8sparse' # The tiled & fixed point kernels are i8sparse based
         algo  = self.algo_pred if algo is None else algo
+        iidx = prst.io.get_sample_index(bed.fam_df, keep=keep, remove=remove, verbose=self.verbose) # Sorted sample rows to read & score, None is all
+        if iidx is not None: assert algo != 'lut' and trait_df is None, 'Sample selection (keep/remove) is not available for algo=\'lut\' or with trait_df.'
+        n_iid = bed.iid_count if iidx is None else len(iidx)
         msg = ''
         
         if validate:
-            bim_df = bed.bim_df.copy() # For the next line did it the other way around for mem-footprint.
-            bim_df = prst.io.validate_dataframe_rsids(bim_df, rsidmode=rsidmode)
             weights_df = weights_df.drop(columns='xidx', errors='ignore') # Make sure it does not have xidx by chance.
             p_pre = weights_df.shape[0]
-            weights_df = prst.merge_snps(weights_df, bim_df, req_all_right=False, handle_missing='filter', flipcols=[]) ## HEY WAIT... WHAT!!!
+            if varindex: # Lookups in a hashed index of the target variants instead of merging with the full bim, varindex='save' also stores it next to the target
+                index_dt = prst.io.load_varindex(bed, rsidmode=rsidmode, save=varindex == 'save', verbose=self.verbose)
+                weights_df = prst.io.match_snps_index(weights_df, bed, index_dt)
+            else:
+                bim_df = bed.bim_df.copy() # For the next line did it the other way around for mem-footprint.
+                bim_df = prst.io.validate_dataframe_rsids(bim_df, rsidmode=rsidmode)
+                weights_df = prst.merge_snps(weights_df, bim_df, req_all_right=False, handle_missing='filter', flipcols=[], engine='auto') ## HEY WAIT... WHAT!!!
             #prst.utils.get_ip().embed()
             #weights_df['allele_weight']=weights_df['allele_weight']*weights_df['rflip'] # 20TB crash..
             #weights_df['allele_weight']=weights_df[['allele_weight']]*weights_df[['rflip']] # nans
-            weights_df['allele_weight']=weights_df['allele_weight'].mul(weights_df['rflip'], axis=0) # This is a bit of a hack
+            if sparse_W is None: weights_df['allele_weight']=weights_df['allele_weight'].mul(weights_df['rflip'], axis=0) # This is a bit of a hack
             weights_df['xidx'] = weights_df['xidx'].astype('int64', errors='ignore')
             assert weights_df['xidx'].dtype == 'int64', 'xidx contained a nan, this should not happen for regular users, contact dev'
             weights_df = weights_df.sort_values('xidx')
@@ -509,64 +531,221 @@ class BasePred(ABC):
             if n_missing > 0: msg += f'\nMissing {n_missing:,} variants ({perc:.0f}%) in the target that are in the weights{inject}.'
             if n_missing > 0 and not self._allow_missing: raise RuntimeError(msg)
         if self.verbose or n_missing > 0: print(msg)
+        stats_df = self._get_targetstats(bed, targetstats, required=bool(min_maf) or max_miss is not None)
+        if min_maf or max_miss is not None: # Filtering on the target variant statistics
+            cur_df = stats_df.iloc[weights_df['xidx'].to_numpy()]
+            ind = (np.minimum(cur_df['af_A1'], 1 - cur_df['af_A1']) >= (min_maf or 0.)) & (cur_df['miss_rate'] <= (1. if max_miss is None else max_miss))
+            if self.verbose or not ind.all(): print(f'Filtering on target variant statistics (min_maf={min_maf}, max_miss={max_miss}) removed {(~ind).sum():,} variants.')
+            weights_df = weights_df[ind.to_numpy()]
+        stats_mean = stats_df['mean'].to_numpy() if stats_df is not None and iidx is None else None # For mean imputation, instead of per chunk means (those are over the scored samples)
+        if sparse_W is not None: # Pick the matched rows (in target order) & flip them, this stays sparse
+            rflip = weights_df['rflip'].to_numpy(dtype='float64') if 'rflip' in weights_df.columns else np.ones(weights_df.shape[0])
+            sparse_W = _scale_rows(sparse_W[weights_df['widx'].to_numpy()], rflip)
         
         # Loop through Genome:
         yhat_dt = dict(); sst_dt = {}; X=None; self._msksumlst = []
-        if len(weights_df['allele_weight'].shape) == 1: n_traits = 1
-        else: n_traits = weights_df['allele_weight'].shape[1]  
         #for itr in self.get_iterator(range(n_iter), pbar=self.pbar)
+        if algo not in ('ori','i8fast','i8sparse','lut'): raise ValueError(f"Unknown algorithm: {algo}")
+        fixed = str(dtype) == 'int16' # int8 x int16 fixed point scoring, see score_i8fixed()
+        if fixed: assert algo == 'i8sparse' and n_jobs == 1, 'Fixed point scoring (dtype=\'int16\') requires algo=\'i8sparse\' and n_jobs=1.'
+        errbnd_dt = {}
+        ckpt_dt = None; offset = 0
+        if checkpoint: # Running yhat & the number of finished variants are stored every checkpoint_secs, and resumed from if inputs are unchanged
+            assert groupby is None and n_jobs == 1 and trait_df is None, 'checkpoint is only possible with groupby=None, n_jobs=1 and no trait_df.'
+            ckpt_hash = self._get_predict_hash(weights_df, bed, W=sparse_W, iidx=iidx, algo=algo, dtype=str(dtype), weight_type=weight_type)
+            ckpt_dt = prst.io.load_checkpoint(checkpoint, hash=ckpt_hash, verbose=self.verbose); ckpt_time = time.time()
         for grp, wgrp_df in self.get_iterator(weights_df.groupby(groupby), pbar=self.pbar, colour=colour) if groupby is not None else [(None, weights_df)]:
-            yhat = np.zeros((bed.iid_count, n_traits)); sst_lst = []
-            inner_pbar = self.pbar if grp is None else None
-            for start in self.get_iterator(range(0, wgrp_df.shape[0], n_inchunk), pbar=inner_pbar, colour=colour):
-                wchunk_df = wgrp_df.iloc[start:start+n_inchunk]
-                cxidx = wchunk_df['xidx']
-                if algo == 'ori':
-                    X = bed.read(index=np.s_[:,cxidx], dtype=dtype)
-                    m = np.nanmean(X, axis=0)
+            sst_lst = []; ryhat = None
+            if ckpt_dt is not None: ryhat = ckpt_dt['yhat']; offset = int(ckpt_dt['stop'])
+            if sparse_W is None:
+                w = wgrp_df['allele_weight']; w=w if type(w) is pd.DataFrame else w.to_frame(name='prs')
+            columns = w.columns if sparse_W is None else pd.Index(sparse_names)
+            Wgrp = w.to_numpy() if sparse_W is None else sparse_W # For the fixed point scale & the error bound
+            acc = ScoreAccumulator((n_iid, n_traits), dtype=dtype, yhat=ryhat, W=Wgrp) # float32: Kahan summation over the chunks
+            max_c = 0; n_chunks = 0
+            inner_pbar = self.pbar if grp is None else None # Pbar counts variants, since the chunk sizes adapt to the read throughput
+            pbar = None; chunks = []; mean_grp = stats_mean[wgrp_df['xidx'].to_numpy()] if stats_mean is not None else None
+            if n_jobs != 1: # Process-parallel scoring over (samples x variants) tiles, replaces the chunk loop below.
+                assert algo == 'i8sparse' and trait_df is None, 'n_jobs != 1 requires algo=\'i8sparse\' and no trait_df.'
+                if sparse_W is None: w = wgrp_df['allele_weight']; w=w if type(w) is pd.DataFrame else w.to_frame(name='prs')
+                tyhat, msksum = score_bed_tiled(bed, wgrp_df['xidx'].to_numpy(), w.to_numpy() if sparse_W is None else sparse_W, n_jobs=n_jobs, dtype=dtype, iidx=iidx, verbose=self.verbose)
+                acc.add(tyhat); self._msksumlst += [msksum]; max_c = wgrp_df.shape[0]; n_chunks = 1
+            else: # Genotype chunks are read-ahead by a background thread, so disk IO overlaps with the compute below:
+                pbar = self.get_pbar(range(wgrp_df.shape[0]), colour=colour, initial=offset) if inner_pbar is True else None
+                chunks = prst.io.iter_bed_chunks(bed, wgrp_df['xidx'].to_numpy(), n_inchunk=n_inchunk, prefetch=prefetch, adaptive=adaptive,
+                                                 dtype=dict(ori=dtype, lut='packed').get(algo, 'int8'), start=offset, iidx=iidx)
+            for start, stop, Xr in chunks:
+                wchunk_df = wgrp_df.iloc[start:stop]
+                if sparse_W is None: w = wchunk_df['allele_weight']; w=w if type(w) is pd.DataFrame else w.to_frame(name='prs')
+                wmat = w.to_numpy() if sparse_W is None else sparse_W[start:stop] # sparse: only the nonzero weights of the chunk are multiplied
+                mean = mean_grp[start:stop] if mean_grp is not None else None
+                yhat = acc.buffer(); max_c = max(max_c, stop-start); n_chunks += 1
+                if fixed: # int8 genotypes x int16 quantized weights, summed exactly in int64
+                    self._msksumlst += [score_i8fixed(Xr, wmat, acc.acc, yhat, scale=acc.scale, mean=mean)]
+                elif algo == 'i8sparse': # X@w straight on the int8 data, plus a sparse correction for the (mean imputed) missings
+                    self._msksumlst += [score_i8sparse(Xr, wmat, yhat, dtype=dtype, mean=mean)]
+                elif algo == 'lut': # Raw 2-bit packed bed bytes (memory mapped) scored with per-variant byte lookup tables
+                    msksum = stats_df['n_miss'].to_numpy()[wchunk_df['xidx'].to_numpy()] if mean is not None else None
+                    self._msksumlst += [score_packed_lut(Xr, bed.iid_count, wmat, yhat, dtype=dtype, mean=mean, msksum=msksum)]
+                elif algo == 'ori':
+                    X = Xr
+                    m = np.nanmean(X, axis=0) if mean is None else mean
                     idx = np.where(np.isnan(X))
                     s = np.nanstd(X, axis=0) if weight_type == 'standardized' else None
                     X[idx] = np.take(m, idx[1])
                 elif algo == 'i8fast':
-                    if X is None: X = bed.read(index=np.s_[:,cxidx], dtype=dtype)
-                    nsamp,_= X.shape
-                    X8 = bed.read(index=np.s_[:,cxidx], dtype='int8') # 17% -> 7k ukbafr run
+                    X8 = Xr # 17% -> 7k ukbafr run
+                    nsamp,_= X8.shape
                     mask = (X8 == -127)
-                    m = X8.sum(axis=0).astype(dtype)
                     msksum = mask.sum(axis=0).astype(dtype)
-                    m += msksum*127
-                    m /= (nsamp - msksum)
-                    try:
-                        assert X.shape == X8.shape
-                        np.copyto(X, X8)
-                    except: X = X8.astype(dtype)
+                    if mean is None:
+                        m = X8.sum(axis=0).astype(dtype)
+                        m += msksum*127
+                        m /= (nsamp - msksum)
+                    else: m = mean.astype(dtype)
+                    if X is None or X.shape != X8.shape: X = np.empty(X8.shape, dtype=dtype) # Reused over equally sized chunks
+                    np.copyto(X, X8)
                     for j in range(X.shape[1]): # <--- This one is faster!
                         X[mask[:, j], j] = m[j] # 13% -> 7k ukbafr run
                     self._msksumlst += [msksum]
                     # for i in range(X.shape[0]):
                     #     X[i, mask[i,:]] = m[mask[i,:]]
-                else: raise ValueError(f"Unknown algorithm: {algo}")
-                w = wchunk_df['allele_weight']; w=w if type(w) is pd.DataFrame else w.to_frame(name='prs')
-                if weight_type == 'standardized': w = s*w
-                ## np.matmul(X, B, out=Y), looked promising. 50% reduction in execution speed was not possible afterall
-                ## Seemed the crucial difference was in Y[:] = X@B vs Y+= X@B of which the latter is faster
-                ## Yes, Again! float32 appears 2x faster, pretty much exactly. Perhaps a sum binning... is it needed?
-                yhat += X@w.values.astype(X.dtype) #chunk_df['allele_weight'] # 45% -> 7k ukbafr run
+                if algo not in ('i8sparse','lut'):
+                    if weight_type == 'standardized': wmat = s[:,None]*wmat
+                    ## np.matmul(X, B, out=Y), looked promising. 50% reduction in execution speed was not possible afterall
+                    ## Seemed the crucial difference was in Y[:] = X@B vs Y+= X@B of which the latter is faster
+                    ## Yes, Again! float32 appears 2x faster, pretty much exactly. Perhaps a sum binning... is it needed?
+                    _add_matmul(yhat, X, wmat.astype(X.dtype)) # 45% -> 7k ukbafr run
+                acc.add(yhat)
                 if trait_df is not None: # Compute beta marginal too if required
                     self._compute_sst_inside_pred(**locals())
+                if pbar: pbar.update(stop-start)
+                if checkpoint and time.time() - ckpt_time >= checkpoint_secs:
+                    prst.io.save_checkpoint(checkpoint, hash=ckpt_hash, yhat=acc.value(), stop=stop); ckpt_time = time.time()
+            if pbar: pbar.close()
+            yhat = acc.value()
+            rel, absb = get_score_error_bound(dtype, Wgrp, n_inchunk=max_c, n_chunks=n_chunks)
+            errbnd_dt[grp] = pd.Series(absb, index=columns, name='abs_error_bound')
+            prstlogs.setdefault('predict_error_bound', {})[str(grp)] = dict(dtype=str(dtype), rel=float(rel), max_abs=float(np.max(absb, initial=0.)))
+            if self.verbose: print(f'Worst-case score error bound ({dtype}): {rel:.2e} relative to sum|x*w|, max absolute {np.max(absb, initial=0.):.2e}.')
+            if checkpoint and os.path.isfile(checkpoint): os.remove(checkpoint) # Done, so the checkpoint is not needed anymore
 
-            columns = w.columns # considering doing something special with ('prs',f'{colname}') here.. \newline
+            # Considering doing something special with ('prs',f'{colname}') for the columns here..
             # , but multiindex will give funny/bad-4-users prs pred files downstream so..
-            yhat = pd.DataFrame(yhat, index=pd.MultiIndex.from_arrays(bed.fam_df[['fid','iid']].values.T, names=["fid", "iid"]), columns=columns)
+            fam_df = bed.fam_df if iidx is None else bed.fam_df.iloc[iidx]
+            yhat = pd.DataFrame(yhat, index=pd.MultiIndex.from_arrays(fam_df[['fid','iid']].values.T, names=["fid", "iid"]), columns=columns)
             if trait_df is not None: sst_dt[grp] = pd.concat(sst_lst, axis=0)
             yhat_dt[grp] = yhat
 
         ## Also wondering if the yhat should be standardized to zero-one.. downstream applications?
         ## Some missingness stats here by analyzing msksum could be cute.
+        if partial is not None and loco: yhat = self._get_loco(yhat)
+        self.error_bound_ = errbnd_dt[None] if groupby is None else errbnd_dt
         output = yhat if groupby is None else yhat_dt
         if localdump: output=locals()
         return output
-            
+
+    def _predict_multifile(self, target, *, n_jobs_files=1, groupby=None, checkpoint=None, **kwg):
+        # Multi-file target (a list of files or a template like 'ukb_chr{chrom}'): the weights are split by chromosome, each file
+        # is scored in its own worker process (n_jobs_files of them at once, n_jobs is passed on to the scoring of each file) and the
+        # partial scores are summed here, after checking that all fams hold the same induviduals in the same order. A checkpoint is kept per file.
+        from joblib import Parallel, delayed
+        assert groupby is None and kwg.get('partial') is None, 'groupby and partial are not available for multi-file targets.'
+        weights_df = self.get_weights(); sparse_W = getattr(self, 'sparse_weights_', None)
+        chrom = weights_df['chrom'].astype(str).to_numpy()
+        fn_dt = prst.io.get_target_fns(target, chroms=pd.unique(chrom))
+        prst.io.check_target_fams(list(fn_dt.values()))
+        n_missing = (~np.isin(chrom, list(fn_dt.keys()))).sum()
+        if n_missing > 0:
+            msg = f'Missing {n_missing:,} variants ({n_missing/len(chrom)*100:.0f}%) of the weights, since their chromosome has no file in the target.'
+            if not self._allow_missing: raise RuntimeError(msg)
+            print(msg)
+        jobs = []; fns = []
+        for c, fn in fn_dt.items():
+            ind = chrom == c
+            if not ind.any(): continue
+            part = copy.copy(self) # A (shallow) copy with the weights of this chromosome, without linkage data
+            for attr in ('_linkdata','cache_dt'): part.__dict__.pop(attr, None)
+            part.weights_df = weights_df[ind].reset_index(drop=True); part.pbar = False; part.verbose = False
+            if sparse_W is not None: part.sparse_weights_ = sparse_W[np.flatnonzero(ind)]
+            ckpt = None if checkpoint is None else checkpoint[:-4] + f'.chr{c}.npz' if checkpoint.endswith('.npz') else f'{checkpoint}.chr{c}'
+            jobs += [delayed(_predict_file)(part, fn, dict(kwg, checkpoint=ckpt))]; fns += [fn]
+        if self.verbose: print(f'Scoring {len(jobs)} target files with {n_jobs_files} worker(s).', flush=True)
+        yhat = None; errbnd = 0.
+        for fn, (cur, cur_errbnd) in zip(fns, Parallel(n_jobs=n_jobs_files)(jobs)): # reduce, in file order
+            if yhat is None: yhat = cur.copy(); first = fn
+            elif not cur.index.equals(yhat.index): raise Exception(f'The induviduals of {fn} differ from those of {first} (or are in another order).')
+            else: yhat += cur
+            errbnd = errbnd + cur_errbnd
+        self.error_bound_ = errbnd
+        return yhat
+
+    @staticmethod
+    def _get_partial_weights(weights_df, partial):
+        # Sparse (variants x groups*traits) expansion of the weights for predict(partial=..): the column for (group, trait) holds
+        # the trait its weights of the variants in the group (see get_variant_groups). An 'all' group is added for LOCO scores.
+        W = weights_df['allele_weight']; traits = ['prs'] if W.ndim == 1 else [str(col) for col in W.columns]
+        W = W.to_numpy(dtype='float64').reshape(weights_df.shape[0], -1); p, K = W.shape
+        rows, gidx, names = prst.io.get_variant_groups(weights_df, partial)
+        rows = np.concatenate([rows, np.arange(p)]); gidx = np.concatenate([gidx, np.full(p, len(names))]); names = names + ['all']
+        r = np.repeat(rows, K); k = np.tile(np.arange(K), len(rows))
+        Wp = sp.sparse.csr_array((W[r, k], (r, np.repeat(gidx, K)*K + k)), shape=(p, len(names)*K)); Wp.eliminate_zeros()
+        return Wp, (names if K == 1 else [(name, trait) for name in names for trait in traits])
+
+    @staticmethod
+    def _get_loco(yhat):
+        # Leave-one-group-out scores from the partial scores of predict(partial=..): the 'all' score minus that of each group.
+        K = yhat['all'].shape[1] if yhat['all'].ndim == 2 else 1
+        part = yhat.drop(columns='all', level=0 if K > 1 else None)
+        return pd.DataFrame(np.tile(yhat['all'].to_numpy().reshape(-1, K), part.shape[1]//K) - part.to_numpy(), index=yhat.index, columns=part.columns)
+
+    def _get_targetstats(self, bed, targetstats='auto', required=False):
+        # Precomputed target variant statistics (see 'prst targetstats'): a frame, a sidecar filename or 'auto' (use the sidecar if present).
+        if isinstance(targetstats, pd.DataFrame): return targetstats
+        stats_df = None
+        if getattr(bed, 'dosage', False): assert not required, 'Filtering on target variant statistics is not available for dosage targets.'; return None
+        if targetstats: stats_df = prst.io.load_targetstats(bed, fn=None if targetstats == 'auto' else targetstats, verbose=self.verbose)
+        if stats_df is None and required: stats_df = prst.io.compute_targetstats(bed, verbose=self.verbose)
+        return stats_df
+
+    @staticmethod
+    def _get_predict_hash(weights_df, bed, W=None, iidx=None, **kwg):
+        # Fingerprint of the matched weights (target indices & flipped weights), the target bim, the sample selection and the settings.
+        import hashlib
+        sha = hashlib.sha1()
+        sha.update(weights_df['xidx'].to_numpy(dtype='int64').tobytes())
+        if W is None: sha.update(np.ascontiguousarray(weights_df['allele_weight'].to_numpy(dtype='float64')).tobytes())
+        else: [sha.update(np.ascontiguousarray(arr).tobytes()) for arr in (W.data, W.indices, W.indptr)] # sparse (csr) weights
+        sha.update(pd.util.hash_pandas_object(bed.bim_df[['chrom','snp','pos','A1','A2']], index=False).to_numpy().tobytes())
+        if iidx is not None: sha.update(b'iidx' + np.asarray(iidx, dtype='int64').tobytes())
+        sha.update(f'{bed.iid_count}|{sorted(kwg.items())}'.encode())
+        return sha.hexdigest()
+
+    def evaluate(self, yhat, pheno, *, metric='auto', binary='auto'):
+        # Scores all weight configurations (the columns of yhat, which predict() computes in one genotype pass)
+        # against a phenotype and stores the best one in self.selected_ for get_selected_weights().
+        if type(yhat) is dict: raise NotImplementedError('evaluate() with a groupby prediction is not possible, contact dev.')
+        metrics_df = prst.io.compute_prs_metrics(yhat, pheno, binary=binary)
+        if metric == 'auto': metric = 'auc' if 'auc' in metrics_df.columns else 'r2'
+        assert metric in metrics_df.columns, f'Metric \'{metric}\' not available, choose from: {", ".join(metrics_df.columns)}'
+        metrics_df['selected'] = metrics_df.index == metrics_df[metric].idxmax()
+        self.metrics_df = metrics_df; self.selected_ = metrics_df[metric].idxmax()
+        return metrics_df
+
+    def get_selected_weights(self, col=None, dropzeros=True):
+        weights_df = self.get_weights(); sparse_W = getattr(self, 'sparse_weights_', None)
+        if sparse_W is None and len(weights_df['allele_weight'].shape) == 1: return weights_df.copy()
+        if col is None: col = getattr(self, 'selected_', None)
+        assert col is not None, 'No weight configuration selected yet, run evaluate() first or specify col.'
+        if sparse_W is not None:
+            out_df = weights_df.copy(); out_df['allele_weight'] = sparse_W[:, [self.sparse_names_.index(col)]].toarray().ravel()
+            return out_df[out_df['allele_weight'] != 0].reset_index(drop=True) if dropzeros else out_df
+        out_df = weights_df.drop(columns='allele_weight', level=0)
+        out_df.columns = out_df.columns.get_level_values(0)
+        out_df['allele_weight'] = weights_df[('allele_weight', col)].to_numpy()
+        if dropzeros: out_df = out_df[out_df['allele_weight'] != 0].reset_index(drop=True) # zeros are absent variants (fillna(0) in from_dict)
+        return out_df
+
     def srdpredict(self, srd, *, n_inchunk=1000, groupby=None, check='depreciated-arg', validate=True, 
                 localdump=False, weight_type='allele', trait_df=None, colour=None, dtype=None): # <-- The more esotheric stuff on this line
         
@@ -595,8 +774,9 @@ class BasePred(ABC):
             
             if weights_df.snp.shape[0] != srd.sid.shape[0] or not np.all(weights_df.snp == bim_df.snp): # Do things to make this true
                 toc('statring sid_to_index')
-                weights_df['idx_srd'] = srd.sid_to_index(weights_df.snp) # ask a small # of snps to sid_to_index asks about 10G for 22M 1kg snpset..
-                # corresponding bim is about 700MB and bed 2.8G (but should not be loaded..), not great...
+                # srd.sid_to_index() asked about 10G for 22M 1kg snpset, a sorted int64 hash index + searchsorted needs ~12 bytes/snp:
+                index_dt = prst.io.make_hash_index(prst.io.get_varhash(bim_df, on=['snp']))
+                weights_df['idx_srd'] = prst.io.lookup_hash_index(index_dt, prst.io.get_varhash(weights_df, on=['snp']))
             toc('continue after sid2index')
                 #srd = srd[:,srd.sid_to_index(weights_df.snp)]
             #assert np.all(srd.sid == weights_df.snp)
@@ -666,6 +846,11 @@ class BasePred(ABC):
         if localdump: output=locals()
         return output
     
+def _predict_file(model, fn, kwg):
+    # Worker for BasePred._predict_multifile(), scores one target file.
+    yhat = model.predict(prst.io.load_bed(fn), **kwg)
+    return yhat, model.error_bound_
+
 class BaseMulti(): ## This is a base class so should Not generate objects i.e. instances.
     
     @classmethod
@@ -681,7 +866,7 @@ class BaseMulti(): ## This is a base class so should Not generate objects i.e. i
         return model
     
     @classmethod
-    def from_dict(cls, weights_dt, ref_df=None, verbose=False, greedy=False, on=None, remove_allnan=False, **kwg):
+    def from_dict(cls, weights_dt, ref_df=None, verbose=False, greedy=False, on=None, remove_allnan=False, sparse=False, **kwg):
         
         assert not greedy, 'Greedy options not implemented yet.'
         assert len(weights_dt) > 0, 'weights_dt is empty'
@@ -698,6 +883,8 @@ class BaseMulti(): ## This is a base class so should Not generate objects i.e. i
             if verbose: print(f'{"Combining":<12}: Since number of input weights is 1, we do not have to combine weight files.')
             return cls.from_weights(list(weights_dt.values())[0], verbose=verbose, **kwg)
         
+        if sparse: return cls._from_dict_sparse(weights_dt, ref_df=allweights_df, verbose=verbose, on_dt=on_dt, **kwg)
+
         # merging mechanics:
         pre_self = cls(**kwg, verbose=verbose) ## <---- self is init twice, see cls.from*() line below
         for wname, curweights_df in pre_self.get_iterator(weights_dt.items(), pbar=pre_self.pbar):
@@ -725,6 +912,38 @@ class BaseMulti(): ## This is a base class so should Not generate objects i.e. i
         if verbose: ''
         return model
             
+    @classmethod
+    def _from_dict_sparse(cls, weights_dt, *, ref_df, verbose=False, on_dt={}, **kwg):
+        # Like from_dict() but combines the weights into a csr matrix (variants x weights) instead of a dense frame with 
+        # fillna(0), so memory is bounded by the number of nonzero weights (thousands of mostly disjoint catalog scores).
+        model = cls(**kwg, verbose=verbose)
+        slim_df = ref_df[['chrom','snp','pos','A1','A2']].reset_index(drop=True)
+        on = on_dt.get('on', ['snp','AX'])
+        index_dt = prst.io.make_hash_index(prst.io.get_varhash(slim_df, on=on)) # The reference is indexed once, each weight file is looked up in it
+        rows_lst = []; vals_lst = []; cols_lst = []; names = []
+        for j, (wname, curweights_df) in enumerate(model.get_iterator(weights_dt.items(), pbar=model.pbar)):
+            if hasattr(model.pbar, 'set_description'): model.pbar.set_description(f"{'Combining':<12}")
+            curweights_df = curweights_df.copy() # Crucial for the PandasMimic type used to load from disk.
+            cur_df = prst.io.match_snps_index(prst.io.validate_dataframe_index(curweights_df, warn=False), slim_df, index_dt, on=on)
+            widx = cur_df['xidx'].to_numpy(dtype='int64'); w = cur_df['allele_weight'].to_numpy(dtype='float64')*cur_df['rflip'].to_numpy()
+            _, first = np.unique(widx, return_index=True) # Duplicated variants in a weight file: the first one is used (as merge_snps does)
+            ind = first[~np.isnan(w[first]) & (w[first] != 0)]
+            rows_lst += [widx[ind]]; vals_lst += [w[ind]]; cols_lst += [np.full(len(ind), j)]
+            names += [wname]
+        W = sp.sparse.csr_array((np.concatenate(vals_lst), (np.concatenate(rows_lst), np.concatenate(cols_lst))), shape=(slim_df.shape[0], len(names)))
+        keep = np.flatnonzero(np.diff(W.indptr)) # Drop variants without any weight
+        model._set_sparse_weights(slim_df.iloc[keep], W[keep], names)
+        if verbose: print(f'Combined {len(names)} weights into a sparse matrix ({len(keep):,} variants, {W.nnz:,} nonzero weights).')
+        return model
+
+    def _set_sparse_weights(self, weights_df, W, names, sort=True):
+        # Sets the variant info (weights_df) & the csr weight matrix W, both in the same (chrom,pos) row order.
+        assert weights_df.shape[0] == W.shape[0] and W.shape[1] == len(names)
+        weights_df = weights_df.reset_index(drop=True)
+        order = weights_df.sort_values(['chrom','pos']).index.to_numpy() if sort else np.arange(weights_df.shape[0])
+        self.weights_df = weights_df.iloc[order].reset_index(drop=True)
+        self.sparse_weights_ = sp.sparse.csr_array(W)[order]; self.sparse_names_ = list(names)
+
     @classmethod
     def from_path(cls, path_or_list, 
                   ref_df=None,
@@ -870,7 +1089,14 @@ class MultiPRS(BaseMulti, BasePred, PRSTCLI):
         # Determines how missing variants are handled.
                  
         missing='flex',
-        val=None,
+        n_jobs:int=1,                 # Number of worker processes for scoring the target, which is then tiled over (samples x variants). With 1 the scoring is done in-process.
+        val:str=None,                 # Validation phenotype for selecting the best weights. Use 'fam' for the target's fam trait column or give a pheno file (FID IID pheno..).
+        pheno:str=None,               # Column of the --val pheno file to use (default: the first phenotype column).
+        metric:str='auto',            # Selection metric, 'r2' or 'auc'. With 'auto' AUC is used for binary phenotypes and R2 otherwise.
+        keep:str=None,                # File with the induviduals (FID IID, or only IID) of the target to score, others are not read. Order and duplicates do not matter.
+        remove:str=None,              # File with the induviduals (FID IID, or only IID) of the target to leave out of the scoring.
+        sparse:bool=False,            # Combine the weights into a sparse matrix, so memory scales with the number of nonzero weights (e.g. for thousands of PGS Catalog scores).
+        checkpoint:bool=False,        # Store the running scores in a checkpoint next to the output, so a crashed prediction resumes from it (requires --n_jobs 1).
         groupby:str=None,
         pbar:bool=True,
         verbose:bool=False
@@ -971,7 +1197,9 @@ class MultiPRS(BaseMulti, BasePred, PRSTCLI):
         #else:  msg += '\nBecause there is not 1 output for every 1 input we cannot proceed! Set e.g. "--out {trimweights}.prs.tsv" to fix.' 
         #msg += 'Will be combining the weights and dont worry.. before the prediction is starting a combined version will be stored which can be reloaded quickly.'
         if verbose: print(msg+'\n')
-        target_df, _ = prst.load_bimfam(target, fam=False, start_string = 'Loading target file.', verbose=False) if target else (None,None) # Load the target to make sure it work
+        if target and prst.io.is_multitarget(target): prst.io.get_target_fns(target) # Make sure the target files are there
+        elif target and not target.endswith('.bgen'): # Load the target to make sure it work (a bgen target gets its variant index on loading)
+            target_df, _ = prst.load_bimfam(target, fam=False, start_string = 'Loading target file.', verbose=False)
             
         # Loop through files:
         if verbose: print('Loading & Combining weights:')
@@ -999,25 +1227,42 @@ class MultiPRS(BaseMulti, BasePred, PRSTCLI):
         # Combine the weights into one frame:    
         model = cls.from_dict(weights_dt, **modelkwg, ref_df=ref_df)
         
-        if len(weights_dt) > 1: 
+        if len(weights_dt) > 1 and getattr(model, 'sparse_weights_', None) is not None:
+            if verbose: print('Not re-saving the combined weights since they are stored sparse (--sparse).\n')
+        elif len(weights_dt) > 1: 
             if prst.io.get_pyarrowinstalled_bool():
                 model._save_results(out_fnfmt, out=out, ftype=weights_ftype)
             else: 
                 if verbose: print('Skipping multi-weights saving since pyarrow is not installed\n')
         elif verbose: print("Not re-saving weights since there was only 1 input weight.\n")
         
+        yhat = None
         if pred and pred != 'no': # Prediction
-            try: 
-                bed = prst.io.load_bed(target, verbose=verbose)
-                yhat = model.predict(bed); 
+            try:
+                bed = target if prst.io.is_multitarget(target) else prst.io.load_bed(target, verbose=verbose) # Multi-file targets are loaded per worker
+                ckpt_fn = out_fnfmt.format_map(dict(ftype='predict.ckpt.npz')) if getattr(model, 'checkpoint', False) else None # Opt-in (--checkpoint)
+                yhat = model.predict(bed, n_jobs=getattr(model, 'n_jobs', 1), checkpoint=ckpt_fn, keep=getattr(model, 'keep', None), remove=getattr(model, 'remove', None)) # A crashed run resumes from the checkpoint
                 prst.io.save_prs(yhat, fn=out_fnfmt, verbose=verbose, ftype=prs_ftype) # Store prediction result
             except Exception as e:
-                msg = (f"Could not generate prediction (e.g. plink file missing)" 
+                msg = (f"Could not generate prediction (e.g. plink file missing)"
                        f" so since --pred='auto' the prediction step will be skipped (target={target})")
                 if pred == 'auto': print(msg)
                 else: raise e
-                    
-        if return_models: 
+
+        if getattr(model, 'val', None): # Selection of the best weights, all configs were scored in the single predict() pass above
+            if yhat is None: raise RuntimeError('--val requires a prediction for the target, but no prediction was made (see above).')
+            fam_df = prst.load_bimfam(list(prst.io.get_target_fns(target).values())[0], bim=False)[1] if prst.io.is_multitarget(target) else bed.fam_df
+            pheno_ser = prst.io.load_pheno(model.val, fam_df=fam_df, pheno=model.pheno, verbose=verbose)
+            metrics_df = model.evaluate(yhat, pheno_ser, metric=model.metric)
+            val_fn = out_fnfmt.format_map(dict(ftype='prstval.tsv'))
+            if verbose: print(f'Validation results:\n{metrics_df.to_string()}\nSaving validation results to: {val_fn}', end=' ')
+            prst.io._pd_to_atomizer(to_file=metrics_df.rename_axis('weights').reset_index().to_csv, fn=val_fn, sep='\t', index=False)
+            if verbose: print('-> Done')
+            selmodel = cls.from_weights(model.get_selected_weights(), verbose=False)
+            selmodel.verbose = verbose
+            selmodel.save_weights(out_fnfmt.format_map(dict(ftype='selected.{ftype}')), ftype='prstweights.tsv')
+
+        if return_models:
             return model
     
 try:
@@ -1,5 +1,6 @@
 import copy, time, warnings, math, traceback, sys, os, glob
 import scipy as sp
+import scipy.sparse
 import numpy as np
 from scipy import linalg, stats
 from numpy import random
@@ -113,6 +114,248 @@ def gigrnd(p, a, b):
     rnd = rnd/math.sqrt(a/b)
     return rnd
 
+def _as_weights(W, dtype='float64'):
+    # Weights (variants x scores) as float array, or as csr matrix if sparse (e.g. thousands of mostly disjoint scores).
+    if sp.sparse.issparse(W): return sp.sparse.csr_array(W, dtype=dtype)
+    W = np.asarray(W, dtype=dtype)
+    return W[:,None] if W.ndim == 1 else W
+
+def _add_matmul(yhat, X, W):
+    # yhat += X@W, for sparse W only the nonzero weights are visited (cost ~ nnz(W) x samples instead of variants x scores x samples).
+    if sp.sparse.issparse(X) and sp.sparse.issparse(W): # sparse x sparse (missingness correction): scatter the nonzeros of the product
+        S = sp.sparse.coo_array(X@W); S.sum_duplicates(); yhat[S.row, S.col] += S.data
+    else: yhat += X@W
+    return yhat
+
+def _scale_rows(W, m):
+    # diag(m)@W for dense or sparse W
+    return sp.sparse.csr_array(W.multiply(m[:,None])) if sp.sparse.issparse(W) else m[:,None]*W
+
+def _zero_missing(X8, miss=-127):
+    # Sets the missings of the int8 chunk X8 (samples x variants) to zero in-place. Returns X8.T (variants x samples, C order)
+    # and the missing entries as sorted flat indices into it with their per-variant pointers (compressed sparse column layout).
+    nsamp, p = X8.shape
+    XT = X8.T # variants x samples, bed_reader reads in fortran order so this normally is a view (no copy)
+    if not XT.flags.c_contiguous: XT = np.ascontiguousarray(XT)
+    flat = np.flatnonzero(XT == miss)
+    XT.reshape(-1)[flat] = 0
+    indptr = np.searchsorted(flat, np.arange(p+1)*nsamp)
+    return XT, flat, indptr
+
+def _score_i8_zeroed(X8, W, yhat, *, dtype='float64', block_mb=32, miss=-127):
+    # yhat += X0@W with X0 the int8 chunk X8 (samples x variants) with missings (-127) set to zero in-place. This is done 
+    # over variant blocks (a small reused float buffer) so there is no float copy of the chunk. Returns the missing entries 
+    # as sorted flat indices into X8.T with their per-variant pointers (i.e. the compressed sparse column layout) and 
+    # the per-variant sums of the non-missing genotypes.
+    nsamp, p = X8.shape
+    XT, flat, indptr = _zero_missing(X8, miss=miss)
+    W = _as_weights(W, dtype=dtype)
+    n_inblock = max(1, int(block_mb*2**20/(max(nsamp,1)*np.dtype(dtype).itemsize)))
+    buf = np.empty((min(n_inblock, p), nsamp), dtype=dtype)
+    for start in range(0, p, n_inblock):
+        stop = min(start+n_inblock, p); Xb = buf[:stop-start]
+        np.copyto(Xb, XT[start:stop])
+        _add_matmul(yhat, Xb.T, W[start:stop])
+    return flat, indptr, XT.sum(axis=1, dtype=np.int64)
+
+def score_i8sparse(X8, W, yhat, *, dtype='float64', block_mb=32, miss=-127, mean=None):
+    # yhat += X@W for an int8 genotype chunk X8 (samples x variants) with the missing (-127) entries mean imputed,
+    # without building a float copy of the chunk: X0@W is computed on the zeroed int8 data and the imputation is added
+    # afterwards as M@(mean*W) with M the sparse missingness indicator matrix. Returns the per-variant missing counts.
+    nsamp, p = X8.shape
+    flat, indptr, colsum = _score_i8_zeroed(X8, W, yhat, dtype=dtype, block_mb=block_mb, miss=miss)
+    msksum = np.diff(indptr)
+    m = colsum/np.maximum(nsamp - msksum, 1) if mean is None else mean # mean of the non-missing genotypes
+    if len(flat) > 0:
+        M = sp.sparse.csc_matrix((np.ones(len(flat), dtype=dtype), flat % nsamp, indptr), shape=(nsamp, p))
+        _add_matmul(yhat, M, _scale_rows(_as_weights(W, dtype=dtype), m))
+    return msksum
+
+def score_i8fixed(X8, W, acc, yhat, *, scale, n_inblock=256, miss=-127, mean=None):
+    # Fixed point version of score_i8sparse(): the weights are quantized to int16 (Wq = rint(W*scale), see ScoreAccumulator)
+    # and acc (int64) += X0@Wq exactly. For blocks of <=256 variants |X0@Wq| <= 2*32767*256 < 2**24, so the products are
+    # done as cheap float32 GEMMs that are still exact integers. The mean imputation M@(mean*Wq/scale) is added to yhat.
+    nsamp, p = X8.shape; assert n_inblock <= 256
+    XT, flat, indptr = _zero_missing(X8, miss=miss)
+    Wq = np.rint(_as_weights(W.toarray() if sp.sparse.issparse(W) else W, dtype='float64')*scale)
+    buf = np.empty((min(n_inblock, p), nsamp), dtype='float32'); Wq32 = Wq.astype('float32')
+    for start in range(0, p, n_inblock):
+        stop = min(start+n_inblock, p); Xb = buf[:stop-start]
+        np.copyto(Xb, XT[start:stop])
+        acc += np.rint(Xb.T@Wq32[start:stop]).astype(np.int64)
+    msksum = np.diff(indptr)
+    m = XT.sum(axis=1, dtype=np.int64)/np.maximum(nsamp - msksum, 1) if mean is None else mean
+    if len(flat) > 0:
+        M = sp.sparse.csc_matrix((np.ones(len(flat)), flat % nsamp, indptr), shape=(nsamp, p))
+        _add_matmul(yhat, M, _scale_rows(Wq/scale, m))
+    return msksum
+
+class ScoreAccumulator:
+    # Sums the per chunk partial scores (samples x traits) of predict(). For float64 the kernels add straight into the total.
+    # For float32 they add into a zeroed float32 buffer that is summed into a float32 total with a Kahan compensation term,
+    # so the rounding error does not grow with the number of chunks. 'int16' is fixed point scoring (see score_i8fixed), with 
+    # exact int64 sums of the quantized weights (the per-trait scale maps max|w| to 32767) and a float64 total for the rest.
+    def __init__(self, shape, dtype='float64', yhat=None, W=None):
+        self.mode = str(np.dtype(dtype)); assert self.mode in ('float64','float32','int16'), f'Unsupported scoring dtype: {dtype}'
+        tdtype = 'float32' if self.mode == 'float32' else 'float64'
+        self.total = np.zeros(shape, dtype=tdtype) if yhat is None else np.array(yhat, dtype=tdtype)
+        if self.mode == 'float32':
+            self.comp = np.zeros(shape, dtype='float32') if yhat is None else (self.total - yhat).astype('float32')
+            self._part = np.zeros(shape, dtype='float32')
+        if self.mode == 'int16':
+            self.acc = np.zeros(shape, dtype=np.int64)
+            wmax = np.abs(W).max(axis=0) if W.shape[0] > 0 else np.zeros(W.shape[1])
+            wmax = wmax.toarray().ravel() if sp.sparse.issparse(wmax) else np.asarray(wmax).ravel()
+            self.scale = np.where(wmax > 0, 32767/np.where(wmax > 0, wmax, 1), 1.)
+
+    def buffer(self):
+        # Array that the next chunk's kernel should add its partial scores to.
+        if self.mode != 'float32': return self.total
+        self._part.fill(0); return self._part
+
+    def add(self, part):
+        if self.mode != 'float32':
+            if part is not self.total: self.total += part
+            return
+        y = part - self.comp; t = self.total + y # Kahan
+        self.comp[:] = (t - self.total) - y; self.total[:] = t
+
+    def value(self):
+        if self.mode == 'float32': return self.total.astype('float64') - self.comp
+        if self.mode == 'int16': return self.total + self.acc/self.scale
+        return self.total.copy()
+
+def get_score_error_bound(dtype, W, *, n_inchunk, n_chunks=1):
+    # Worst-case error bound of the scores from predict() with the given scoring dtype. Returns the bound relative to 
+    # sum_j |x_ij*w_j| <= 2*||w||_1 (genotypes and imputed means are in [0,2]) and the absolute bound per trait. Floating point:
+    # weight rounding (u), a chunk's products & sums (gamma_c, any summation order, with c=n_inchunk plus the imputation term)
+    # and the accumulation over chunks: recursive (gamma_n_chunks) for float64, Kahan (2u + n_chunks*u**2) for float32.
+    # Fixed point (int16): only the weight quantization, |w - wq/scale| <= 0.5/scale for each nonzero weight.
+    mode = str(np.dtype(dtype)); W = W.tocsc() if sp.sparse.issparse(W) else _as_weights(W, dtype='float64')
+    l1 = np.asarray(abs(W).sum(axis=0)).ravel()
+    if mode == 'int16':
+        nnz = np.diff(W.indptr) if sp.sparse.issparse(W) else (W != 0).sum(axis=0)
+        wmax = np.asarray(abs(W).max(axis=0).todense() if sp.sparse.issparse(W) else np.abs(W).max(axis=0, initial=0)).ravel()
+        absb = nnz*2*0.5*wmax/32767
+        rel = np.max(absb/np.where(l1 > 0, 2*l1, 1), initial=0.)
+        return rel, absb
+    u = np.finfo(mode).eps/2; gamma = lambda n: n*u/(1 - n*u)
+    rel = u + gamma(n_inchunk + 2)*(1 + u)
+    rel += gamma(n_chunks) if mode == 'float64' else 2*u + n_chunks*u**2
+    return rel, rel*2*l1
+
+_bed_codes = (np.arange(256)[:,None] >> (2*np.arange(4))) & 3 # The 2-bit plink codes of the 4 samples packed in each byte value
+_bed_vals = np.array([2., np.nan, 1., 0.]) # plink code -> A1 count: 00 hom A1, 01 missing, 10 het, 11 hom A2
+
+def get_packed_counts(P, n_iid, *, block_mb=8):
+    # Per-variant counts of the 4 plink codes (hom A1, missing, het, hom A2) for packed bed rows P (variants x bytes), via 
+    # per-byte-value histograms (so no decoding). The padding in the last byte of each row is excluded.
+    c, nb = P.shape; n_last = n_iid - 4*(nb-1)
+    onehot = (_bed_codes[:,:,None] == np.arange(4)) # (byte value, sample in byte, code)
+    tab = onehot.sum(1); counts = onehot[:,:n_last].sum(1)[P[:,-1]].astype(np.int64)
+    n_inblock = max(1, int(block_mb*2**20/(8*max(nb, 1))))
+    for start in range(0, c, n_inblock):
+        stop = min(start+n_inblock, c); off = (np.arange(stop-start)*256)[:,None]
+        hist = np.bincount((P[start:stop,:-1] + off).ravel(), minlength=(stop-start)*256).reshape(-1, 256)
+        counts[start:stop] += hist@tab
+    return counts
+
+def get_packed_stats(P, n_iid, **kwg):
+    # Per-variant sums of the A1 counts & numbers of missings for packed bed rows P.
+    counts = get_packed_counts(P, n_iid, **kwg)
+    return counts@np.array([2., 0., 1., 0.]), counts[:,1]
+
+def score_packed_lut(P, n_iid, W, yhat, *, dtype='float64', lut_kb=256, tmp_kb=512, mean=None, msksum=None):
+    # yhat += X@W straight from packed bed rows P (variants x bytes, 4 samples per byte) with mean imputed missings.
+    # Every variant gets a 256 entry table with the weight contributions (2w, mean*w, w, 0) for the 4 samples of each byte 
+    # value, after which scoring is a gather + sum over variants per byte: no decoding to int8/float. Work is blocked over
+    # variants (tables of a block fit in cache) and over bytes (bounded temporaries). Returns the per-variant missing counts.
+    c, nb = P.shape; W = _as_weights(W.toarray() if sp.sparse.issparse(W) else W, dtype=dtype); K = W.shape[1]
+    if mean is None: # Not precomputed (see targetstats)
+        colsum, msksum = get_packed_stats(P, n_iid); mean = colsum/np.maximum(n_iid - msksum, 1)
+    m = np.asarray(mean, dtype=dtype)
+    V = np.stack([2*W, m[:,None]*W, W, np.zeros_like(W)], axis=1) # (variants, code, traits)
+    itemsize = np.dtype(dtype).itemsize
+    n_inblock = max(1, int(lut_kb*2**10/(1024*K*itemsize))); acc = np.zeros((nb, 4*K), dtype=dtype)
+    for start in range(0, c, n_inblock):
+        stop = min(start+n_inblock, c)
+        lut = V[start:stop][:, _bed_codes].reshape(-1, 4*K) # ((variants*256), 4 samples*traits)
+        idx = P[start:stop] + (np.arange(stop-start)*256)[:,None]
+        n_inbytes = max(1, int(tmp_kb*2**10/((stop-start)*4*K*itemsize)))
+        for bstart in range(0, nb, n_inbytes):
+            bstop = min(bstart+n_inbytes, nb)
+            acc[bstart:bstop] += lut[idx[:, bstart:bstop]].sum(axis=0)
+    yhat += acc.reshape(nb*4, K)[:n_iid]
+    return msksum
+
+def get_cache_sizes(default=(2**20, 32*2**20)):
+    # Returns the (L2, L3) cache sizes in bytes of this machine (linux sysfs), or the defaults if undetermined.
+    sizes = dict()
+    for dn in glob.glob('/sys/devices/system/cpu/cpu0/cache/index*'):
+        try:
+            with open(os.path.join(dn, 'level')) as f: level = int(f.read())
+            with open(os.path.join(dn, 'size')) as f: size = f.read().strip()
+            sizes[level] = int(size[:-1])*{'K':2**10,'M':2**20,'G':2**30}[size[-1]] if size[-1].isalpha() else int(size)
+        except Exception: continue
+    return sizes.get(2, default[0]), sizes.get(3, default[1])
+
+def get_tile_shape(n_iid, n_snp, *, n_jobs, mem_mb=2048, n_traits=1, dtype='float64', min_inchunk=64, tiles_per_job=4):
+    # Tile = (n_rows samples x n_cols variants). The int8 tile plus its float block buffer has to fit in the memory budget
+    # per worker, and there should be >= tiles_per_job tiles per worker for load balancing. If a tile of min_inchunk 
+    # variants over all samples does not fit, the samples are split as well. Inside a tile the float block buffer is 
+    # sized to the L2 cache and a sample range is kept within L3 when possible, so the GEMM panels stay cache resident.
+    l2, l3 = get_cache_sizes()
+    budget = mem_mb*2**20/max(n_jobs, 1)/2 # half for the int8 tile, half for buffers & partial results
+    n_cols = int(min(max(n_snp/(max(n_jobs,1)*tiles_per_job), min_inchunk), 8192))
+    n_rows = n_iid
+    if n_rows*n_cols > budget: n_cols = max(min_inchunk, int(budget/n_rows))
+    if n_rows*n_cols > budget: n_rows = max(1024, int(budget/n_cols))
+    if n_snp <= n_cols and n_jobs > 1: # too few variants to keep the workers busy, so split over samples
+        n_rows = max(1024, int(np.ceil(n_iid/(n_jobs*tiles_per_job))))
+    n_rows = int(min(n_rows, n_iid)); n_cols = int(min(max(n_cols, 1), max(n_snp, 1)))
+    block_mb = max(l2/2**20, n_rows*np.dtype(dtype).itemsize*16/2**20) # >= 16 variants per float block, else L2 sized
+    if n_rows*np.dtype(dtype).itemsize*n_traits > l3: block_mb = max(block_mb, l3/2**20/4)
+    return n_rows, n_cols, block_mb
+
+def _score_tile(location, iid_count, sid_count, rsl, csl, xidx, W, *, dtype, block_mb, rows=None):
+    # Worker for score_bed_tiled(), with its own open_bed handle. Returns the partial scores for the samples in rsl
+    # and the per-variant partial sums & missing entries (global coordinates), the mean correction needs all samples.
+    # If given, rows are the bed sample rows of the tile (sample subset), rsl then indexes into the subset.
+    from bed_reader import open_bed
+    with open_bed(location, iid_count=iid_count, sid_count=sid_count) as bed:
+        X8 = bed.read(index=np.s_[rsl if rows is None else rows, xidx], dtype='int8', num_threads=1)
+    yhat = np.zeros((X8.shape[0], W.shape[1]))
+    flat, indptr, colsum = _score_i8_zeroed(X8, W, yhat, dtype=dtype, block_mb=block_mb)
+    nsamp = X8.shape[0]
+    return rsl, csl, yhat, colsum, np.diff(indptr), rsl.start + flat % nsamp, csl.start + flat//nsamp
+
+def score_bed_tiled(bed, xidx, W, *, n_jobs=2, mem_mb=2048, tile_shape=None, dtype='float64', iidx=None, verbose=False):
+    # Process-parallel scoring over (sample range x variant range) tiles, yhat = X@W with mean imputed missings.
+    # Every worker opens its own bed handle; partial yhat blocks are summed as they come back, then the mean 
+    # imputation is added for all tiles at once as M@(mean*W) (sparse M). With iidx (sorted sample rows) only those
+    # samples are read, tiled and scored (yhat has len(iidx) rows, means are over the subset).
+    import re
+    from joblib import Parallel, delayed, __version__ as joblib_version
+    xidx = np.asarray(xidx); W = _as_weights(W, dtype=dtype)
+    unordered = tuple(int(x) for x in re.findall(r'\d+', joblib_version)[:2]) >= (1, 4) # joblib<1.4 has no 'generator_unordered', then a list
+    n_iid = bed.iid_count if iidx is None else len(iidx); p = len(xidx)
+    n_rows, n_cols, block_mb = get_tile_shape(n_iid, p, n_jobs=n_jobs, mem_mb=mem_mb, n_traits=W.shape[1], dtype=dtype) \
+        if tile_shape is None else (*tile_shape, 32)
+    tiles = [(slice(r, min(r+n_rows, n_iid)), slice(c, min(c+n_cols, p))) for c in range(0, p, n_cols) for r in range(0, n_iid, n_rows)]
+    if verbose: print(f'Scoring {len(tiles)} tiles of {n_rows:,} x {n_cols:,} (samples x variants) with {n_jobs} workers.', flush=True)
+    yhat = np.zeros((n_iid, W.shape[1])); colsum = np.zeros(p); msksum = np.zeros(p, dtype=np.int64); rows_lst = []; cols_lst = []
+    results = Parallel(n_jobs=n_jobs, max_nbytes=None, mmap_mode=None, **(dict(return_as='generator_unordered') if unordered else {}))(
+        delayed(_score_tile)(bed.location, bed.iid_count, bed.sid_count, rsl, csl, xidx[csl], W[csl], dtype=dtype, block_mb=block_mb,
+                             rows=None if iidx is None else np.asarray(iidx[rsl])) for rsl, csl in tiles)
+    for rsl, csl, part, csum, msum, rows, cols in results: # reduce
+        yhat[rsl] += part; colsum[csl] += csum; msksum[csl] += msum; rows_lst += [rows]; cols_lst += [cols]
+    rows = np.concatenate(rows_lst); cols = np.concatenate(cols_lst)
+    if len(rows) > 0:
+        m = colsum/np.maximum(n_iid - msksum, 1)
+        M = sp.sparse.csr_matrix((np.ones(len(rows), dtype=dtype), (rows, cols)), shape=(n_iid, p))
+        _add_matmul(yhat, M, _scale_rows(W, m))
+    return yhat, msksum
+
 if np.all([x in sys.argv[-1] for x in ('jupyter','.json')]+
           ['ipykernel_launcher.py' in sys.argv[0]] + 
           [not '__file__' in locals()]):
@@ -0,0 +1,59 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import prstools as prst
+from prstools._bgen import write_bgen
+from prstools.models import MultiPRS
+
+def make_bgen(fn, n_iid=57, n_snp=150, seed=0, **kwg):
+    rng = np.random.RandomState(seed)
+    bim_df = pd.DataFrame(dict(chrom=np.repeat([1, 2, 22], [50, 50, n_snp-100]), snp=[f'rs{i}' for i in range(n_snp)], pos=np.arange(n_snp)*10 + 5,
+                               A1=rng.choice(list('ACGT'), n_snp), A2='N'))
+    probs = rng.dirichlet([1, 1, 1], size=(n_snp, n_iid))[..., :2]
+    if kwg.get('phased', False): probs = rng.rand(n_snp, n_iid, 2)
+    missing = rng.rand(n_snp, n_iid) < 0.05
+    dosages = write_bgen(fn, probs, bim_df, missing=missing, **kwg)
+    return bim_df, dosages
+
+@pytest.mark.parametrize('bits,compression,phased,ids', [(8, 1, False, True), (10, 0, False, False), (16, 1, True, True), (3, 1, False, False)])
+def test_bgen_dosages_roundtrip(tmp_path, bits, compression, phased, ids):
+    fn = str(tmp_path / 'test.bgen'); n_iid = 57
+    bim_df, dosages = make_bgen(fn, n_iid=n_iid, bits=bits, compression=compression, phased=phased, ids=[f'id{i}' for i in range(n_iid)] if ids else None)
+    bgen = prst.io.load_bed(fn)
+    assert bgen.iid_count == n_iid and bgen.sid_count == bim_df.shape[0] and np.isnan(dosages).any()
+    assert (bgen.bim_df['snp'] == bim_df['snp']).all() and (bgen.bim_df['chrom'] == bim_df['chrom']).all() and (bgen.bim_df['A1'] == bim_df['A1']).all()
+    assert list(bgen.fam_df['iid'][:2]) == (['id0', 'id1'] if ids else ['sample_0', 'sample_1'])
+    assert np.allclose(bgen.read(), dosages, equal_nan=True, rtol=0, atol=1e-12)
+    cols = np.array([140, 3, 77, 78, 0]); rows = np.s_[5:40]
+    assert np.allclose(bgen.read(index=np.s_[rows, cols], dtype='float32'), dosages[rows][:, cols], equal_nan=True, atol=1e-6)
+    assert np.allclose(bgen.read(index=np.s_[:, 10:20]), dosages[:, 10:20], equal_nan=True, atol=1e-12)
+    with pytest.raises(ValueError, match='float'): bgen.read(dtype='int8')
+
+def test_bgen_index_cache(tmp_path, monkeypatch):
+    import prstools._bgen as bgenmod
+    fn = str(tmp_path / 'test.bgen'); make_bgen(fn)
+    prst.io.load_bgen(fn)
+    assert os.path.isfile(fn + '.prstidx.npz')
+    scan = bgenmod._scan_variants
+    def fail(*args): raise AssertionError('index should have been reused')
+    monkeypatch.setattr(bgenmod, '_scan_variants', fail)
+    prst.io.load_bgen(fn)
+    _, dosages = make_bgen(fn, seed=1) # rewritten file -> other size/mtime -> reindex
+    with pytest.raises(AssertionError, match='reused'): prst.io.load_bgen(fn)
+    monkeypatch.setattr(bgenmod, '_scan_variants', scan)
+    assert np.allclose(prst.io.load_bgen(fn).read(), dosages, equal_nan=True, atol=1e-12)
+
+def test_bgen_zstd(tmp_path):
+    pytest.importorskip('zstandard')
+    fn = str(tmp_path / 'test.bgen'); _, dosages = make_bgen(fn, compression=2)
+    assert np.allclose(prst.io.load_bgen(fn).read(), dosages, equal_nan=True, atol=1e-12)
+
+def test_predict_on_bgen_target(tmp_path):
+    fn = str(tmp_path / 'test.bgen'); bim_df, dosages = make_bgen(fn, n_snp=400, bits=12)
+    weights_df = bim_df.copy(); weights_df['allele_weight'] = np.random.RandomState(3).randn(bim_df.shape[0])*0.01
+    model = MultiPRS.from_weights(weights_df, pbar=False)
+    yhat = model.predict(fn, n_inchunk=64)
+    X = dosages.copy(); m = np.nanmean(X, axis=0); idx = np.where(np.isnan(X)); X[idx] = np.take(m, idx[1])
+    assert np.allclose(yhat.to_numpy()[:,0], X@weights_df['allele_weight'].to_numpy())
+    with pytest.raises(AssertionError, match='Dosage'): model.predict(fn, algo='i8sparse')
@@ -0,0 +1,411 @@
+import os, shutil
+import numpy as np
+import pandas as pd
+import pytest
+import prstools as prst
+from prstools.models import MultiPRS
+
+example_dn = os.path.join(os.path.dirname(prst.__file__), 'data', '_example')
+
+@pytest.fixture(scope='module')
+def bed():
+    return prst.io.load_bed(os.path.join(example_dn, 'target'))
+
+def get_weights(bed, n_configs=3, seed=0):
+    rng = np.random.RandomState(seed)
+    weights_df = bed.bim_df[['chrom','snp','pos','A1','A2']].copy()
+    W = rng.randn(weights_df.shape[0], n_configs)*0.01
+    W[rng.rand(*W.shape) < 0.3] = 0.
+    cols = pd.MultiIndex.from_tuples([(col, '') for col in weights_df.columns] + [('allele_weight', f'cfg{j}') for j in range(n_configs)])
+    weights_df = pd.concat([weights_df, pd.DataFrame(W)], axis=1); weights_df.columns = cols
+    return weights_df
+
+def get_reference_prs(bed, W):
+    X = bed.read(dtype='float64')
+    m = np.nanmean(X, axis=0); idx = np.where(np.isnan(X)); X[idx] = np.take(m, idx[1])
+    return X@W
+
+def test_predict_multiconfig_one_pass(bed):
+    weights_df = get_weights(bed)
+    model = MultiPRS.from_weights(weights_df, pbar=False)
+    yhat = model.predict(bed)
+    assert list(yhat.columns) == ['cfg0','cfg1','cfg2']
+    assert np.allclose(yhat.to_numpy(), get_reference_prs(bed, weights_df['allele_weight'].to_numpy()))
+
+def test_evaluate_selects_best_config(bed):
+    weights_df = get_weights(bed)
+    model = MultiPRS.from_weights(weights_df, pbar=False)
+    yhat = model.predict(bed)
+    rng = np.random.RandomState(1)
+    y = yhat['cfg1'].to_numpy(); y = (y - y.mean())/y.std() + rng.randn(len(y))
+    metrics_df = model.evaluate(yhat, pd.Series(y, index=yhat.index))
+    assert model.selected_ == 'cfg1' and metrics_df['selected'].sum() == 1
+    assert np.isclose(metrics_df.loc['cfg1','r2'], np.corrcoef(y, yhat['cfg1'])[0,1]**2)
+    sel_df = model.get_selected_weights()
+    assert (sel_df['allele_weight'] != 0).all()
+    assert np.allclose(sel_df['allele_weight'], weights_df[('allele_weight','cfg1')][weights_df[('allele_weight','cfg1')] != 0])
+
+def test_compute_prs_metrics_auc(bed):
+    rng = np.random.RandomState(2)
+    yhat = pd.DataFrame(rng.randn(200, 2), columns=['a','b'])
+    y = (yhat['a'] + rng.randn(200) > 0).astype(float) + 1 # plink style 1/2 coding
+    y[:5] = np.nan
+    metrics_df = prst.io.compute_prs_metrics(yhat, y)
+    ind = y.notna(); s = yhat.loc[ind,'a'].to_numpy(); case = (y[ind] == 2).to_numpy()
+    auc = (s[case][:,None] > s[~case][None,:]).mean() # brute force over all case/control pairs
+    assert metrics_df.loc['a','n'] == 195 and np.isclose(metrics_df.loc['a','auc'], auc)
+    assert metrics_df.loc['a','auc'] > metrics_df.loc['b','auc']
+
+def test_multiprs_cli_val_selection(bed, tmp_path):
+    for ext in ['bed','bim','fam']: shutil.copy(os.path.join(example_dn, f'target.{ext}'), tmp_path)
+    weights_df = get_weights(bed)
+    yhat = get_reference_prs(bed, weights_df['allele_weight'].to_numpy())
+    fn_lst = []
+    for j, name in enumerate(weights_df['allele_weight'].columns):
+        cur_df = weights_df[['chrom','snp','pos','A1','A2']].droplevel(1, axis=1)
+        cur_df['allele_weight'] = weights_df[('allele_weight', name)].to_numpy()
+        fn = str(tmp_path / f'{name}.prstweights.tsv'); fn_lst += [fn]
+        cur_df[cur_df['allele_weight'] != 0].to_csv(fn, sep='\t', index=False)
+    pheno_df = bed.fam_df[['fid','iid']].copy(); pheno_df['height'] = yhat[:,2] + 0.1*np.random.RandomState(3).randn(yhat.shape[0])
+    pheno_df.rename(columns=dict(fid='FID', iid='IID')).to_csv(tmp_path / 'pheno.txt', sep='\t', index=False)
+    out = str(tmp_path / 'result')
+    from prstools._parser_vars import get_subparserkwg_lst
+    spkwg = [elem for elem in get_subparserkwg_lst() if elem['clsname'] == 'MultiPRS'][0]
+    MultiPRS.from_cli_params_and_run(pkwargs=spkwg['groups']['model']['pkwargs'], weights=fn_lst, target=str(tmp_path / 'target'), out=out, ref=str(tmp_path / 'target.bim'),
+        pred='yes', val=str(tmp_path / 'pheno.txt'), verbose=False)
+    val_df = pd.read_csv(out + '.prstval.tsv', sep='\t')
+    assert val_df.loc[val_df['selected'], 'weights'].item() == 'cfg2.prstweights.tsv'
+    sel_df = prst.load_weights(out + '.selected.prstweights.tsv')
+    org_df = pd.read_csv(fn_lst[2], sep='\t')
+    assert np.allclose(sel_df.set_index('snp').loc[org_df['snp'], 'allele_weight'], org_df['allele_weight'])
+
+def test_multiprs_cli_multifile_target(bed, tmp_path):
+    for c in bed.bim_df['chrom'].unique(): prst.io.extract_bed(bed, bed.bim_df[bed.bim_df['chrom'] == c], str(tmp_path / f'tgt_chr{c}'), verbose=False)
+    weights_df = get_weights(bed); yhat = get_reference_prs(bed, weights_df['allele_weight'].to_numpy())
+    fn_lst = []
+    for j, name in enumerate(weights_df['allele_weight'].columns):
+        cur_df = weights_df[['chrom','snp','pos','A1','A2']].droplevel(1, axis=1)
+        cur_df['allele_weight'] = weights_df[('allele_weight', name)].to_numpy()
+        fn = str(tmp_path / f'{name}.prstweights.tsv'); fn_lst += [fn]
+        cur_df[cur_df['allele_weight'] != 0].to_csv(fn, sep='\t', index=False)
+    pheno_df = bed.fam_df[['fid','iid']].copy(); pheno_df['height'] = yhat[:,1] + 0.1*np.random.RandomState(3).randn(yhat.shape[0])
+    pheno_df.rename(columns=dict(fid='FID', iid='IID')).to_csv(tmp_path / 'pheno.txt', sep='\t', index=False)
+    out = str(tmp_path / 'result')
+    from prstools._parser_vars import get_subparserkwg_lst
+    spkwg = [elem for elem in get_subparserkwg_lst() if elem['clsname'] == 'MultiPRS'][0]
+    model = MultiPRS.from_cli_params_and_run(pkwargs=spkwg['groups']['model']['pkwargs'], weights=fn_lst, target=str(tmp_path / 'tgt_chr{chrom}'), out=out,
+        ref=os.path.join(example_dn, 'target.bim'), pred='yes', val=str(tmp_path / 'pheno.txt'), verbose=False, return_models=True)
+    val_df = pd.read_csv(out + '.prstval.tsv', sep='\t')
+    assert val_df.loc[val_df['selected'], 'weights'].item() == 'cfg1.prstweights.tsv'
+    assert np.allclose(model.predict(str(tmp_path / 'tgt_chr{chrom}')).to_numpy(), model.predict(bed).to_numpy(), rtol=1e-10, atol=1e-12)
+
+def test_multiprs_cli_checkpoint_opt_in(bed, tmp_path, monkeypatch):
+    fn = str(tmp_path / 'cfg0.prstweights.tsv'); get_weights(bed, n_configs=1).droplevel(1, axis=1).to_csv(fn, sep='\t', index=False)
+    from prstools._parser_vars import get_subparserkwg_lst
+    spkwg = [elem for elem in get_subparserkwg_lst() if elem['clsname'] == 'MultiPRS'][0]
+    ckpts = []; predict = MultiPRS.predict
+    monkeypatch.setattr(MultiPRS, 'predict', lambda self, *args, **kwg: ckpts.append(kwg.get('checkpoint')) or predict(self, *args, **kwg))
+    for checkpoint in [False, True]:
+        MultiPRS.from_cli_params_and_run(pkwargs=spkwg['groups']['model']['pkwargs'], weights=[fn], target=os.path.join(example_dn, 'target'), out=str(tmp_path / 'result'),
+            ref=os.path.join(example_dn, 'target.bim'), pred='yes', checkpoint=checkpoint, verbose=False)
+    assert ckpts == [None, str(tmp_path / 'result.predict.ckpt.npz')] and not os.path.isfile(ckpts[1]) # Removed when done
+
+@pytest.mark.parametrize('prefetch,n_threads', [(0, 1), (2, 1), (1, 3)])
+def test_iter_bed_chunks_in_order(bed, prefetch, n_threads):
+    xidx = np.sort(np.random.RandomState(4).choice(bed.sid_count, 500, replace=False))
+    X = bed.read(index=np.s_[:, xidx], dtype='int8')
+    stops = []
+    for start, stop, X8 in prst.io.iter_bed_chunks(bed, xidx, n_inchunk=37, prefetch=prefetch, n_threads=n_threads,
+                                                   adaptive=True, min_inchunk=10):
+        assert start == (stops[-1] if stops else 0)
+        assert (X8 == X[:, start:stop]).all(); stops += [stop]
+    assert stops[-1] == len(xidx)
+
+def test_predict_prefetch_matches_sync(bed):
+    model = MultiPRS.from_weights(get_weights(bed), pbar=False)
+    yhat_sync = model.predict(bed, prefetch=0, adaptive=False, n_inchunk=100)
+    yhat = model.predict(bed, prefetch=2, n_inchunk=100)
+    assert np.allclose(yhat.to_numpy(), yhat_sync.to_numpy(), rtol=1e-12, atol=1e-12)
+
+@pytest.fixture(scope='module')
+def missbed(tmp_path_factory):
+    from prstools._speedtest import make_synthetic_bed
+    base_fn = str(tmp_path_factory.mktemp('missbed') / 'synth')
+    make_synthetic_bed(base_fn, n_iid=1001, n_snp=700, miss_rate=0.05, verbose=False)
+    return prst.io.load_bed(base_fn)
+
+def test_i8sparse_matches_imputation_algos(missbed):
+    weights_df = get_weights(missbed)
+    assert np.isnan(missbed.read(dtype='float64')).mean() > 0.01
+    model = MultiPRS.from_weights(weights_df, pbar=False)
+    ref = get_reference_prs(missbed, weights_df['allele_weight'].to_numpy())
+    for algo in ['ori','i8fast','i8sparse']:
+        yhat = model.predict(missbed, algo=algo, n_inchunk=128)
+        assert np.allclose(yhat.to_numpy(), ref, rtol=1e-10, atol=1e-12), algo
+    assert model.algo_pred == 'i8fast' # i8sparse is opt-in, and on par with the default:
+    for dtype in ['float64','float32']:
+        yfast, ysparse = (model.predict(missbed, algo=algo, dtype=dtype, n_inchunk=128).to_numpy() for algo in ['i8fast','i8sparse'])
+        assert np.allclose(ysparse, yfast, rtol=1e-10 if dtype == 'float64' else 1e-4, atol=1e-12 if dtype == 'float64' else 1e-5), dtype
+
+def test_tiled_scoring_matches_chunked(missbed):
+    from prstools.models._compute import score_bed_tiled
+    weights_df = get_weights(missbed)
+    model = MultiPRS.from_weights(weights_df, pbar=False)
+    ref = model.predict(missbed, algo='i8sparse')
+    assert np.allclose(model.predict(missbed, n_jobs=2).to_numpy(), ref.to_numpy(), rtol=1e-10, atol=1e-12)
+    W = weights_df['allele_weight'].to_numpy()
+    for tile_shape in [(300, 128), (1001, 50), (17, 700)]: # sample splits incl. ragged ones
+        yhat, msksum = score_bed_tiled(missbed, np.arange(missbed.sid_count), W, n_jobs=2, tile_shape=tile_shape)
+        assert np.allclose(yhat, ref.to_numpy(), rtol=1e-10, atol=1e-12), tile_shape
+    assert msksum.sum() == np.isnan(missbed.read(dtype='float32')).sum()
+
+def test_tiled_scoring_older_joblib(missbed, monkeypatch):
+    import joblib
+    from prstools.models._compute import score_bed_tiled
+    W = get_weights(missbed)['allele_weight'].to_numpy(); ref, _ = score_bed_tiled(missbed, np.arange(missbed.sid_count), W, n_jobs=2, tile_shape=(300, 128))
+    monkeypatch.setattr(joblib, '__version__', '1.3.2') # No return_as='generator_unordered' yet, the results come back as a list
+    yhat, _ = score_bed_tiled(missbed, np.arange(missbed.sid_count), W, n_jobs=2, tile_shape=(300, 128))
+    assert np.allclose(yhat, ref, rtol=1e-12, atol=1e-14)
+
+class CrashBed:
+    # Wraps a bed and raises after n_reads reads, to simulate a crashed/killed run.
+    def __init__(self, bed, n_reads): self._bed = bed; self._n_reads = n_reads
+    def __getattr__(self, name): return getattr(self._bed, name)
+    def read(self, *args, **kwg):
+        if self._n_reads == 0: raise RuntimeError('Simulated crash')
+        self._n_reads -= 1; return self._bed.read(*args, **kwg)
+
+def test_predict_resumes_from_checkpoint(missbed, tmp_path):
+    model = MultiPRS.from_weights(get_weights(missbed), pbar=False)
+    kwg = dict(prefetch=0, adaptive=False, n_inchunk=100)
+    ref = model.predict(missbed, **kwg)
+    ckpt_fn = str(tmp_path / 'predict.ckpt.npz')
+    with pytest.raises(RuntimeError, match='Simulated crash'):
+        model.predict(CrashBed(missbed, 3), checkpoint=ckpt_fn, checkpoint_secs=0, **kwg)
+    assert int(prst.io.load_checkpoint(ckpt_fn)['stop']) == 300
+    yhat = model.predict(missbed, checkpoint=ckpt_fn, **kwg)
+    assert np.allclose(yhat.to_numpy(), ref.to_numpy(), rtol=1e-12, atol=1e-12)
+    assert not os.path.isfile(ckpt_fn)
+
+def test_predict_checkpoint_ignored_if_inputs_changed(missbed, tmp_path):
+    kwg = dict(prefetch=0, adaptive=False, n_inchunk=100)
+    ckpt_fn = str(tmp_path / 'predict.ckpt.npz')
+    model = MultiPRS.from_weights(get_weights(missbed, seed=5), pbar=False)
+    with pytest.raises(RuntimeError): model.predict(CrashBed(missbed, 2), checkpoint=ckpt_fn, checkpoint_secs=0, **kwg)
+    model = MultiPRS.from_weights(get_weights(missbed), pbar=False)
+    with pytest.warns(UserWarning, match='different inputs'):
+        yhat = model.predict(missbed, checkpoint=ckpt_fn, **kwg)
+    assert np.allclose(yhat.to_numpy(), model.predict(missbed, **kwg).to_numpy(), rtol=1e-12, atol=1e-12)
+
+def get_disjoint_weights_dt(bed, n_scores=40, frac=0.05, seed=6):
+    # Many scores that each cover a small random subset of the variants, some with swapped alleles
+    rng = np.random.RandomState(seed); bim_df = bed.bim_df[['chrom','snp','pos','A1','A2']]
+    weights_dt = {}
+    for j in range(n_scores):
+        cur_df = bim_df[rng.rand(bim_df.shape[0]) < frac].copy()
+        cur_df['allele_weight'] = rng.randn(cur_df.shape[0])*0.01
+        swap = rng.rand(cur_df.shape[0]) < 0.3
+        cur_df.loc[swap, ['A1','A2']] = cur_df.loc[swap, ['A2','A1']].to_numpy(); cur_df.loc[swap, 'allele_weight'] *= -1
+        weights_dt[f'score{j}'] = cur_df.reset_index(drop=True)
+    return weights_dt
+
+def test_sparse_multi_weights_match_dense(missbed, monkeypatch):
+    weights_dt = get_disjoint_weights_dt(missbed)
+    ref_df = missbed.bim_df[['chrom','snp','cm','pos','A1','A2']]
+    dense = MultiPRS.from_dict(weights_dt, ref_df=ref_df); dense.pbar = False
+    with monkeypatch.context() as mp: # The sparse combine only does lookups in one index of the reference, no merges
+        for mod in (prst, prst.io): mp.setattr(mod, 'merge_snps', lambda *args, **kwg: 1/0)
+        model = MultiPRS.from_dict(weights_dt, ref_df=ref_df, sparse=True); model.pbar = False
+    assert model.sparse_weights_.nnz == sum(df.shape[0] for df in weights_dt.values())
+    assert model.sparse_weights_.nnz == (dense.get_weights()['allele_weight'] != 0).sum().sum()
+    ref = dense.predict(missbed)
+    for kwg in [dict(algo='ori'), dict(algo='i8fast'), dict(algo='i8sparse'), dict(n_jobs=2)]:
+        yhat = model.predict(missbed, **kwg)
+        assert list(yhat.columns) == list(ref.columns)
+        assert np.allclose(yhat.to_numpy(), ref.to_numpy(), rtol=1e-10, atol=1e-12), kwg
+    sel_df = model.get_selected_weights('score3')
+    assert sel_df.equals(dense.get_selected_weights('score3')[sel_df.columns])
+
+def test_lut_matches_i8sparse(bed, missbed):
+    from prstools.models._compute import get_packed_stats
+    for cbed in [bed, missbed]: # 1001 induviduals: padding in the last byte
+        weights_df = get_weights(cbed)
+        model = MultiPRS.from_weights(weights_df, pbar=False)
+        ref = model.predict(cbed, algo='i8sparse')
+        yhat = model.predict(cbed, algo='lut', n_inchunk=100)
+        assert np.allclose(yhat.to_numpy(), ref.to_numpy(), rtol=1e-10, atol=1e-12)
+    X = missbed.read(dtype='float64'); colsum, msksum = get_packed_stats(prst.io.read_bed_packed(missbed, np.arange(missbed.sid_count)), missbed.iid_count)
+    assert (msksum == np.isnan(X).sum(axis=0)).all() and np.allclose(colsum, np.nansum(X, axis=0))
+
+def test_targetstats_sidecar_and_predict(missbed, tmp_path):
+    for ext in ['bed','bim','fam']: shutil.copy(str(missbed.location)[:-4] + f'.{ext}', tmp_path / f'target.{ext}')
+    from prstools.utils import TargetStats
+    stats_df = TargetStats.from_cli_params_and_run(target=str(tmp_path / 'target'), n_jobs=2, verbose=False)
+    X = missbed.read(dtype='float64')
+    assert (stats_df['n_miss'] == np.isnan(X).sum(axis=0)).all() and (stats_df['n_het'] == (X == 1).sum(axis=0)).all()
+    assert np.allclose(stats_df['af_A1'], np.nanmean(X, axis=0)/2)
+    bed = prst.io.load_bed(str(tmp_path / 'target'))
+    assert prst.io.load_targetstats(bed)[stats_df.columns].equals(stats_df)
+    weights_df = get_weights(bed); model = MultiPRS.from_weights(weights_df, pbar=False)
+    ref = model.predict(bed, targetstats=None)
+    for algo in ['ori','i8fast','i8sparse','lut']:
+        assert np.allclose(model.predict(bed, algo=algo).to_numpy(), ref.to_numpy(), rtol=1e-10, atol=1e-12), algo
+    fake_df = stats_df.assign(mean=stats_df['mean'] + 0.5) # the sidecar means are really used for the imputation
+    assert not np.allclose(model.predict(bed, targetstats=fake_df).to_numpy(), ref.to_numpy())
+    maf = np.minimum(stats_df['af_A1'], 1 - stats_df['af_A1'])
+    yhat = model.predict(bed, min_maf=maf.median(), max_miss=0.06)
+    keep = ((maf >= maf.median()) & (stats_df['miss_rate'] <= 0.06)).to_numpy()
+    assert 0 < keep.sum() < len(keep)
+    assert np.allclose(yhat.to_numpy(), get_reference_prs(bed, weights_df['allele_weight'].to_numpy()*keep[:,None]))
+    os.utime(str(tmp_path / 'target.bed'), ns=(0, 0)) # bed changed -> stale sidecar is ignored
+    with pytest.warns(UserWarning, match='do not match'): assert prst.io.load_targetstats(bed) is None
+
+def test_varindex_matches_merge(bed, tmp_path, monkeypatch):
+    for ext in ['bed','bim','fam']: shutil.copy(os.path.join(example_dn, f'target.{ext}'), tmp_path)
+    bed = prst.io.load_bed(str(tmp_path / 'target'))
+    rng = np.random.RandomState(7); weights_df = get_weights(bed)
+    weights_df = weights_df[rng.rand(weights_df.shape[0]) < 0.8].reset_index(drop=True) # subset of the target
+    swap = rng.rand(weights_df.shape[0]) < 0.4 # swapped alleles -> flipped weights
+    weights_df.loc[swap, [('A1',''),('A2','')]] = weights_df.loc[swap, [('A2',''),('A1','')]].to_numpy()
+    weights_df.loc[swap, 'allele_weight'] = -weights_df.loc[swap, 'allele_weight'].to_numpy()
+    extra_df = weights_df.iloc[:5].copy(); extra_df[('snp','')] = [f'rsmissing{i}' for i in range(5)] # absent in target
+    weights_df = pd.concat([weights_df, extra_df], ignore_index=True)
+    model = MultiPRS.from_weights(weights_df, pbar=False)
+    ref = model.predict(bed, varindex=False)
+    yhat = model.predict(bed)
+    assert np.allclose(yhat.to_numpy(), ref.to_numpy(), rtol=1e-12, atol=1e-12)
+    assert not os.path.isfile(str(tmp_path / 'target.prstvaridx.npz')) # storing the index is opt-in
+    with monkeypatch.context() as mp: # e.g. a read-only target dir: only a warning
+        mp.setattr(prst.io, '_pd_to_atomizer', lambda **kwg: (_ for _ in ()).throw(PermissionError('read-only')))
+        with pytest.warns(UserWarning, match='Could not store'): yhat = model.predict(bed, varindex='save')
+    assert np.allclose(yhat.to_numpy(), ref.to_numpy(), rtol=1e-12, atol=1e-12)
+    model.predict(bed, varindex='save'); index_dt = prst.io.load_varindex(bed)
+    assert os.path.isfile(str(tmp_path / 'target.prstvaridx.npz')) and len(index_dt['hash']) == bed.sid_count
+    monkeypatch.setattr(prst.io, 'make_hash_index', lambda *args: 1/0) # the stored index is reused
+    assert np.allclose(model.predict(bed).to_numpy(), ref.to_numpy(), rtol=1e-12, atol=1e-12)
+    os.utime(str(tmp_path / 'target.bim'), ns=(0, 0))
+    with pytest.raises(ZeroDivisionError): prst.io.load_varindex(bed) # target changed -> rebuild
+
+def test_predict_keep_remove_samples(missbed, tmp_path):
+    rng = np.random.RandomState(3); fam_df = missbed.fam_df
+    rows = np.sort(rng.choice(fam_df.shape[0], 300, replace=False))
+    keep_df = fam_df.iloc[np.concatenate([rows, rows[:50]])].sample(frac=1, random_state=1) # reordered & duplicated ids
+    keep_df[['fid','iid']].rename(columns={'fid':'#FID','iid':'IID'}).to_csv(tmp_path / 'keep.txt', sep='\t', index=False)
+    fam_df.iloc[rows[:10]][['iid']].to_csv(tmp_path / 'remove.txt', header=False, index=False) # IID only
+    iidx = prst.io.get_sample_index(fam_df, keep=str(tmp_path / 'keep.txt'), remove=str(tmp_path / 'remove.txt'))
+    assert (iidx == rows[10:]).all()
+    weights_df = get_weights(missbed); W = weights_df['allele_weight'].to_numpy()
+    X = missbed.read(dtype='float64')[iidx] # the imputation means are over the scored samples
+    m = np.nanmean(X, axis=0); idx = np.where(np.isnan(X)); X[idx] = np.take(m, idx[1])
+    model = MultiPRS.from_weights(weights_df, pbar=False)
+    kwg = dict(keep=str(tmp_path / 'keep.txt'), remove=str(tmp_path / 'remove.txt'))
+    for algo, n_jobs in [('ori',1),('i8fast',1),('i8sparse',1),('i8sparse',2)]:
+        yhat = model.predict(missbed, algo=algo, n_jobs=n_jobs, n_inchunk=128, **kwg)
+        assert yhat.index.equals(pd.MultiIndex.from_frame(fam_df.iloc[iidx][['fid','iid']])), algo
+        assert np.allclose(yhat.to_numpy(), X@W, rtol=1e-10, atol=1e-12), algo
+    with pytest.raises(Exception, match='No induviduals'): prst.io.get_sample_index(fam_df, keep=fam_df.iloc[:0])
+
+def test_reduced_precision_within_error_bound(tmp_path):
+    from prstools._speedtest import make_synthetic_bed, get_synthetic_weights
+    bed = prst.io.load_bed(make_synthetic_bed(str(tmp_path / 'large'), n_iid=2000, n_snp=30000, miss_rate=0.02, verbose=False))
+    model = MultiPRS.from_weights(get_synthetic_weights(bed, n_configs=3), pbar=False)
+    ref = model.predict(bed, dtype='float64').to_numpy()
+    for algo, dtype in [('ori','float32'),('i8fast','float32'),('i8sparse','float32'),('lut','float32'),('i8sparse','int16')]:
+        yhat = model.predict(bed, algo=algo, dtype=dtype, n_inchunk=512).to_numpy()
+        bound = model.error_bound_.to_numpy()
+        assert (np.abs(yhat - ref) <= bound).all(), (algo, dtype)
+        assert np.abs(yhat - ref).max() > 0 and prst.utils.get_prstlogs()['predict_error_bound']['None']['dtype'] == dtype
+
+def test_extract_matches_full_target(missbed, tmp_path):
+    for ext in ['bed','bim','fam']: shutil.copy(str(missbed.location)[:-4] + f'.{ext}', tmp_path / f'target.{ext}')
+    from prstools.utils import Extract
+    bed = prst.io.load_bed(str(tmp_path / 'target'))
+    rng = np.random.RandomState(5); weights_df = get_weights(bed)
+    weights_df = weights_df[rng.rand(weights_df.shape[0]) < 0.3].reset_index(drop=True)
+    swap = rng.rand(weights_df.shape[0]) < 0.5 # swapped alleles still match
+    weights_df.loc[swap, [('A1',''),('A2','')]] = weights_df.loc[swap, [('A2',''),('A1','')]].to_numpy()
+    weights_df.loc[swap, 'allele_weight'] = -weights_df.loc[swap, 'allele_weight'].to_numpy()
+    var_df = weights_df[['snp','A1','A2']].droplevel(1, axis=1)
+    pd.concat([var_df, pd.DataFrame(dict(snp=['rsabsent'], A1=['A'], A2=['C']))]).to_csv(tmp_path / 'variants.tsv', sep='\t', index=False)
+    manifest = Extract.from_cli_params_and_run(target=str(tmp_path / 'target'), variants=str(tmp_path / 'variants.tsv'), out=str(tmp_path / 'ext'), verbose=False)
+    assert manifest['n_variants'] == weights_df.shape[0] and manifest['n_list'] == weights_df.shape[0] + 1
+    assert os.path.getsize(tmp_path / 'ext.bed') == 3 + weights_df.shape[0]*((bed.iid_count + 3)//4)
+    ext = prst.io.load_bed(str(tmp_path / 'ext'))
+    assert np.array_equal(ext.read(dtype='int8'), bed.read(index=np.s_[:, np.sort(bed.bim_df['snp'].isin(var_df['snp']).to_numpy().nonzero()[0])], dtype='int8'))
+    model = MultiPRS.from_weights(weights_df, pbar=False)
+    assert np.allclose(model.predict(ext).to_numpy(), model.predict(bed).to_numpy(), rtol=1e-12, atol=1e-12)
+    os.utime(str(tmp_path / 'target.bed'), ns=(0, 0)) # source changed -> warning
+    with pytest.warns(UserWarning, match='changed after the extraction'): prst.io.load_bed(str(tmp_path / 'ext'))
+
+def test_predict_multifile_target(missbed, tmp_path):
+    bim_df = missbed.bim_df
+    for c in [1, 2, 5]: # one file per chromosome (via extract), 3 files with some chromosomes each
+        prst.io.extract_bed(missbed, bim_df[bim_df['chrom'] == c], str(tmp_path / f'chr{c}'), verbose=False)
+    groups = [range(1, 8), range(8, 16), range(16, 23)]
+    for i, grp in enumerate(groups): prst.io.extract_bed(missbed, bim_df[bim_df['chrom'].isin(grp)], str(tmp_path / f'part{i}'), verbose=False)
+    weights_df = get_weights(missbed); model = MultiPRS.from_weights(weights_df, pbar=False)
+    ref = model.predict(missbed)
+    yhat = model.predict([str(tmp_path / f'part{i}.bed') for i in range(3)], n_jobs_files=2)
+    assert yhat.index.equals(ref.index) and np.allclose(yhat.to_numpy(), ref.to_numpy(), rtol=1e-10, atol=1e-12)
+    yhat = model.predict([str(tmp_path / f'part{i}.bed') for i in range(3)], n_jobs=2) # n_jobs: the tiled kernel, per file
+    assert np.allclose(yhat.to_numpy(), ref.to_numpy(), rtol=1e-10, atol=1e-12)
+    ind = bim_df['chrom'].isin([1, 2, 5]).to_numpy()
+    sub = MultiPRS.from_weights(weights_df[ind].reset_index(drop=True), pbar=False)
+    yhat = sub.predict(str(tmp_path / 'chr{chrom}'), n_jobs_files=2)
+    assert np.allclose(yhat.to_numpy(), get_reference_prs(missbed, weights_df['allele_weight'].to_numpy()*ind[:,None]), rtol=1e-10, atol=1e-12)
+    assert np.allclose(model.predict(str(tmp_path / 'chr{chrom}')).to_numpy(), yhat.to_numpy()) # chromosomes without a file are missing
+    fam_df = missbed.fam_df.iloc[::-1] # other sample order
+    prst.save_fam(fam_df, fn=str(tmp_path / 'chr5.fam'), verbose=False)
+    with pytest.raises(Exception, match='another order'): sub.predict(str(tmp_path / 'chr{chrom}'))
+
+class SlotPRS(MultiPRS):
+    __slots__ = ('tag',) # State outside of __dict__, as a subclass might have
+
+def test_predict_multifile_keeps_subclass_state(missbed, tmp_path, monkeypatch):
+    from prstools.models import _base
+    for i, grp in enumerate([range(1, 12), range(12, 23)]): prst.io.extract_bed(missbed, missbed.bim_df[missbed.bim_df['chrom'].isin(grp)], str(tmp_path / f'part{i}'), verbose=False)
+    model = SlotPRS.from_weights(get_weights(missbed), pbar=False); model.tag = 'x'; model._linkdata = object()
+    parts = []; predict_file = _base._predict_file
+    monkeypatch.setattr(_base, '_predict_file', lambda part, fn, kwg: parts.append(part) or predict_file(part, fn, kwg))
+    yhat = model.predict([str(tmp_path / f'part{i}.bed') for i in range(2)])
+    assert all(type(part) is SlotPRS and part.tag == 'x' and not hasattr(part, '_linkdata') for part in parts) and len(parts) > 1
+    assert hasattr(model, '_linkdata') and sum(part.weights_df.shape[0] for part in parts) == model.weights_df.shape[0]
+    assert np.allclose(yhat.to_numpy(), model.predict(missbed).to_numpy(), rtol=1e-10, atol=1e-12)
+
+@pytest.mark.parametrize('ext', ['tsv','parquet','feather','npy','h5'])
+def test_save_prs_formats(bed, tmp_path, ext):
+    yhat = MultiPRS.from_weights(get_weights(bed, n_configs=70), pbar=False).predict(bed) # more columns than a block (64)
+    fn = str(tmp_path / f'result.{ext}')
+    prst.io.save_prs(yhat, fn=fn)
+    df = prst.io.load_prs(fn)
+    assert list(df.columns) == ['fid','iid'] + list(yhat.columns)
+    assert (df['iid'].to_numpy() == bed.fam_df['iid'].astype(str).to_numpy()).all()
+    assert np.allclose(df.iloc[:,2:].to_numpy(), yhat.to_numpy(), rtol=1e-12, atol=0) # tsv: decimal text
+    assert np.allclose(prst.io.load_prs(fn, columns=['cfg66','cfg3']).iloc[:,2:].to_numpy(), yhat[['cfg66','cfg3']].to_numpy())
+    ftype = 'prstprs.h5' if ext == 'h5' else f'prstprs.{ext}' # the ftype also gives the format
+    prst.io.save_prs(yhat, fn=str(tmp_path / 'res.{ftype}'), ftype=ftype)
+    assert prst.io.load_prs(str(tmp_path / f'res.{ftype}')).equals(df)
+
+def test_predict_partial_and_loco(missbed, tmp_path):
+    bim_df = missbed.bim_df; weights_df = get_weights(missbed); W = weights_df['allele_weight'].to_numpy()
+    model = MultiPRS.from_weights(weights_df, pbar=False)
+    part = model.predict(missbed, partial=True) # per chromosome
+    ref = model.predict(missbed)
+    chroms = [str(c) for c in sorted(bim_df['chrom'].unique())]
+    assert list(part.columns.levels[0]) == sorted(chroms + ['all'])
+    assert np.allclose(part['all'].to_numpy(), ref.to_numpy(), rtol=1e-10, atol=1e-12)
+    for c in ['1','7']:
+        ind = (bim_df['chrom'].astype(str) == c).to_numpy()[:,None]
+        assert np.allclose(part[c].to_numpy(), get_reference_prs(missbed, W*ind), rtol=1e-10, atol=1e-12)
+        loco = model.predict(missbed, partial='chrom', loco=True)
+        assert np.allclose(loco[c].to_numpy(), get_reference_prs(missbed, W*~ind), rtol=1e-10, atol=1e-10)
+    pos = bim_df['pos'].to_numpy() # overlapping annotation intervals & a variant list annotation (variants in several groups)
+    with open(tmp_path / 'ann.bed', 'w') as f: f.write(f'chr1\t0\t{pos[10]}\tgeneA\n1\t{pos[5]}\t{pos[20]}\tgeneB\n2\t0\t10\tempty\n')
+    with open(tmp_path / 'ann.tsv', 'w') as f: f.write('snp\tgroup\n' + ''.join(f'{snp}\tpw{i%3}\n{snp}\tpw_all\n' for i, snp in enumerate(bim_df['snp'][::7])))
+    sub = MultiPRS.from_weights(weights_df[[('chrom',''),('snp',''),('pos',''),('A1',''),('A2',''),('allele_weight','cfg0')]].droplevel(1, axis=1), pbar=False)
+    for ann, groups in [('ann.bed', dict(geneA=np.arange(11), geneB=np.arange(6, 21))), ('ann.tsv', dict(pw1=np.arange(7, 700, 21), pw_all=np.arange(0, 700, 7)))]:
+        yhat = sub.predict(missbed, partial=str(tmp_path / ann))
+        if ann == 'ann.bed': assert (yhat['empty'] == 0).all() # an interval without variants
+        for grp, idx in groups.items():
+            ind = np.isin(np.arange(len(W)), idx)
+            assert np.allclose(yhat[grp].to_numpy(), get_reference_prs(missbed, W[:,:1]*ind[:,None]).ravel(), rtol=1e-10, atol=1e-12), grp
@@ -0,0 +1,379 @@
+import os, shutil
+import numpy as np
+import pandas as pd
+import pytest
+import prstools as prst
+
+example_dn = os.path.join(os.path.dirname(prst.__file__), 'data', '_example')
+
+@pytest.fixture
+def sst_fn(tmp_path):
+    shutil.copy(os.path.join(example_dn, 'sumstats.tsv'), tmp_path)
+    return str(tmp_path / 'sumstats.tsv')
+
+def test_sst_cache_roundtrip_and_invalidation(sst_fn, monkeypatch):
+    ref_df = prst.io.load_sst(sst_fn, n_gwas=2565, verbose=False, cache=False)
+    assert not os.path.isfile(sst_fn + '.prstcache.feather')
+    prst.io.load_sst(sst_fn, n_gwas=2565, verbose=False) # cache='auto': too small to be stored
+    assert not os.path.isfile(sst_fn + '.prstcache.feather')
+    assert prst.io.load_sst(sst_fn, n_gwas=2565, verbose=False, cache=True).equals(ref_df)
+    assert os.path.isfile(sst_fn + '.prstcache.feather')
+    with monkeypatch.context() as mp:
+        mp.setattr(prst.io, '_pd_read_csv', lambda *args, **kwg: 1/0) # the cache is used, no parsing
+        sst_df = prst.io.load_sst(sst_fn, n_gwas=2565, verbose=False)
+        assert sst_df.equals(ref_df) and (sst_df.dtypes == ref_df.dtypes).all()
+        with pytest.raises(ZeroDivisionError): prst.io.load_sst(sst_fn, n_gwas=1000, verbose=False) # other arguments
+        for obj, name, value in [(prst, '__version__', '0.0.0'), (prst.io, '_cache_format', -1)]: # a cache of another version or format is a miss
+            with monkeypatch.context() as mp2:
+                mp2.setattr(obj, name, value)
+                with pytest.raises(ZeroDivisionError): prst.io.load_sst(sst_fn, n_gwas=2565, verbose=False)
+    with open(sst_fn, 'a') as f: f.write('rsnew\tA\tG\t0.1\t0.5\n') # source changed
+    sst_df = prst.io.load_sst(sst_fn, n_gwas=2565, verbose=False)
+    assert sst_df.shape[0] == ref_df.shape[0] + 1 and sst_df['snp'].iloc[-1] == 'rsnew'
+
+def test_transform_writes_cache(sst_fn, tmp_path, monkeypatch):
+    from prstools.utils import Transform
+    out_fn = str(tmp_path / 'out.prstsst.tsv')
+    Transform.from_cli_params_and_run(sst=sst_fn, n_gwas=2565, out=out_fn, verbose=False)
+    assert os.path.isfile(out_fn + '.prstcache.feather')
+    colmap = prst.io._get_default_colmap()
+    ref_df = prst.io.load_sst(out_fn, colmap=colmap, n_gwas=2565, verbose=False, cache=False)
+    monkeypatch.setattr(prst.io, '_pd_read_csv', lambda *args, **kwg: 1/0)
+    assert prst.io.load_sst(out_fn, colmap=colmap, n_gwas=2565, verbose=False).equals(ref_df)
+    assert prst.io.load_sst(out_fn, verbose=False).equals(ref_df) # as e.g. the fit loads it
+
+def test_transform_cache_nondefault_colmap(sst_fn, tmp_path, monkeypatch):
+    from prstools.utils import Transform
+    sst_df = pd.read_csv(sst_fn, sep='\t'); rng = np.random.default_rng(2)
+    sst_df = sst_df.rename(columns=dict(SNP='rsid', A1='EA', A2='OA', BETA='B', P='PV')).assign(SE=0.02, NN=rng.integers(2000, 3000, sst_df.shape[0]))
+    in_fn = str(tmp_path / 'other.tsv'); sst_df.to_csv(in_fn, sep='\t', index=False); out_fn = str(tmp_path / 'out.prstsst.tsv')
+    Transform.from_cli_params_and_run(sst=in_fn, colmap='rsid,EA,OA,B,,PV,SE,NN,,CHR,BP', out=out_fn, verbose=False) # n_eff_handling='raw'
+    ref_df = prst.io.load_sst(out_fn, verbose=False, cache=False) # topmedian n_eff, as later loads do
+    with monkeypatch.context() as mp:
+        mp.setattr(prst.io, '_pd_read_csv', lambda *args, **kwg: 1/0)
+        sst_df = prst.io.load_sst(out_fn, verbose=False)
+    assert sst_df.equals(ref_df) and (sst_df.dtypes == ref_df.dtypes).all()
+
+@pytest.mark.parametrize('gz', [False, True])
+def test_sst_keep_snps_streamed(sst_fn, gz, monkeypatch):
+    import gzip
+    if gz:
+        with open(sst_fn, 'rb') as f, gzip.open(sst_fn + '.gz', 'wb') as g: g.write(f.read())
+        sst_fn = sst_fn + '.gz'
+    full_df = prst.io.load_sst(sst_fn, n_gwas=2565, calc_beta_mrg=False, verbose=False, cache=False)
+    keep = full_df['snp'].iloc[::7].tolist() + ['rsnotinsst']
+    ref_df = full_df[full_df['snp'].isin(keep)].reset_index(drop=True)
+    sst_df = prst.io.load_sst(sst_fn, n_gwas=2565, calc_beta_mrg=False, verbose=False, keep_snps=set(keep))
+    assert sst_df.equals(ref_df) and (sst_df.dtypes == ref_df.dtypes).all()
+    assert sst_df.attrs['n_read'] == full_df.shape[0] # streamed
+    assert not os.path.isfile(sst_fn + '.prstcache.feather')
+    sst_df = prst.io.load_sst(sst_fn, n_gwas=2565, verbose=False, keep_snps=pd.DataFrame(dict(snp=keep)))
+    assert sst_df.shape[0] == ref_df.shape[0] and 'beta_mrg' in sst_df
+    with pytest.raises(AssertionError, match='None of the variants'): prst.io.load_sst(sst_fn, n_gwas=2565, verbose=False, keep_snps=['rsnone'])
+
+@pytest.mark.parametrize('streamed', [True, False])
+def test_sst_keep_snps_full_statistics(tmp_path, streamed):
+    rng = np.random.default_rng(4); n = 5000
+    df = pd.DataFrame(dict(SNP=[f'rs{i}' for i in range(n)], A1='A', A2='G', BETA=rng.normal(size=n)*0.02, SE=rng.uniform(0.005, 0.05, n), P=rng.uniform(size=n),
+                           N=rng.integers(1000, 50_000, n).astype(float)))
+    df.loc[::97, 'SE'] = np.nan
+    fn = str(tmp_path / 'sst.tsv'); df.to_csv(fn, sep='\t', index=False)
+    keep = df['SNP'].iloc[1::9] # the largest N & smallest SE are mostly left out
+    full_df = prst.io.load_sst(fn, verbose=False, cache=False, pyarrow=streamed)
+    ref_df = full_df[full_df['snp'].isin(keep)].reset_index(drop=True)
+    sst_df = prst.io.load_sst(fn, verbose=False, keep_snps=keep, pyarrow=streamed)
+    assert ('n_read' in sst_df.attrs) == streamed and sst_df['snp'].tolist() == ref_df['snp'].tolist()
+    assert np.allclose(sst_df['beta_mrg'], ref_df['beta_mrg'], rtol=1e-14, atol=0) and np.allclose(sst_df['std_sst'], ref_df['std_sst'], rtol=1e-14, atol=0)
+    sub_df = prst.io.compute_beta_mrg(ref_df.drop(columns=['beta_mrg','std_sst'])) # the statistics over the kept variants only differ
+    assert not np.allclose(sub_df['beta_mrg'], sst_df['beta_mrg']) and not np.allclose(sub_df['std_sst'], sst_df['std_sst'])
+
+def test_fit_loading_keeps_reference_variants(tmp_path, monkeypatch):
+    from prstools.linkage import RefLinkageData
+    shutil.copytree(os.path.join(example_dn, 'ldref_1kg_pop'), tmp_path / 'ref', ignore=shutil.ignore_patterns('snpregister.tsv', '__*'))
+    rng = np.random.default_rng(6); ori_df = pd.read_csv(os.path.join(example_dn, 'sumstats.tsv'), sep='\t'); n = 4000
+    extra_df = pd.DataFrame(dict(SNP=[f'rsx{i}' for i in range(n)], A1='A', A2='G', BETA=rng.normal(size=n)*0.02, P=rng.uniform(size=n)))
+    sst_df = pd.concat([ori_df, extra_df], ignore_index=True).assign(SE=lambda x: rng.uniform(0.005, 0.05, x.shape[0]), N=lambda x: rng.integers(1000, 5000, x.shape[0]))
+    fn = str(tmp_path / 'sst.tsv'); sst_df.to_csv(fn, sep='\t', index=False)
+    keeps = []; load_sst = prst.load_sst
+    monkeypatch.setattr(prst, 'load_sst', lambda *args, **kwg: keeps.append(kwg.get('keep_snps')) or load_sst(*args, **kwg))
+    df = RefLinkageData.from_cli_params(ref=str(tmp_path / 'ref'), target=os.path.join(example_dn, 'target'), sst=fn, verbose=False).get_sumstats_cur()
+    assert len(keeps) == 1 and keeps[0] is not None and df.shape[0] == keeps[0]['snp'].isin(ori_df['SNP']).sum()
+    full_df = load_sst(fn, verbose=False, cache=False).set_index('snp') # whole-sumstat n_eff & normalization, as before keep_snps
+    assert np.allclose(df['beta_mrg'], full_df.loc[df['snp'], 'beta_mrg'].to_numpy()*df['rflip'], rtol=1e-14, atol=0)
+
+def test_sst_keep_snps_chrompos(tmp_path):
+    rng = np.random.default_rng(1); n = 500
+    df = pd.DataFrame(dict(CHR=np.repeat(['1','2','X','chr3','4'], n//5), BP=np.arange(n)*10+1, SNP=[f'rs{i}' for i in range(n)],
+                           A1='A', A2='G', BETA=rng.normal(size=n), P=rng.uniform(size=n), N=1000))
+    fn = str(tmp_path / 'sst.tsv'); df.to_csv(fn, sep='\t', index=False)
+    idx = [0, 99, 150, 151, 250, 350, 450, 499]
+    ref_df = pd.DataFrame(dict(chrom=['1','1','2','2','X','3','chr4','4'], pos=df['BP'].iloc[idx].to_numpy()))
+    sst_df = prst.io.load_sst(fn, calc_beta_mrg=False, verbose=False, keep_snps=ref_df)
+    assert sst_df['snp'].tolist() == [f'rs{i}' for i in idx]
+    fb_df = prst.io.load_sst(fn, calc_beta_mrg=False, verbose=False, keep_snps=ref_df, pyarrow=False) # not streamed
+    assert not 'n_read' in fb_df.attrs and fb_df['snp'].tolist() == sst_df['snp'].tolist()
+
+@pytest.mark.parametrize('pyarrow', [True, False])
+def test_sst_keep_snps_without_snp_column(tmp_path, pyarrow):
+    rng = np.random.default_rng(3); n = 300 # No snp ids & positions in another build than keep: get_rsids has to come first, so nothing is filtered
+    df = pd.DataFrame(dict(CHR=rng.integers(1, 23, n), BP=rng.integers(1, 10**8, n), A1='A', A2='G', BETA=rng.normal(size=n), P=rng.uniform(size=n), N=1000))
+    fn = str(tmp_path / 'sst.tsv'); df.to_csv(fn, sep='\t', index=False)
+    keep_df = pd.DataFrame(dict(snp=['rs1','rs2'], chrom=df['CHR'].iloc[:2], pos=df['BP'].iloc[:2] + 1000))
+    kwg = dict(calc_beta_mrg=False, verbose=False, addrsids=False, reqcols=['A1','A2','beta','pval'], pyarrow=pyarrow)
+    sst_df = prst.io.load_sst(fn, keep_snps=keep_df, **kwg)
+    assert sst_df.equals(prst.io.load_sst(fn, cache=False, **kwg)) and sst_df.shape[0] == n
+
+def test_sst_keep_snps_from_cache(sst_fn, monkeypatch):
+    keep = pd.read_csv(sst_fn, sep='\t')['SNP'].iloc[::5]
+    ref_df = prst.io.load_sst(sst_fn, n_gwas=2565, verbose=False, cache=False, keep_snps=keep)
+    prst.io.load_sst(sst_fn, n_gwas=2565, verbose=False, cache=True) # the cache of the whole sumstat
+    for name in ['_pd_read_csv', '_read_csv_filtered']: monkeypatch.setattr(prst.io, name, lambda *args, **kwg: 1/0)
+    sst_df = prst.io.load_sst(sst_fn, n_gwas=2565, verbose=False, keep_snps=keep)
+    assert sst_df.equals(ref_df) and (sst_df.dtypes == ref_df.dtypes).all()
+    assert sst_df.attrs['n_total'] == ref_df.attrs['n_total'] and not 'n_total' in prst.io.load_sst(sst_fn, n_gwas=2565, verbose=False).attrs
+
+def _merge_both(df0, df1, **kwg):
+    import warnings
+    res = []
+    for engine in ['pandas', 'index' if 'AX' in kwg.get('on', ['AX']) else 'auto']:
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            try: out = prst.io.merge_snps(df0.copy(), df1.copy(), engine=engine, **kwg)
+            except Exception as e: out = f'{type(e).__name__}: {e}'
+        res += [(out, [str(elem.message) for elem in w])]
+    return res
+
+def test_merge_snps_index_engine_matches_pandas():
+    sst_df = prst.io.load_sst(os.path.join(example_dn, 'sumstats.tsv'), n_gwas=2565, verbose=False, cache=False)
+    bim_df, _ = prst.io.load_bimfam(os.path.join(example_dn, 'target'))
+    rng = np.random.default_rng(0); n = 2000
+    left_df = pd.DataFrame(dict(chrom=1, snp=[f'rs{i}' for i in rng.permutation(n)], pos=np.arange(n), A1=rng.choice(list('ACGT'), n), A2='N', i=np.arange(n)))
+    right_df = left_df.sample(frac=0.6, random_state=1).reset_index(drop=True)[['snp','A1','A2','i']]
+    swap = rng.random(len(right_df)) < 0.3; right_df.loc[swap, ['A1','A2']] = right_df.loc[swap, ['A2','A1']].values
+    right_df['beta'] = rng.normal(size=len(right_df)); right_df['af'] = rng.random(len(right_df))
+    weights_df = right_df.rename(columns={'beta':'allele_weight'}); weights_df.loc[0, 'snp'] = 'rsnothere'
+    dup = lambda df, k: pd.concat([df, df.iloc[:k]], ignore_index=True)
+    cases = [(bim_df, sst_df, dict(flipcols=['beta_mrg','beta'], handle_missing='filter')),
+             (sst_df, bim_df, dict(flipcols=[], handle_missing='filter')),
+             (left_df, right_df, dict(flipcols=['beta'], afcols=['af'], handle_missing='filter')), # numpy dtypes, missing & swapped
+             (dup(left_df, 7), dup(right_df, 4), dict(flipcols=['beta'], handle_missing='filter')), # duplicates
+             (left_df, right_df, dict(flipcols=['beta'], handle_missing='filter', on=['snp'])),
+             (left_df, right_df, dict(flipcols=['beta'], handle_missing=False)), # errors
+             (left_df, weights_df, dict(flipcols=['allele_weight'], handle_missing='filter'))]
+    for df0, df1, kwg in cases:
+        (ref, ref_w), (out, out_w) = _merge_both(df0, df1, **kwg)
+        if isinstance(ref, str): assert ref == out; continue
+        assert ref.equals(out) and list(ref.columns) == list(out.columns) and (ref.dtypes == out.dtypes).all() and ref_w == out_w
+
+def test_merge_snps_duplicated_right_variants():
+    left_df = pd.DataFrame(dict(snp=['rs1','rs2','rs3','rs4'], A1=['A','C','G','T'], A2=['G','T','A','C'], pos=[1,2,3,4]))
+    right_df = pd.DataFrame(dict(snp=['rs2','rs1','rs1','rs3','rs1','rs3','rs4'], A1=['C','A','G','T','A','G','T'], A2=['T','G','A','C','C','A','C'],
+                                 beta=[0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7])) # rs1 three times (flipped & tri-allelic), rs3 another allele pair first
+    for kwg in [dict(on=['snp']), dict()]: # engine='auto' falls back to pd.merge without AX in on
+        (ref, ref_w), (out, out_w) = _merge_both(left_df, right_df, flipcols=['beta'], handle_missing='filter', **kwg)
+        assert ref.equals(out) and (ref.dtypes == out.dtypes).all() and ref_w == out_w
+        assert out.equals(prst.io.merge_snps(left_df.copy(), right_df.copy(), flipcols=['beta'], handle_missing='filter', engine='auto', **kwg))
+        assert ref['beta'].tolist() == [0.2, 0.1, 0.6, 0.7] and any('Duplicates' in msg for msg in ref_w) # the first of the matching rs1 & rs3
+    with pytest.raises(AssertionError, match='AX in on'): prst.io.merge_snps(left_df.copy(), right_df.copy(), flipcols=['beta'], handle_missing='filter', on=['snp'], engine='index')
+    assert prst.io.merge_snps(left_df.copy(), right_df.copy(), flipcols=['beta'], handle_missing='filter').equals(ref) # pd.merge is the default
+
+def test_join_snps():
+    df0 = pd.DataFrame(dict(snp=['rs1','rs2','rs3','rs4','rs1'], A1=['A','C','G','T','A'], A2=['G','T','A','C','C']))
+    df1 = pd.DataFrame(dict(snp=['rs3','rs1','rs9','rs2','rs2','rs1'], A1=['A','A','A','C','C','C'], A2=['G','G','C','T','T','A']))
+    join_dt = prst.io.join_snps(df0, df1)
+    assert join_dt['lidx'].tolist() == [0,1,2,4] and join_dt['ridx'].tolist() == [1,3,0,5]
+    assert join_dt['rflip'].tolist() == [1,1,-1,-1] and join_dt['n_right'].tolist() == [1,2,1,1]
+
+def test_allele_codes_and_AX():
+    codes = prst.io.get_allele_codes(pd.Series(['A','C','G','T','a','AT','AT',None,'ACGTT'], dtype=object))
+    assert codes[:4].tolist() == [0,1,2,3] and codes[4] >= 4 and codes[5] == codes[6] and codes[5] >= 4 and codes[7] == -1 and codes[8] not in (-1, codes[5])
+    df = pd.DataFrame(dict(A1=['A','G','AT','A','C',None], A2=['G','A','A','T','T','A'])).astype('string[pyarrow]')
+    ax = prst.io.get_AX(df)['AX'].to_numpy()
+    assert ax[0] == ax[1] and len(set(ax[[0,2,3,4]])) == 4 and ax[5] == -1
+    a1, a2, b1, b2 = (pd.Series(lst) for lst in [['A','A','A','AT','C','a'], ['G','G','G','A','G','g'], ['A','G','T','A','G','A'], ['G','A','C','AT','C','G']])
+    assert [int(m) - int(f) for m, f in zip(*prst.io.get_allele_match(a1, a2, b1, b2))] == [1,-1,0,-1,-1,0] # A/G vs T/C only on the other strand, C/G swapped
+    assert [int(m) - int(f) for m, f in zip(*prst.io.get_allele_match(a1, a2, b1, b2, strand=True))] == [1,-1,1,-1,0,0] # C/G: both match & flip, a/g is not A/G
+
+def test_chromposAX_and_allele_match_compat():
+    # The chromposAX key & the allele alignment in merge_snps are as with the string AX: 'chrom_pos_A1_A2' (ordered) & exact allele strings
+    df = pd.DataFrame(dict(chrom=[1, 22, 3, 4, 5], pos=[100, 2000, 30, 40, 50], A1=['G','A','AT','a','T'], A2=['A','G','A','g','TTC']))
+    assert prst.io.get_chromposAX(df.copy())['chromposAX'].tolist() == ['1_100_A_G','22_2000_A_G','3_30_A_AT','4_40_a_g','5_50_T_TTC']
+    left_df = df.assign(snp=[f'rs{i}' for i in range(5)]); right_df = left_df[['snp','A1','A2']].assign(A1=['A','A','A','A','T'], A2=['G','G','AT','G','TTC'], beta=1.)
+    with pytest.warns(UserWarning, match='tri-allelic snps detected \\(n=1\\)'): # a/g is not A/G, as with the string compare
+        mrg_df = prst.io.merge_snps(left_df, right_df, flipcols=['beta'], handle_missing='filter', on=['snp'])
+    assert mrg_df['snp'].tolist() == ['rs0','rs1','rs2','rs4'] and mrg_df['rflip'].tolist() == [-1., 1., -1., 1.]
+
+def test_snpdb_index_rsids_and_build(tmp_path):
+    rng = np.random.default_rng(0); n = 20_000
+    chrom = rng.integers(1, 23, n); pos = rng.integers(1, 200_000, n)
+    db_df = pd.DataFrame(dict(snp=[f'rs{i}' for i in rng.permutation(n) + 1], chrom19=chrom, pos19=pos, chrom38=chrom, pos38=pos + 7))
+    db_df.loc[::50, ['chrom38','pos38']] = np.nan # not in hg38
+    fn = str(tmp_path / 'snpdb.tsv.gz'); db_df.to_csv(fn, sep='\t', index=False)
+    db_df = prst.io.load_snpdb(fn)
+    sst_df = db_df.sample(n=16_000, random_state=1)[['chrom19','pos19']].astype('int64').set_axis(['chrom','pos'], axis=1).reset_index(drop=True)
+    sst_df = pd.concat([sst_df, pd.DataFrame(dict(chrom=[1, 2], pos=[10**7, 10**7]))], ignore_index=True) # not in the snpdb
+    sst_df['beta'] = rng.normal(size=sst_df.shape[0])
+    ref_df = prst.io.get_rsids(sst_df, snpdb_df=db_df, bld=19, verbose=False)
+    out_df = prst.io.get_rsids(sst_df, snpdb_df=fn, bld=19, verbose=False)
+    assert os.path.isfile(fn + '.prstidx/cp19.npy') and not os.path.isfile(fn + '.prstidx/snp.npy')
+    assert out_df.equals(ref_df) and (out_df.dtypes == ref_df.dtypes).all() and out_df['snp'].isna().sum() == 2
+    assert prst.io.get_build(sst_df, snpdb_df=fn, on_fail='warn', verbose=False) == prst.io.get_build(sst_df, snpdb_df=db_df, on_fail='warn', verbose=False) == 19
+    db_df.iloc[:10].to_csv(fn, sep='\t', index=False); os.utime(fn, ns=(1, 1)) # changed source: index is rebuilt
+    assert prst.io.load_snpdb_index(fn)['meta']['n'] == 10
+
+def test_build_sketch_detection(tmp_path, monkeypatch):
+    rng = np.random.default_rng(1); n = 200_000
+    chrom = rng.integers(1, 23, n); pos = rng.integers(1, 10**8, n)
+    db_df = pd.DataFrame(dict(snp=[f'rs{i}' for i in range(n)], chrom19=chrom, pos19=pos, chrom38=chrom, pos38=pos + rng.integers(1, 10**4, n)))
+    fn = str(tmp_path / 'snpdb.tsv.gz'); db_df.to_csv(fn, sep='\t', index=False)
+    sst_df = db_df.sample(frac=0.8, random_state=1)[['chrom38','pos38']].set_axis(['chrom','pos'], axis=1)
+    bld, conf = prst.io.get_build(sst_df, snpdb_df=fn, verbose=False, return_conf=True)
+    assert bld == 38 and conf >= 0.999 and os.path.isfile(fn + '.buildsketch.npz')
+    assert prst.io.get_build(sst_df, snpdb_df=fn, verbose=False, method='sample') == 38
+    sub_df = sst_df.sample(frac=0.05, random_state=2) # A subset-sized sumstat: covers a small part of the sketch, but all its positions match
+    bld, conf, stats_dt = prst.io.get_build_sketched(sub_df, sketch_dt=prst.io.get_build_sketch(fn))
+    assert bld == 38 and conf >= 0.999 and stats_dt['hg38']['frac'] == 1. and stats_dt['hg38']['cover'] < 0.1
+    assert prst.io.get_build(sub_df, snpdb_df=fn, verbose=False, method='sketch') == 38
+    sup_df = pd.concat([sst_df, pd.DataFrame(dict(chrom=rng.integers(1, 23, 10*n), pos=rng.integers(1, 10**8, 10*n)))]) # A superset (imputed sumstat)
+    bld, conf, stats_dt = prst.io.get_build_sketched(sup_df, sketch_dt=prst.io.get_build_sketch(fn))
+    assert bld == 38 and conf >= 0.999 and stats_dt['hg38']['frac'] < 0.1 and stats_dt['hg38']['cover'] > 0.7
+    other_df = pd.DataFrame(dict(chrom=chrom, pos=pos + 10**4)) # Another build: falls back to the sampled lookup, which fails
+    bld, conf = prst.io.get_build(other_df, snpdb_df=fn, verbose=False, method='sketch', on_fail='warn', return_conf=True)
+    assert bld is None and conf < 0.999
+    with pytest.raises(Exception, match='Build Detection Failed: The maximum'): prst.io.get_build(other_df, snpdb_df=fn, verbose=False)
+    big_df = pd.DataFrame(dict(chrom=np.tile(sst_df['chrom'].to_numpy(), 25), pos=np.tile(sst_df['pos'].to_numpy(), 25))) # 4M rows
+    for name in ['load_snpdb', 'load_snpdb_index', 'make_build_sketch']: # The stored sketch is all that is needed
+        monkeypatch.setattr(prst.io, name, lambda *args, **kwg: 1/0)
+    assert prst.io.get_build(big_df, snpdb_df=fn, verbose=False) == 38
+
+def test_save_build_sketch(tmp_path, monkeypatch):
+    rng = np.random.default_rng(2); n = 50_000
+    chrom = rng.integers(1, 23, n); pos = rng.integers(1, 10**8, n)
+    db_df = pd.DataFrame(dict(snp=[f'rs{i}' for i in range(n)], chrom19=chrom, pos19=pos, chrom38=chrom, pos38=pos + rng.integers(1, 10**4, n)))
+    db_fn = str(tmp_path / 'snpdb.tsv.gz'); db_df.to_csv(db_fn, sep='\t', index=False)
+    fn = prst.io.save_build_sketch(db_fn, fn=str(tmp_path / 'snpdb_mini.buildsketch.npz'), verbose=False)
+    monkeypatch.setattr(prst.io, '_get_build_sketch_fn', lambda name: fn) # As if shipped, then no snpdb is needed at all
+    monkeypatch.setattr(prst.io, 'load_snpdb', lambda *args, **kwg: 1/0)
+    sst_df = db_df.sample(frac=0.8, random_state=1)[['chrom38','pos38']].set_axis(['chrom','pos'], axis=1)
+    assert prst.io.get_build(sst_df, snpdb_df='mini', verbose=False, method='sketch') == 38
+
+def _write_chain(fn):
+    # chr1 +strand with gaps, chr2 onto the minus strand, chr3 two overlapping chains (higher score wins) & chr4 onto an alt contig
+    chains = [('1000 chr1 100000 + 100 5150 chr1 120000 + 1100 5200', ['1000 50 100', '2000 1000 0', '1000']),
+              ('900 chr2 80000 + 0 3000 chr2 90000 - 500 3000', ['1000 500 0', '1500']),
+              ('500 chr3 50000 + 1000 4000 chr3 50000 + 11000 14000', ['3000']),
+              ('700 chr3 50000 + 2000 2500 chr7 60000 + 2000 2500', ['500']),
+              ('300 chr4 50000 + 0 1000 chr4_alt 2000 + 0 1000', ['1000'])]
+    with open(fn, 'w') as f:
+        for i, (head, blocks) in enumerate(chains): f.write(f'chain {head} {i+1}\n' + '\n'.join(blocks) + '\n\n')
+    return chains
+
+def _lift_naive(chains, chrom, pos):
+    # Block-by-block reference: highest score over all blocks that hold the (0-based) position
+    best = None
+    for head, blocks in chains:
+        score, tname, _, _, tst, _, qname, qsize, qstrand, qst, _ = head.split(); t, q = int(tst), int(qst)
+        for line in blocks:
+            size, *gaps = map(int, line.split())
+            if tname == chrom and t <= pos < t + size and (best is None or float(score) > best[3]):
+                newpos = q + pos - t
+                best = (qname, int(qsize) - 1 - newpos if qstrand == '-' else newpos, qstrand, float(score))
+            if gaps: t += size + gaps[0]; q += size + gaps[1]
+    return best
+
+def test_liftover_chain(tmp_path):
+    fn = str(tmp_path / 'hg19ToHg38.over.chain'); chains = _write_chain(fn)
+    chain_dt = prst.io.load_chain(fn)
+    rng = np.random.default_rng(2); n = 5_000
+    chroms = np.array(['chr1','chr2','chr3','chr4','chr5'], dtype=object)[rng.integers(0, 5, n)]; pos = rng.integers(-5, 6000, n)
+    lifted = prst.io.lift_positions(chroms, pos, chain_dt=chain_dt)
+    for i in range(n):
+        ref = _lift_naive(chains, chroms[i], pos[i]) or (None, -1, '+', 0)
+        out = (chain_dt['qnames'][lifted['chrom'][i]] if lifted['chrom'][i] >= 0 else None, lifted['pos'][i], '-' if lifted['neg'][i] else '+')
+        assert out == ref[:3], (chroms[i], pos[i], out, ref)
+    df = pd.DataFrame(dict(chrom=[1, 1, 2, 3, 4, 1, 5], pos=[101, 1152, 1, 2101, 11, 1120, 10], A1='A', A2='G'))
+    with pytest.warns(UserWarning, match='#-of-nans = 2'):
+        out_df = prst.io.get_liftoverpositions(df, bldin=19, bldout=38, chain=fn, verbose=False)
+    assert out_df['pos'].tolist() == [1101, 2202, 89500, 2101, 11, pd.NA, pd.NA] and out_df['strand'].iloc[:5].tolist() == ['+','+','-','+','+']
+    assert out_df['chrom'].tolist() == [1, 1, 2, 7, pd.NA, pd.NA, pd.NA] and out_df['oldpos'].equals(df['pos']) # chr4_alt is not a valid chrom
+    try: from pyliftover import LiftOver
+    except ImportError: LiftOver = None
+    if LiftOver is not None: # Same as the row-by-row reference
+        ref_df = prst.io.get_liftoverpositions(df, bldin=19, bldout=38, chain=fn, engine='pyliftover')
+        assert ref_df[['chrom','pos','strand']].equals(out_df[['chrom','pos','strand']])
+    big = rng.integers(0, 6000, 4_000_000)
+    lifted = prst.io.lift_positions(np.full(len(big), 'chr1', dtype=object), big, chain_dt=chain_dt)
+    assert (lifted['chrom'] >= 0).sum() == ((big >= 100) & (big < 5150) & ~((big >= 1100) & (big < 1150)) & ~((big >= 3150) & (big < 4150))).sum()
+    assert prst.io.load_chain(fn) is chain_dt and prst.io.load_chain(fn, cache=False) is not chain_dt # Cache hit: not read & parsed again
+
+def _get_regid_loop(prst_df, regdef_df, fixchromends=True):
+    # The region-by-region get_regid() from before, without the int() so string region-ids work too
+    prst_df = prst_df.copy()
+    for chrom, cur_df in prst_df.groupby('chrom'):
+        cdef_df = regdef_df[regdef_df.chrom.astype(type(chrom))==chrom].copy()
+        if cdef_df.empty: continue
+        if fixchromends:
+            cdef_df.loc[cdef_df.index[0], 'start'] = 0
+            cdef_df.loc[cdef_df.index[-1], 'stop'] = 1e12
+        for _, row in cdef_df.iterrows():
+            mask = (cur_df['pos'] >= row['start']) & (cur_df['pos'] < row['stop'])
+            prst_df.loc[mask.index[mask].to_numpy(), 'regid'] = row['regid']
+    return prst_df
+
+@pytest.mark.parametrize('regdef', ['regions_1blk_shift=0','regions_2blk_shift=0','regions_2blk_shift=1','regions_3blk_shift=0','regions_3blk_shift=1','regions_3blk_shift=2'])
+def test_get_regid_matches_loop(regdef):
+    import warnings
+    regdef_df = prst.io.load_regdef(regdef, verbose=False)
+    rng = np.random.default_rng(3); n = 20_000
+    prst_df = pd.DataFrame(dict(chrom=rng.integers(1, 24, n), pos=rng.integers(0, 2.6e8, n))).astype('Int64')
+    prst_df.loc[:20, 'pos'] = regdef_df['start'].iloc[:21].to_numpy(); prst_df.loc[21:40, 'pos'] = regdef_df['stop'].iloc[:20].to_numpy() # on the boundaries
+    prst_df.loc[41, 'pos'] = pd.NA
+    gap_df = regdef_df.drop(index=regdef_df.index[5::7]).reset_index(drop=True) # gaps between regions
+    ovl_df = pd.concat([regdef_df, regdef_df.iloc[[3, 10, 200]].assign(start=lambda x: x['start']-10**6, stop=lambda x: x['stop']+10**6, regid=[-1,-2,-3] if pd.api.types.is_numeric_dtype(regdef_df['regid']) else ['o1','o2','o3'])], ignore_index=True) # overlaps
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        for cdef_df, fix in [(regdef_df, True), (regdef_df, False), (gap_df, True), (ovl_df, True), (ovl_df, False)]:
+            ref = _get_regid_loop(prst_df, cdef_df, fixchromends=fix)['regid']
+            out = prst.io.get_regid(prst_df.copy(), regdef=cdef_df, fixchromends=fix)['regid']
+            assert ref.equals(out)
+    assert prst.io.get_intervalidx([1, 1, 1, 2], [5, 15, 25, 5], ichrom=[1, 1, 1], start=[0, 10, 12], stop=[20, 14, 30], overlap='first').tolist() == [0, 0, 2, -1]
+    assert prst.io.get_intervalidx([1, 1, 1, 2], [5, 13, 25, 5], ichrom=[1, 1, 1], start=[0, 10, 12], stop=[20, 14, 30]).tolist() == [0, 2, 2, -1]
+    assert prst.io.get_intervalidx([1, 1, 1], [5, 15, 25], ichrom=[1, 1, 1], start=[0, 12, 20], stop=[20, 8, 30]).tolist() == [0, 0, 2] # inverted: empty
+
+def test_variant_groups_overlapping_bed(tmp_path):
+    rng = np.random.default_rng(5); n = 3000; m = 400
+    df = pd.DataFrame(dict(chrom=rng.integers(1, 4, n), snp=[f'rs{i}' for i in range(n)], pos=rng.integers(0, 10**5, n)))
+    ann_df = pd.DataFrame({0: rng.choice(['chr1','2','3','4'], m), 1: rng.integers(0, 10**5, m)}); ann_df[2] = ann_df[1] + rng.integers(0, 5000, m)
+    ann_df.loc[:9, 1] = df['pos'].iloc[:10].to_numpy(); ann_df.loc[:9, 0] = df['chrom'].iloc[:10].astype(str).to_numpy() # start = pos: not in it
+    ann_df[3] = [f'g{i%150}' for i in range(m)] # several intervals per group, which overlap a lot
+    ann_df.to_csv(tmp_path / 'ann.bed', sep='\t', header=False, index=False)
+    rows, gidx, names = prst.io.get_variant_groups(df, str(tmp_path / 'ann.bed'))
+    chrom = ann_df[0].str.replace('chr', '').to_numpy(); vchrom = df['chrom'].astype(str).to_numpy(); vpos = df['pos'].to_numpy()
+    ref = {(i, name) for c, a, b, name in zip(chrom, ann_df[1], ann_df[2], ann_df[3]) for i in np.flatnonzero((vchrom == c) & (vpos > a) & (vpos <= b))}
+    assert {(i, names[g]) for i, g in zip(rows, gidx)} == ref and len(rows) == len(ref) and len(ref) > 0
+
+def test_bimfam_cache(tmp_path, monkeypatch, capsys):
+    base_fn = str(tmp_path / 'target')
+    for ext in ['.bim','.fam']: shutil.copy(os.path.join(example_dn, 'target' + ext), base_fn + ext)
+    ref_bim, ref_fam = prst.io.load_bimfam(base_fn, cache=False)
+    bim_df, fam_df = prst.io.load_bimfam(base_fn + '.bed', cache=True, add_AX=True) # writes the sidecar
+    assert os.path.isfile(base_fn + '.bim.prstcache.feather') and fam_df.equals(ref_fam)
+    bim_df, _ = prst.io.load_bimfam(base_fn, chrom=22, add_xidx=True)
+    assert bim_df.drop(columns='xidx').equals(ref_bim) and (bim_df.dtypes.drop('xidx') == ref_bim.dtypes).all() and (bim_df['xidx'] == np.arange(len(bim_df))).all()
+    bim_df = pd.read_csv(base_fn + '.bim', sep='\t', header=None, dtype={0: str}) # A changed bim with X chroms: the sidecar is stale
+    bim_df.loc[:9, 0] = 'X'; bim_df.to_csv(base_fn + '.bim', sep='\t', header=False, index=False); os.utime(base_fn + '.bim', ns=(1, 1))
+    ref_bim, _ = prst.io.load_bimfam(base_fn, cache=False)
+    assert ref_bim['chrom'].iloc[0] == 23 and prst.io.load_bim_cache(base_fn + '.bim', dict(cmap=True)) is None
+    prst.io.load_bimfam(base_fn, cache=True); assert prst.io.load_bim_cache(base_fn + '.bim', dict(cmap=True)) is not None
+    with monkeypatch.context() as mp: # A sidecar of another cache format is a miss
+        mp.setattr(prst.io, '_cache_format', -1); assert prst.io.load_bim_cache(base_fn + '.bim', dict(cmap=True)) is None
+    prst.io.load_bimfam(base_fn, cache=True); bim_df, _ = prst.io.load_bimfam(base_fn)
+    assert bim_df.equals(ref_bim) and (bim_df.dtypes == ref_bim.dtypes).all()
+    n = 2_000_000; rng = np.random.default_rng(4) # Large bim: the sidecar is made with cache='auto', and is fast
+    big_df = pd.DataFrame(dict(chrom=rng.integers(1, 23, n), snp=[f'rs{i}' for i in range(n)], cm=0., pos=rng.integers(1, 10**8, n),
+                               A1=rng.choice(list('ACGT'), n), A2=rng.choice(['A','C','G','T','AT'], n)))
+    big_df.to_csv(base_fn + '.bim', sep='\t', header=False, index=False)
+    ref_bim, _ = prst.io.load_bimfam(base_fn)
+    monkeypatch.setattr(pd, 'read_csv', lambda *args, **kwg: 1/0); capsys.readouterr() # The sidecar is used, the bim is not parsed
+    bim_df, _ = prst.io.load_bimfam(base_fn, fam=False, verbose=True)
+    assert '(used cache)' in capsys.readouterr().out and bim_df.equals(ref_bim) and (bim_df.dtypes == ref_bim.dtypes).all()
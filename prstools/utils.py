@@ -960,6 +960,7 @@ class Transform(AutoPRSTCLI): #, AutoPRSTSubparser):
             sep:str='\t', # Seperator for the inputs files, default is \t (tab).
             n_eff_handling='raw',
             pyarrow=True,
+            cache:bool=True, # Also store a columnar cache of each output (<out>.prstcache.feather) so later runs load it in a fraction of the time.
             verbose=True,
             **kwg # this kwg catches command and func for a smooth run
             ):
@@ -1003,7 +1004,12 @@ class Transform(AutoPRSTCLI): #, AutoPRSTSubparser):
                     print(f'\nIt seems {os.path.basename(out_fn)} does not exist (or a redo was requested) so we are making it from {fn}')
                     sst_df = prst.load_sst(fn, colmap=colmap, verbose=verbose, delimiter=sep, n_gwas=n_gwas, n_eff_handling=n_eff_handling)
                     sst_df['snp'] = sst_df['snp'].fillna('NA')
-                    prst.io.save_sst(sst_df, out_fn, verbose=verbose)
+                    out_df = prst.io.save_sst(sst_df, out_fn, verbose=verbose, return_sst=True)
+                    if cache: # The cache holds the output as a later load_sst(out_fn) (default arguments) returns it, made from the frame in hand
+                        cache_df = prst.io._to_arrow_dtypes(out_df.rename(columns=prst.io.get_conv_dt(flow='in'))) # the dtypes a (pyarrow) parse gives
+                        cache_df = prst.io.compute_beta_mrg(cache_df, n_eff_handling='topmedian')
+                        cache_df = prst.io.validate_dataframe_select(cache_df, select=['index','A1A2','chrompos','n_eff'], warn=False)
+                        prst.io.save_sst_cache(cache_df, out_fn, args=prst.io.get_sst_cache_args(), has_n_eff='n_eff' in cache_df, n_total=out_df.shape[0])
                 except Exception as e:
                     if 'strict' in mode:
                         raise e from Exception('Set --mode flex to have the procedure skip input files that give issues.')
@@ -1014,6 +1020,68 @@ class Transform(AutoPRSTCLI): #, AutoPRSTSubparser):
             raise e
             
     
+class TargetStats(AutoPRSTCLI):
+    
+    '''\
+    Compute allele frequencies, missing rates and hard-call counts for every variant of a target plink bed file.
+    The results are stored in a compact sidecar next to the bed (<target>.prsttargetstats.npz), which is tied to the exact
+    bed file (size & modification time). Prediction then uses these statistics for the mean imputation of missing genotypes 
+    and for variant filtering, instead of recomputing them.
+    '''
+    
+    @classmethod
+    def _get_cli_spkwg(cls, basic_pkwargs=True):
+        spkwg = super()._get_cli_spkwg(basic_pkwargs=basic_pkwargs)
+        spkwg['groups']['general']['pkwargs']['target']['kwargs'].update(required=True)
+        return spkwg
+    
+    @classmethod
+    def from_cli_params_and_run(cls,
+            target:str=None, # The target plink bed file or its prefix.
+            out:str=None, # Optional: Output file for the statistics (default: next to the bed file). Predictions only pick up the default location.
+            n_jobs:int=1, # Number of worker processes, each computes the statistics for chunks of variants.
+            tsv:bool=False, # Also store the statistics as a readable tab-separated file.
+            verbose=True,
+            **kwg # this kwg catches command and func for a smooth run
+            ):
+        bed = prst.io.load_bed(target, verbose=verbose, end='\n')
+        stats_df = prst.io.compute_targetstats(bed, n_jobs=n_jobs, verbose=verbose)
+        fn = prst.io.save_targetstats(stats_df, bed, fn=out, verbose=verbose)
+        if tsv and fn:
+            tsv_fn = fn.replace('.npz', '.tsv')
+            if verbose: print(f'Saving target variant statistics as tsv to: {tsv_fn}', end=' ', flush=True)
+            prst.io._pd_to_atomizer(to_file=stats_df.to_csv, fn=tsv_fn, sep='\t', index=False)
+            if verbose: print('-> Done')
+        return stats_df
+    
+class Extract(AutoPRSTCLI):
+    
+    '''\
+    Extract the target variants that are in a variant list (e.g. a HapMap3 subset or weights) into a compact plink fileset.
+    The variants are matched on id & alleles and copied from the target plink bed file without decoding. A manifest of the
+    source (<out>.prstextract.json) is stored too, a warning is given when the extract is used after its source bed changed.
+    Predictions for weights on that variant set can then use the (much smaller) extract as target instead of the full bed.
+    '''
+    
+    @classmethod
+    def _get_cli_spkwg(cls, basic_pkwargs=True):
+        spkwg = super()._get_cli_spkwg(basic_pkwargs=basic_pkwargs)
+        for key in ['target','variants','out']: spkwg['groups']['general']['pkwargs'][key]['kwargs'].update(required=True)
+        return spkwg
+    
+    @classmethod
+    def from_cli_params_and_run(cls,
+            target:str=None, # The target plink bed file or its prefix.
+            variants:str=None, # The variant list: a bim file, a headed file with a snp column (+ optionally A1 & A2, e.g. weights) or a file with one variant id per line.
+            out:str=None, # Output prefix for the extracted plink fileset (.bed/.bim/.fam) and its manifest.
+            rsidmode:str='auto', # How to handle the variant ids of the target, see validate_dataframe_rsids.
+            verbose=True,
+            **kwg # this kwg catches command and func for a smooth run
+            ):
+        bed = prst.io.load_bed(target, verbose=verbose, end='\n')
+        variants_df = prst.io.load_variants(variants)
+        return prst.io.extract_bed(bed, variants_df, out, rsidmode=rsidmode, verbose=verbose)
+    
 class CycleDict(dict):
 
     def __getitem__(self, key):
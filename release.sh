@@ -26,6 +26,9 @@ pip install -e ./ # Important, else it might grab anotherin install
 rsync -auv --exclude='.git/' --exclude-from='.gitignore' --existing ../prstools/ ./
 cd ./prstools  # ok the order of all this seems funny, but im not gonna change it for now
 python ./_cmd.py --dev-secret # !!!ahh yess, to not have all the alpha code references. 
+echo "BUILD SKETCHES" # The shipped build detection sketches (data/defs/buildsketch), made from the prstdatadir snpdbs, see io.save_build_sketch
+python -c "import prstools as prst; prst.io.save_build_sketch('mini'); prst.io.save_build_sketch('full')"
+git add data/defs/buildsketch/*.buildsketch.npz
 
 # Commiting and push to github & pypi
 git add -u